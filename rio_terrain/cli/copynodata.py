@@ -1,8 +1,7 @@
 """Set values of one raster to nodata based on another"""
 
-import time
 import warnings
-import concurrent.futures
+from functools import partial
 import multiprocessing
 from typing import Union
 
@@ -10,8 +9,8 @@ import click
 import numpy as np
 import rasterio
 
-import rio_terrain as rt
-import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+from rio_terrain.cli import options
 from rio_terrain.tools.numbers import is_all_nan, nan_shape
 
 from rio_terrain import __version__ as plugin_version
@@ -23,7 +22,10 @@ def do_copynodata(
     nodata: Union[int, float],
     mask_nodata: Union[int, float]
 ) -> np.ndarray:
-    result = np.where((np.isnan(mask)), nodata, intensity)
+    missing = np.isnan(mask)
+    if mask_nodata is not None:
+        missing |= mask == mask_nodata
+    result = np.where(missing, nodata, intensity)
     return result
 
 
@@ -35,10 +37,36 @@ def do_copynodata(
               help='Multiply TIFF block size by an amount to make chunks')
 @click.option('-j', '--jobs', 'njobs', type=int, default=1,
               help='Number of concurrent jobs to run')
+@options.parallel_reads_opt
+@options.backend_opt
+@options.prefetch_opt
+@options.shard_opt
+@options.plan_only_opt
+@options.resume_opt
+@options.skip_empty_opt
+@options.order_opt
+@options.out_tiled_opt
+@options.out_blocksize_opt
+@options.cog_opt
+@options.output_format_opt
+@options.to_gtiff_opt
+@options.tile_outputs_opt
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
+@options.mask_band_opt
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
 @click.version_option(version=plugin_version, message='rio-channel v%(version)s')
 @click.pass_context
-def copynodata(ctx, intensity_f, mask_f, output, blocks, njobs, verbose):
+def copynodata(
+    ctx,
+    intensity_f,
+    mask_f,
+    output,
+    verbose,
+    **run_options
+):
     """Stamp one single-band raster into another.
 
     \b
@@ -55,9 +83,6 @@ def copynodata(ctx, intensity_f, mask_f, output, blocks, njobs, verbose):
     else:
         warnings.filterwarnings('ignore')
 
-    t0 = time.time()
-    command = click.get_current_context().info_name
-
     with rasterio.open(intensity_f) as intensity_src, rasterio.open(mask_f) as mask_src:
         profile = intensity_src.profile
 
@@ -67,7 +92,6 @@ def copynodata(ctx, intensity_f, mask_f, output, blocks, njobs, verbose):
                 dtype=rasterio.int32,
                 nodata=nodata,
                 count=1,
-                compress='lzw',
                 bigtiff='YES')
         elif profile['dtype'] in ['float32', 'float64']:
             nodata = np.finfo(np.float32).min
@@ -75,103 +99,17 @@ def copynodata(ctx, intensity_f, mask_f, output, blocks, njobs, verbose):
                 dtype=rasterio.float32,
                 nodata=nodata,
                 count=1,
-                compress='lzw',
                 bigtiff='YES')
         else:
             click.echo('No change in profile')
 
-        blockshape = (list(intensity_src.block_shapes))[0]
-        if njobs == 0:
-            w, s, e, n = intensity_src.bounds
-            full_window = rasterio.windows.from_bounds(w, s, e, n, transform=intensity_src.transform)
-            read_windows = [full_window]
-            write_windows = [full_window]
-        else:
-            if intensity_src.is_tiled:
-                if (blockshape[0] == 1) or (blockshape[1] == 1):
-                    warnings.warn((msg.STRIPED).format(blockshape))
-            else:
-                blockshape = [128, 128]
-                warnings.warn((msg.NOTILING).format(intensity_src.shape))
-            windows = rt.tile_grid(
-                intensity_src.width,
-                intensity_src.height,
-                blockshape[0]*blocks,
-                blockshape[1]*blocks,
-                overlap=0)
-
-        with rasterio.open(output, 'w', **profile) as dst:
-            if njobs == 0 or njobs == 1:
-                if njobs == 0:
-                    click.echo((msg.STARTING).format(command, msg.INMEMORY))
-                else:
-                    click.echo((msg.STARTING).format(command, msg.SEQUENTIAL))
-                with click.progressbar(
-                        length=intensity_src.height*intensity_src.width,
-                        label='Blocks done:') as bar:
-                    for window in windows:
-                        intensity = intensity_src.read(1, window=window)
-                        mask = mask_src.read(1, window=window)
-                        result = do_copynodata(intensity.astype(profile['dtype']), mask, nodata, mask_src.nodata)
-                        dst.write(result.astype(profile['dtype']), 1, window=window)
-                        bar.update(result.size)
-            else:
-                click.echo((msg.STARTING).format(command, msg.CONCURRENT))
-
-                def jobs():
-                    for (ij, window) in intensity_src.block_windows():
-                        intensity = intensity_src.read(1, window=window)
-                        mask = mask_src.read(1, window=window)
-                        yield intensity, mask, window
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor, \
-                        click.progressbar(
-                            length=intensity_src.width*intensity_src.height,
-                            label='Blocks done:') as bar:
-
-                    future_to_window = {
-                        executor.submit(
-                            do_copynodata, intensity, mask, nodata, mask_src.nodata
-                        ): (window)
-                        for (intensity, mask, window) in jobs()
-                    }
-
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        window = future_to_window[future]
-                        result = future.result()
-                        dst.write(result.astype(profile['dtype']), 1, window=window)
-                        bar.update(result.size)
-
-                """
-                import dask.array as da
-
-                with click.progressbar(
-                        length=intensity_src.width*intensity_src.height,
-                        label='Blocks done:') as bar:
-                    for window in windows:
-                        intensity = intensity_src.read(1, window=window)
-                        mask = mask_src.read(1, window=window)
-
-                        hh, ww = rt.tile_dims(
-                            (intensity.shape[0], intensity.shape[1]),
-                            (blockshape[0] * 4, blockshape[1] * 4),
-                            min_size=blockshape[0] * 2,
-                            balance=True,
-                            merge=True,
-                            as_chunks=True)
-
-                        result = da.map_overlap(
-                            do_copynodata,
-                            intensity=intensity.astype(profile['dtype']),
-                            dtype=profile['dtype'],
-                            mask=mask,
-                            nodata=nodata,
-                            mask_nodata=mask_src.nodata,
-                            boundary='reflect').compute()
-
-                        dst.write(result.astype(profile['dtype']), 1, window=window)
-                        bar.update(result.size)
-                """
+        kernel = partial(do_copynodata, nodata=nodata, mask_nodata=mask_src.nodata)
 
-    click.echo((msg.WRITEOUT).format(output))
-    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
+        engine.run(
+            [intensity_src, mask_src], kernel, profile, output,
+            engine.RunOptions(verbose=verbose, **run_options),
+            command=click.get_current_context().info_name,
+            nan_nodata=False,
+            codec='lzw',
+            echo=click.echo,
+            progressbar=click.progressbar)
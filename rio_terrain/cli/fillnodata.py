@@ -1,20 +1,25 @@
 """Apply hysteresis thresholding to a raster."""
 
-import time
 import warnings
-import concurrent.futures
+from functools import partial
+from math import ceil
 from typing import Union
 
 import click
 import numpy as np
 import rasterio
+import rasterio.fill
 
-import rio_terrain as rt
-import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+from rio_terrain.cli import options
 
 from rio_terrain import __version__ as plugin_version
 
 
+# float64 tile-sized arrays the kernel allocates, used to size tiles for --max-memory
+TEMPORARIES = 3
+
+
 def do_fillnodata(
     intensity: np.ndarray,
     mask: np.ndarray = None,
@@ -56,10 +61,44 @@ def do_fillnodata(
 @click.option('-n', '--iterations', nargs=1, type=int, default=0, help="Number of smoothing iterations")
 @click.option('-j', '--njobs', type=int, default=1,
               help="Number of concurrent jobs to run.")
+@options.parallel_reads_opt
+@options.backend_opt
+@options.prefetch_opt
+@options.shard_opt
+@options.plan_only_opt
+@options.resume_opt
+@options.skip_empty_opt
+@options.order_opt
+@options.max_memory_opt
+@options.autotune_opt
+@options.autotune_cache_opt
+@options.out_tiled_opt
+@options.out_blocksize_opt
+@options.cog_opt
+@options.output_format_opt
+@options.to_gtiff_opt
+@options.tile_outputs_opt
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
+@options.mask_band_opt
+@options.quantize_opt
+@options.scale_opt
+@options.offset_opt
 @click.option('-v', '--verbose', is_flag=True, help="Enables verbose mode.")
 @click.version_option(version=plugin_version, message="rio-terrain v%(version)s")
 @click.pass_context
-def fillnodata(ctx, input, output, mask_f, distance, iterations, njobs, verbose):
+def fillnodata(
+    ctx,
+    input,
+    output,
+    mask_f,
+    distance,
+    iterations,
+    verbose,
+    **run_options
+):
     """Fill nodata cells by interpolation.
 
     INPUT should be a single-band continuous raster.
@@ -74,9 +113,6 @@ def fillnodata(ctx, input, output, mask_f, distance, iterations, njobs, verbose)
     else:
         warnings.filterwarnings('ignore')
 
-    t0 = time.time()
-    command = click.get_current_context().info_name
-
     with rasterio.open(input) as src:
         if mask_f:
             mask_src = rasterio.open(mask_f)
@@ -84,89 +120,29 @@ def fillnodata(ctx, input, output, mask_f, distance, iterations, njobs, verbose)
             mask_src = None
 
         profile = src.profile
-        affine = src.transform
 
         # nodata = np.finfo(np.float32).min
         nodata = profile['nodata']
         profile.update(
             dtype=rasterio.float32,
             count=1,
-            compress='deflate',
-            predictor=3,
             bigtiff='YES')
 
-        if njobs == 0:
-            w, s, e, n = src.bounds
-            full_window = rasterio.windows.from_bounds(w, s, e, n, transform=src.transform)
-            read_windows = [full_window]
-            write_windows = [full_window]
-        else: 
-            if src.is_tiled:
-                blockshape = (list(src.block_shapes))[0]
-                if (blockshape[0] == 1) or (blockshape[1] == 1):
-                    warnings.warn((msg.STRIPED).format(blockshape))
-            else:
-                blockshape = [128, 128]
-                warnings.warn((msg.NOTILING).format(src.shape))
-            read_windows = rt.tile_grid(
-                src.width,
-                src.height,
-                blockshape[0],
-                blockshape[1],
-                overlap=distance)
-            write_windows = rt.tile_grid(
-                src.width,
-                src.height,
-                blockshape[0],
-                blockshape[1],
-                overlap=0)
-
-        with rasterio.open(output, 'w', **profile) as dst:
-            if njobs == 0 or njobs == 1:
-                if njobs == 0:
-                    click.echo((msg.STARTING).format(command, msg.INMEMORY))
-                else:
-                    click.echo((msg.STARTING).format(command, msg.SEQUENTIAL))
-                with click.progressbar(length=src.width*src.height, label="Blocks done:") as bar:
-                    for read_window, write_window in zip(read_windows, write_windows):
-                        intensity = src.read(1, window=read_window)
-                        if mask_src:
-                            mask = mask_src.read(1, window=read_window)
-                        else:
-                            mask = None
-                        full_result = do_fillnodata(intensity, mask, distance, iterations, nodata)
-                        result = rt.trim(full_result, rt.margins(read_window, write_window))
-                        dst.write(result.astype(profile['dtype']), 1, window=write_window)
-                        bar.update(result.size)
-            else:
-                click.echo((msg.STARTING).format(command, msg.CONCURRENT))
-
-                def jobs():
-                    for (read_window, write_window) in zip(read_windows, write_windows):
-                        intensity = src.read(1, window=read_window)
-                        if mask_src:
-                            mask = mask_src.read(1, window=read_window)
-                        else:
-                            mask = None
-                        yield intensity, mask, read_window, write_window
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor, \
-                        click.progressbar(length=src.width*src.height, label="Blocks done:") as bar:
-
-                    future_to_window = {
-                        executor.submit(
-                            do_fillnodata, intensity, mask, distance, iterations, nodata
-                        ): (read_window, write_window)
-                        for (intensity, mask, read_window, write_window) in jobs()
-                    }
-
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        read_window, write_window = future_to_window[future]
-                        full_result = future.result()
-                        result = rt.trim(full_result, rt.margins(read_window, write_window))
-                        dst.write(result.astype(profile['dtype']), 1, window=write_window)
-                        bar.update(result.size)
+        kernel = partial(
+            do_fillnodata,
+            max_search_distance=distance,
+            smoothing_iterations=iterations,
+            nodata=nodata)
+
+        engine.run(
+            [src, mask_src] if mask_src else [src], kernel, profile, output,
+            engine.RunOptions(verbose=verbose, **run_options),
+            command=click.get_current_context().info_name,
+            overlap=ceil(distance),
+            temporaries=TEMPORARIES,
+            nan_nodata=False,
+            echo=click.echo,
+            progressbar=click.progressbar)
+
         if mask_src:
             mask_src.close()
-    click.echo((msg.WRITEOUT).format(output))
-    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
@@ -11,13 +11,11 @@ import scipy
 
 import rio_terrain as rt
 import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine, regions
+from rio_terrain.cli import options
 from rio_terrain import __version__ as plugin_version
 
 
-BOX = np.ones((3, 3))
-CROSS = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
-
-
 @click.command('label', short_help="Label regions.")
 @click.argument('input', nargs=1, type=click.Path(exists=True))
 @click.argument('output', nargs=1, type=click.Path())
@@ -26,10 +24,17 @@ CROSS = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
 @click.option('--zeros/--no-zeros', is_flag=True,
               help='Use the raster nodata value or zeros for False condition.')
 @click.option('-j', '--njobs', type=int, default=0, help='Number of concurrent jobs to run.')
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
 @click.version_option(version=plugin_version, message='rio-terrain v%(version)s')
 @click.pass_context
-def label(ctx, input, output, diagonals, zeros, njobs, verbose):
+def label(
+    ctx, input, output, diagonals, zeros, njobs,
+    codec, codec_level, max_z_error, codec_threads, verbose
+):
     """Label regions in a raster.
 
     INPUT should be a single-band raster.
@@ -57,28 +62,23 @@ def label(ctx, input, output, diagonals, zeros, njobs, verbose):
             dtype=rasterio.int32,
             nodata=nodata,
             count=1,
-            compress='lzw',
             bigtiff='yes'
         )
-
-        if zeros:
-            false_val = 0
-        else:
-            false_val = nodata
+        engine.set_codec(
+            profile, codec or 'lzw', level=codec_level, max_z_error=max_z_error,
+            threads=codec_threads)
 
         if diagonals is True:
-            structure = BOX
+            structure = regions.BOX
         else:
-            structure = CROSS
+            structure = regions.CROSS
 
         with rasterio.open(output, 'w', **profile) as dst:
             if njobs == 0:
                 click.echo((msg.STARTING).format(command, msg.INMEMORY))
-                img = src.read(1)
-                labels, count = scipy.ndimage.label(img, structure=structure)
-                labels[img == nodata] = false_val
-                labels[labels == 0] = false_val
-                dst.write(labels.astype(profile['dtype']), 1)
+                labels, count = regions.label(
+                    src.read(1), nodata, diagonals=diagonals, zeros=zeros)
+                dst.write(labels, 1)
             elif njobs == 1:
                 click.echo((msg.STARTING).format(command, msg.SEQUENTIAL))
 
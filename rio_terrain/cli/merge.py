@@ -0,0 +1,51 @@
+"""Merge the fragments written by sharded runs."""
+
+import time
+import warnings
+
+import click
+import rasterio
+
+import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+from rio_terrain import __version__ as plugin_version
+
+
+@click.command('terrain-merge', short_help="Merge fragments written by sharded runs.")
+@click.argument('fragments', nargs=-1, required=True, type=click.Path(exists=True))
+@click.argument('output', nargs=1, type=click.Path())
+@click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
+@click.version_option(version=plugin_version, message='rio-terrain v%(version)s')
+@click.pass_context
+def merge(ctx, fragments, output, verbose):
+    """Merge raster fragments written by the shards of a run.
+
+    FRAGMENTS should be aligned rasters with the same data type and band count,
+    such as the outputs of a command run with --shard 0/4 through --shard 3/4.
+
+    \b
+    Example:
+    rio slope elevation.tif slope_0.tif --shard 0/2
+    rio slope elevation.tif slope_1.tif --shard 1/2
+    rio terrain-merge slope_0.tif slope_1.tif slope.tif
+
+    """
+    if verbose:
+        warnings.filterwarnings('default')
+    else:
+        warnings.filterwarnings('ignore')
+
+    t0 = time.time()
+    command = click.get_current_context().info_name
+
+    ncells = 0
+    for fragment in fragments:
+        with rasterio.open(fragment) as src:
+            ncells += src.width * src.height
+
+    click.echo((msg.STARTING).format(command, msg.FRAGMENTS))
+    with click.progressbar(length=ncells, label='Blocks done:') as bar:
+        engine.merge_fragments(list(fragments), output, bar=bar)
+
+    click.echo((msg.WRITEOUT).format(output))
+    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
@@ -0,0 +1,228 @@
+"""Options shared by the tiled commands."""
+
+import re
+from functools import wraps
+
+import click
+
+import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+
+
+class MemorySize(click.ParamType):
+    """Parse a memory size such as 512M or 2G into bytes"""
+
+    name = 'size'
+    units = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(value), re.IGNORECASE)
+        if match is None:
+            self.fail('{} is not a memory size such as 512M or 2G'.format(value), param, ctx)
+        number, unit = match.groups()
+        return int(float(number) * self.units[unit.upper()])
+
+
+class Shard(click.ParamType):
+    """Parse a shard INDEX/COUNT into a tuple of integers"""
+
+    name = 'index/count'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', str(value))
+        if match is None:
+            self.fail('{} is not a shard such as 0/4'.format(value), param, ctx)
+        index, count = int(match.group(1)), int(match.group(2))
+        if not 0 <= index < count:
+            self.fail('shard index {} is not in 0..{}'.format(index, count - 1), param, ctx)
+        return index, count
+
+
+class BlockSize(click.ParamType):
+    """Parse an output block size, a positive multiple of 16 cells"""
+
+    name = 'cells'
+
+    def convert(self, value, param, ctx):
+        try:
+            size = int(value)
+        except (TypeError, ValueError):
+            self.fail('{} is not a block size such as 256 or 512'.format(value), param, ctx)
+        if size <= 0 or size % 16:
+            self.fail('block size {} is not a positive multiple of 16'.format(size), param, ctx)
+        return size
+
+
+parallel_reads_opt = click.option(
+    '--parallel-reads/--no-parallel-reads', default=False,
+    help='Read tiles in the worker threads, each with its own dataset handle.')
+
+backend_opt = click.option(
+    '--backend', type=click.Choice(['thread', 'process', 'dask']), default='thread',
+    help='Run concurrent jobs in worker threads, worker processes or with dask map_overlap.')
+
+prefetch_opt = click.option(
+    '--prefetch', type=int, default=1,
+    help='Number of tiles to read ahead when running sequentially.')
+
+max_memory_opt = click.option(
+    '--max-memory', type=MemorySize(), default=None,
+    help='Size tiles to fit a memory budget such as 512M or 2G, overrides --blocks.')
+
+autotune_opt = click.option(
+    '--autotune', is_flag=True,
+    help='Choose --blocks and --njobs from a short probe run.')
+
+autotune_cache_opt = click.option(
+    '--autotune-cache/--no-autotune-cache', default=True,
+    help='Reuse and store autotuned choices per command and input layout.')
+
+def shard_opt(f):
+    """Add the --shard option, reporting more shards than rows of tiles as a usage error"""
+    @wraps(f)
+    def command(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except engine.ShardError as e:
+            raise click.BadParameter(str(e), param_hint="'--shard'")
+
+    return click.option(
+        '--shard', type=Shard(), default=None,
+        help='Process shard INDEX of COUNT, writing a fragment for terrain-merge.')(command)
+
+plan_only_opt = click.option(
+    '--plan-only', type=click.Path(), default=None,
+    help='Write the tasks of the run to a manifest for terrain-worker instead of running.')
+
+resume_opt = click.option(
+    '--resume/--no-resume', default=False,
+    help='Resume an interrupted run from the journal next to the output.')
+
+skip_empty_opt = click.option(
+    '--skip-empty/--no-skip-empty', default=False,
+    help='Scan block masks and skip reading and computing tiles with no valid cells.')
+
+order_opt = click.option(
+    '--order', type=click.Choice(['row', 'zorder', 'hilbert']), default='row',
+    help='Process tiles in row-major order or along a space-filling curve.')
+
+stream_opt = click.option(
+    '--stream/--no-stream', default=False,
+    help='Process full-width row bands, reading each input row once.')
+
+out_blocksize_opt = click.option(
+    '--out-blocksize', type=BlockSize(), default=None,
+    help='Output tile size, or rows per strip, in cells. Tiles are snapped to output blocks.')
+
+out_tiled_opt = click.option(
+    '--out-tiled/--out-striped', default=True,
+    help='Write the output in tiles or in full-width strips.')
+
+cog_opt = click.option(
+    '--cog/--no-cog', default=False,
+    help='Write a Cloud-Optimized GeoTIFF, building overviews as tiles are written.')
+
+def output_format_opt(f):
+    """Add the --format option, reporting GTiff options with zarr as a usage error"""
+    @wraps(f)
+    def command(*args, **kwargs):
+        if kwargs.get('output_format') == 'zarr':
+            if kwargs.get('cog'):
+                raise click.UsageError(msg.ZARRCOG)
+            if kwargs.get('mask_band'):
+                raise click.UsageError(msg.ZARRMASK)
+        return f(*args, **kwargs)
+
+    return click.option(
+        '--format', 'output_format', type=click.Choice(['gtiff', 'zarr']), default='gtiff',
+        help='Write a GTiff, or a Zarr store with a chunk per tile written concurrently.'
+    )(command)
+
+to_gtiff_opt = click.option(
+    '--to-gtiff', type=click.Path(), default=None,
+    help='Convert a Zarr output to a GTiff at this path once it is written.')
+
+def tile_outputs_opt(f):
+    """Add the --tile-outputs option, reporting it with --cog or --format zarr as a usage error"""
+    @wraps(f)
+    def command(*args, **kwargs):
+        if kwargs.get('tile_outputs') is not None and (
+                kwargs.get('cog') or kwargs.get('output_format', 'gtiff') != 'gtiff'):
+            raise click.UsageError(msg.TILEOUTPUTS)
+        return f(*args, **kwargs)
+
+    return click.option(
+        '--tile-outputs', type=click.Path(file_okay=False), default=None,
+        help='Write each tile to its own GTiff in this directory, and OUTPUT as a VRT mosaic of them.'
+    )(command)
+
+def codec_opt(f):
+    """Add the --codec option, reporting compression options it does not take as a usage error"""
+    @wraps(f)
+    def command(*args, **kwargs):
+        # the default codec of a command is only checked once the run sets it
+        if kwargs.get('codec') is not None:
+            try:
+                engine.check_codec(
+                    kwargs['codec'], level=kwargs.get('codec_level'),
+                    max_z_error=kwargs.get('max_z_error'))
+            except engine.CodecError as e:
+                raise click.UsageError(str(e))
+        try:
+            return f(*args, **kwargs)
+        except engine.CodecError as e:
+            raise click.UsageError(str(e))
+
+    return click.option(
+        '--codec',
+        type=click.Choice(['deflate', 'zstd', 'lzw', 'lerc', 'lerc_deflate', 'lerc_zstd', 'none']),
+        default=None,
+        help='Output compression, defaults to deflate for continuous and lzw for categorical outputs.'
+    )(command)
+
+codec_level_opt = click.option(
+    '--codec-level', type=int, default=None,
+    help='Compression level of deflate, zstd, lerc_deflate and lerc_zstd.')
+
+max_z_error_opt = click.option(
+    '--max-z-error', type=click.FloatRange(min=0), default=None,
+    help='Maximum error of the lerc codecs in output units, lossless by default.')
+
+codec_threads_opt = click.option(
+    '--codec-threads', type=click.IntRange(min=0), default=None,
+    help='Threads compressing output blocks, 0 for all CPUs.')
+
+quantize_opt = click.option(
+    '--quantize', type=click.Choice(['int16', 'uint16']), default=None,
+    help='Pack results into integers, writing --scale and --offset for readers to unpack them.')
+
+def nonzero(ctx, param, value):
+    """Reject a zero value of an option"""
+    if value == 0:
+        raise click.BadParameter('must not be zero')
+    return value
+
+
+scale_opt = click.option(
+    '--scale', type=float, default=1.0, callback=nonzero,
+    help='Value of a step of quantized integers, such as 0.01.')
+
+offset_opt = click.option(
+    '--offset', type=float, default=0.0,
+    help='Value of a quantized zero.')
+
+mask_band_opt = click.option(
+    '--mask-band/--no-mask-band', default=False,
+    help='Also write the valid cells to an internal 1-bit mask band.')
+
+mosaic_opt = click.option(
+    '--mosaic/--no-mosaic', 'as_mosaic', default=False,
+    help='Read INPUT, a VRT, a directory of GeoTIFFs or a text file of paths, as a mosaic of its sources.')
+
+max_open_opt = click.option(
+    '--max-open', type=click.IntRange(min=1), default=64,
+    help='Source files a --mosaic input keeps open per reader.')
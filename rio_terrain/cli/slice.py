@@ -1,16 +1,15 @@
 """Extract regions from a raster by a data range."""
 
-import time
 import warnings
-import concurrent.futures
+from functools import partial
 from typing import Union
 
 import click
 import numpy as np
 import rasterio
 
-import rio_terrain as rt
-import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+from rio_terrain.cli import options
 from rio_terrain import __version__ as plugin_version
 
 
@@ -58,10 +57,39 @@ def do_slice(
 @click.option('--zeros/--no-zeros', is_flag=True,
               help='Use the raster nodata value or zeros for False condition.')
 @click.option('-j', '--njobs', type=int, default=1, help='Number of concurrent jobs to run.')
+@options.parallel_reads_opt
+@options.backend_opt
+@options.prefetch_opt
+@options.shard_opt
+@options.plan_only_opt
+@options.resume_opt
+@options.skip_empty_opt
+@options.order_opt
+@options.out_tiled_opt
+@options.out_blocksize_opt
+@options.cog_opt
+@options.output_format_opt
+@options.to_gtiff_opt
+@options.tile_outputs_opt
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
+@options.mask_band_opt
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
 @click.version_option(version=plugin_version, message='rio-terrain v%(version)s')
 @click.pass_context
-def slice(ctx, input, output, minimum, maximum, keep_data, zeros, njobs, verbose):
+def slice(
+    ctx,
+    input,
+    output,
+    minimum,
+    maximum,
+    keep_data,
+    zeros,
+    verbose,
+    **run_options
+):
     """Extract regions from a raster by a data range.
 
     INPUT should be a single-band raster.
@@ -80,79 +108,32 @@ def slice(ctx, input, output, minimum, maximum, keep_data, zeros, njobs, verbose
     else:
         warnings.filterwarnings('ignore')
 
-    t0 = time.time()
-    command = click.get_current_context().info_name
-
     with rasterio.open(input) as src:
 
         profile = src.profile
-        affine = src.transform
 
         if keep_data:
             dtype = profile['dtype']
             nodata = profile['nodata']
-            profile.update(count=1, compress='lzw', bigtiff='yes')
+            profile.update(count=1, bigtiff='yes')
         else:
             dtype = rasterio.int32
             nodata = np.iinfo(np.int32).min
-            profile.update(dtype=dtype, nodata=nodata, count=1, compress='lzw', bigtiff='yes')
+            profile.update(dtype=dtype, nodata=nodata, count=1, bigtiff='yes')
 
         if zeros:
             false_val = 0
         else:
             false_val = nodata
 
-        if njobs == 0:
-            w, s, e, n = src.bounds
-            full_window = rasterio.windows.from_bounds(w, s, e, n, transform=src.transform)
-            read_windows = [full_window]
-            write_windows = [full_window]
-        else:
-            if src.is_tiled:
-                blockshape = (list(src.block_shapes))[0]
-                if (blockshape[0] == 1) or (blockshape[1] == 1):
-                    warnings.warn((msg.STRIPED).format(blockshape))
-            else:
-                blockshape = [128, 128]
-                warnings.warn((msg.NOTILING).format(src.shape))
-            windows = rt.tile_grid(
-                src.width, src.height, blockshape[0], blockshape[1], overlap=0)
-
-        with rasterio.open(output, 'w', **profile) as dst:
-            if njobs == 0 or njobs == 1:
-                if njobs == 0:
-                    click.echo((msg.STARTING).format(command, msg.INMEMORY))
-                else:
-                    click.echo((msg.STARTING).format(command, msg.SEQUENTIAL))
-                with click.progressbar(length=src.width * src.height, label='Blocks done:') as bar:
-                    for window in windows:
-                        img = src.read(1, window=window)
-                        result = do_slice(img, minimum, maximum, keep_data, false_val)
-                        dst.write(result.astype(profile['dtype']), 1, window=window)
-                        bar.update(result.size)
-            else:
-                click.echo((msg.STARTING).format(command, msg.CONCURRENT))
-
-                def jobs():
-                    for window in windows:
-                        img = src.read(1, window=window)
-                        yield img, window
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor, \
-                        click.progressbar(length=src.width*src.height, label='Blocks done:') as bar:
-
-                    future_to_window = {
-                        executor.submit(
-                            do_slice, img, minimum, maximum, keep_data, false_val
-                        ): (window)
-                        for (img, window) in jobs()
-                    }
-
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        window = future_to_window[future]
-                        result = future.result()
-                        dst.write(result.astype(profile['dtype']), 1, window=window)
-                        bar.update(result.size)
-
-    click.echo((msg.WRITEOUT).format(output))
-    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
+        kernel = partial(
+            do_slice, minimum=minimum, maximum=maximum, keep_data=keep_data, false_val=false_val)
+
+        engine.run(
+            [src], kernel, profile, output,
+            engine.RunOptions(verbose=verbose, **run_options),
+            command=click.get_current_context().info_name,
+            nan_nodata=False,
+            codec='lzw',
+            echo=click.echo,
+            progressbar=click.progressbar)
@@ -17,6 +17,8 @@ from shapely.geometry import shape, Polygon
 
 import rio_terrain as rt
 import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine
+from rio_terrain.cli import options
 
 from rio_terrain import __version__ as plugin_version
 
@@ -56,10 +58,17 @@ def to_raster(
 @click.option('--prefix', nargs=1, type=str, default='zone_')
 @click.option('--zone-field', nargs=1, type=str, default=None)
 @click.option('--buffer-distance', nargs=1, type=float, default=0.0)
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
 @click.version_option(version=plugin_version, message='rio-channel v%(version)s')
 @click.pass_context
-def subdivide(ctx, input, zones_f, outdir, prefix, zone_field, buffer_distance, verbose):
+def subdivide(
+    ctx, input, zones_f, outdir, prefix, zone_field, buffer_distance,
+    codec, codec_level, max_z_error, codec_threads, verbose
+):
     """Extract separate raster files by zone polygon from a single raster.
 
     \b
@@ -135,9 +144,10 @@ def subdivide(ctx, input, zones_f, outdir, prefix, zone_field, buffer_distance,
                 height=nrows,
                 width=ncols,
                 transform=affine,
-                compress='deflate',
-                predictor=3,
                 bigtiff='yes')
+            engine.set_codec(
+                profile, codec or 'deflate', level=codec_level, max_z_error=max_z_error,
+                threads=codec_threads)
 
             # write the zone to its own file
             if zone_field:
@@ -1,9 +1,7 @@
 """Threshold a raster with an uncertainty raster."""
 
-import time
 import warnings
-import concurrent.futures
-from typing import Union
+from functools import partial
 
 import click
 import numpy as np
@@ -11,43 +9,48 @@ import rasterio
 
 import rio_terrain as rt
 import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine, regions
+from rio_terrain.cli import options
 from rio_terrain import __version__ as plugin_version
 
 
-def do_threshold(
-    img0: np.ndarray,
-    img1: np.ndarray,
-    level: Union[int, float],
-    default: Union[int, float] = 0
-) -> np.ndarray:
-    """Threshold an image based on another image
-
-    Parameters:
-        img0:
-        img1:
-        level:
-        default:
-
-    Returns:
-        data from img0 after thresholding
-
-    """
-    conditions = [img0 >= img1 * level, img0 <= -img1 * level]
-    choices = [1, -1]
-    result = np.select(conditions, choices, default=default)
-    return result
-
-
 @click.command('threshold', short_help="Threshold an intensity raster with an uncertainty raster.")
 @click.argument('input', nargs=1, type=click.Path(exists=True))
 @click.argument('uncertainty', nargs=1, type=click.Path(exists=True))
 @click.argument('output', nargs=1, type=click.Path())
 @click.argument('level', nargs=1, type=float)
 @click.option('-j', '--njobs', type=int, default=1, help='Number of concurrent jobs to run.')
+@options.parallel_reads_opt
+@options.backend_opt
+@options.prefetch_opt
+@options.shard_opt
+@options.plan_only_opt
+@options.resume_opt
+@options.skip_empty_opt
+@options.order_opt
+@options.out_tiled_opt
+@options.out_blocksize_opt
+@options.cog_opt
+@options.output_format_opt
+@options.to_gtiff_opt
+@options.tile_outputs_opt
+@options.codec_opt
+@options.codec_level_opt
+@options.max_z_error_opt
+@options.codec_threads_opt
+@options.mask_band_opt
 @click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
 @click.version_option(version=plugin_version, message='rio-terrain v%(version)s')
 @click.pass_context
-def threshold(ctx, input, uncertainty, output, level, njobs, verbose):
+def threshold(
+    ctx,
+    input,
+    uncertainty,
+    output,
+    level,
+    verbose,
+    **run_options
+):
     """Threshold an intensity raster with an uncertainty raster.
 
     \b
@@ -64,81 +67,28 @@ def threshold(ctx, input, uncertainty, output, level, njobs, verbose):
     else:
         warnings.filterwarnings('ignore')
 
-    t0 = time.time()
-    command = click.get_current_context().info_name
-
     with rasterio.open(input) as src0, rasterio.open(uncertainty) as src1:
 
-        if not rt.is_raster_intersecting(src0, src1):
-            raise ValueError(msg.NONINTERSECTING)
         if not rt.is_raster_aligned(src0, src1):
             raise ValueError(msg.NONALIGNED)
 
         profile = src0.profile
-        affine = src0.transform
         nodata = np.iinfo(np.int32).min
-
-        if njobs == 0:
-            blockxsize = None
-            blockysize = None
-        else:
-            block_shape = (src0.block_shapes)[0]
-            blockxsize = block_shape[1]
-            blockysize = block_shape[0]
-
-        tiles = rt.tile_grid_intersection(
-            src0, src1, blockxsize=blockxsize, blockysize=blockysize
-        )
-        windows0, windows1, write_windows, affine, nrows, ncols = tiles
-
         profile.update(
             dtype=rasterio.int32,
             nodata=nodata,
             count=1,
-            height=nrows,
-            width=ncols,
-            transform=affine,
-            compress='lzw',
             bigtiff='yes',
         )
 
-        with rasterio.open(output, 'w', **profile) as dst:
-            if njobs == 0 or njobs == 1:
-                if njobs == 0:
-                    click.echo((msg.STARTING).format(command, msg.INMEMORY))
-                else:
-                    click.echo((msg.STARTING).format(command, msg.SEQUENTIAL))
-                with click.progressbar(length=nrows * ncols, label='Blocks done:') as bar:
-                    for (window0, window1, write_window) in zip(windows0, windows1, write_windows):
-                        img0 = src0.read(1, window=window0)
-                        img1 = src1.read(1, window=window1)
-                        result = do_threshold(img0, img1, level, default=nodata)
-                        dst.write(result, 1, window=write_window)
-                        bar.update(result.size)
-            else:
-                click.echo((msg.STARTING).format(command, msg.CONCURRENT))
-
-                def jobs():
-                    for (window0, window1, write_window) in zip(windows0, windows1, write_windows):
-                        img0 = src0.read(1, window=window0)
-                        img1 = src1.read(1, window=window1)
-                        yield img0, img1, window0, window1, write_window
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor, \
-                        click.progressbar(length=nrows * ncols, label='Blocks done:') as bar:
-
-                    future_to_window = {
-                        executor.submit(
-                            do_threshold, img0, img1, level, default=nodata
-                        ): (window0, window1, write_window)
-                        for (img0, img1, window0, window1, write_window) in jobs()
-                    }
-
-                    for future in concurrent.futures.as_completed(future_to_window):
-                        window0, window1, write_window = future_to_window[future]
-                        result = future.result()
-                        dst.write(result, 1, window=write_window)
-                        bar.update(result.size)
-
-    click.echo((msg.WRITEOUT).format(output))
-    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
+        kernel = partial(regions.threshold, level=level, default=nodata)
+
+        engine.run(
+            [src0, src1], kernel, profile, output,
+            engine.RunOptions(verbose=verbose, **run_options),
+            command=click.get_current_context().info_name,
+            nan_nodata=False,
+            intersect=True,
+            codec='lzw',
+            echo=click.echo,
+            progressbar=click.progressbar)
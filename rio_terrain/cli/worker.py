@@ -0,0 +1,67 @@
+"""Run the tasks of a manifest written with --plan-only."""
+
+import time
+import warnings
+
+import click
+
+import rio_terrain.tools.messages as msg
+from rio_terrain.core import manifest
+from rio_terrain import __version__ as plugin_version
+
+
+@click.command('terrain-worker', short_help="Run tasks from a manifest.")
+@click.argument('manifest_f', metavar='MANIFEST', nargs=1, type=click.Path(exists=True))
+@click.option('--tasks', 'tasks', default=None,
+              help='Tasks to run such as 100-199 or 0-9,20, defaults to all tasks.')
+@click.option('-j', '--njobs', type=int, default=1, help='Number of local worker processes.')
+@click.option('--merge/--no-merge', default=False,
+              help='Merge the task fragments into the output once all tasks have completed.')
+@click.option('-v', '--verbose', is_flag=True, help='Enables verbose mode.')
+@click.version_option(version=plugin_version, message='rio-terrain v%(version)s')
+@click.pass_context
+def worker(ctx, manifest_f, tasks, njobs, merge, verbose):
+    """Run tasks from a MANIFEST written by a command with --plan-only.
+
+    Each task writes a fragment to the directory named by the manifest, so
+    tasks may run in any order, on any machine sharing the filesystem, and
+    be retried. Once every task has run, --merge stitches the fragments
+    into the output.
+
+    \b
+    Example:
+    rio slope elevation.tif slope.tif --plan-only slope.json
+    rio terrain-worker slope.json --tasks 0-99
+    rio terrain-worker slope.json --tasks 100-199
+    rio terrain-worker slope.json --tasks 200-299 --merge
+
+    \b
+    Run every task in four local processes and merge:
+    rio terrain-worker slope.json -j 4 --merge
+
+    """
+    if verbose:
+        warnings.filterwarnings('default')
+    else:
+        warnings.filterwarnings('ignore')
+
+    t0 = time.time()
+    command = click.get_current_context().info_name
+
+    plan = manifest.read_manifest(manifest_f)
+    try:
+        task_ids = manifest.parse_tasks(tasks, len(plan['tasks']))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--tasks')
+
+    click.echo((msg.STARTING).format(command, msg.TASKS.format(len(task_ids), plan['command'])))
+    with click.progressbar(length=len(task_ids), label='Tasks done:') as bar:
+        manifest.run_local(manifest_f, task_ids, njobs=njobs, bar=bar)
+
+    if merge:
+        ncells = sum(task['write'][2] * task['write'][3] for task in plan['tasks'])
+        with click.progressbar(length=ncells, label='Blocks merged:') as bar:
+            manifest.merge_tasks(plan, bar=bar)
+        click.echo((msg.WRITEOUT).format(plan['output']))
+
+    click.echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
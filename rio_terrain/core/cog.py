@@ -0,0 +1,243 @@
+"""Cloud-Optimized GeoTIFF output with overviews built while tiles are written."""
+from __future__ import annotations
+
+import os
+import shutil
+import warnings
+import xml.etree.ElementTree as ET
+from math import ceil
+from typing import Any, Optional
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.windows import Window
+
+
+def staging_dir(output: str) -> str:
+    """Return the directory holding the full-resolution raster and overviews of a COG
+
+    Parameters:
+        output: COG output path
+
+    Returns:
+        staging directory path
+
+    """
+    return output + '.cog'
+
+
+def overview_factors(width: int, height: int, blocksize: int = 512) -> list[int]:
+    """Decimation factors of the overviews of a raster
+
+    Factors double until the overview fits in a single block, as the GDAL
+    COG driver does.
+
+    Parameters:
+        width: raster width in columns
+        height: raster height in rows
+        blocksize: output block size
+
+    Returns:
+        decimation factors
+
+    """
+    factors = []
+    factor = 2
+    while max(ceil(width / (factor // 2)), ceil(height / (factor // 2))) > blocksize:
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+def decimate(
+    arr: np.ndarray,
+    factor: int,
+    average: bool = True,
+    nodata: Optional[float] = None
+) -> np.ndarray:
+    """Decimate an array by an integer factor
+
+    Parameters:
+        arr: array to decimate
+        factor: decimation factor
+        average: average valid cells, otherwise keep the upper left cell
+        nodata: value of cells to ignore when averaging, nan cells are always ignored
+
+    Returns:
+        decimated array, partial cells at the lower and right edges are kept
+
+    """
+    if not average:
+        return arr[::factor, ::factor]
+
+    rows, cols = ceil(arr.shape[0] / factor), ceil(arr.shape[1] / factor)
+    if arr.shape == (rows * factor, cols * factor) and nodata is None and arr.dtype.kind == 'f':
+        padded = arr
+    else:
+        dtype = np.result_type(arr.dtype, np.float32)
+        padded = np.full((rows * factor, cols * factor), np.nan, dtype=dtype)
+        padded[:arr.shape[0], :arr.shape[1]] = arr
+        if nodata is not None:
+            padded[padded == nodata] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        out = np.nanmean(padded.reshape(rows, factor, cols, factor), axis=(1, 3))
+    if nodata is not None:
+        out[np.isnan(out)] = nodata
+
+    return out
+
+
+def _aligned(window: Window, factor: int, width: int, height: int) -> bool:
+    """Whether a window covers whole cells of an overview"""
+    return (
+        window.col_off % factor == 0 and window.row_off % factor == 0
+        and (window.width % factor == 0 or window.col_off + window.width == width)
+        and (window.height % factor == 0 or window.row_off + window.height == height))
+
+
+class OverviewWriter:
+    """Accumulate overviews of an output as its tiles are written
+
+    Each tile is decimated into every overview whose cells it covers
+    whole, so those overviews are complete once the last tile is written.
+    Coarser overviews, whose cells span several tiles, are decimated from
+    the finest complete overview by finish. Floating point outputs are
+    averaged, ignoring nan, and other types are sampled.
+
+    Parameters:
+        staging: staging directory, see staging_dir
+        profile: profile of the full-resolution output
+        resume: open the overviews of an interrupted run, finish then decimates them all
+
+    """
+
+    def __init__(self, staging: str, profile: dict, resume: bool = False) -> None:
+        self.staging = staging
+        self.width = profile['width']
+        self.height = profile['height']
+        self.average = np.dtype(profile['dtype']).kind == 'f'
+        self.nodata = profile.get('nodata')
+        self.factors = overview_factors(self.width, self.height, profile.get('blockxsize', 512))
+        # overviews of a resumed run may lack the tiles written before it was interrupted
+        self._streamed = set() if resume else set(self.factors)
+        self._profile = profile
+        self._datasets: dict[int, Any] = {}
+        os.makedirs(staging, exist_ok=True)
+        self.open(resume)
+
+    def path(self, factor: int) -> str:
+        return os.path.join(self.staging, 'overview-{}.tif'.format(factor))
+
+    def open(self, update: bool = True) -> None:
+        """Open the overview datasets, in update mode or creating them"""
+        for factor in self.factors:
+            if update:
+                self._datasets[factor] = rasterio.open(self.path(factor), 'r+')
+                continue
+            profile = dict(
+                self._profile,
+                width=ceil(self.width / factor),
+                height=ceil(self.height / factor),
+                transform=self._profile['transform'] * rasterio.Affine.scale(factor))
+            self._datasets[factor] = rasterio.open(self.path(factor), 'w', **profile)
+
+    def close(self) -> None:
+        """Close the overview datasets, flushing them to disk"""
+        for dst in self._datasets.values():
+            dst.close()
+        self._datasets = {}
+
+    def __call__(self, result: np.ndarray, window: Window) -> None:
+        out = result
+        for factor in self.factors:
+            if factor not in self._streamed:
+                break
+            if not _aligned(window, factor, self.width, self.height):
+                # this and coarser overviews are decimated by finish instead
+                self._streamed -= {f for f in self.factors if f >= factor}
+                break
+            # each overview is decimated from the previous one
+            out = decimate(out, 2, self.average, self.nodata)
+            dst = self._datasets[factor]
+            dst.write(
+                out.astype(dst.dtypes[0], copy=False), 1,
+                window=Window(window.col_off // factor, window.row_off // factor, *out.shape[::-1]))
+
+    def finish(self, source: str) -> None:
+        """Decimate the overviews that were not complete from the finest one that is
+
+        Parameters:
+            source: path of the full-resolution raster
+
+        """
+        self.close()
+        previous, previous_factor = source, 1
+        for factor in self.factors:
+            if factor in self._streamed:
+                previous, previous_factor = self.path(factor), factor
+                continue
+            step = factor // previous_factor
+            with rasterio.open(previous) as src, rasterio.open(self.path(factor), 'r+') as dst:
+                rows = step * max(1, 4096 // step)
+                for row in range(0, src.height, rows):
+                    window = Window(0, row, src.width, min(rows, src.height - row))
+                    out = decimate(src.read(1, window=window), step, self.average, self.nodata)
+                    dst.write(
+                        out.astype(dst.dtypes[0], copy=False), 1,
+                        window=Window(0, row // step, *out.shape[::-1]))
+            previous, previous_factor = self.path(factor), factor
+
+
+COG_PREDICTORS = {1: 'NO', 2: 'STANDARD', 3: 'FLOATING_POINT'}
+
+
+def write_cog(staging: str, source: str, output: str, profile: dict, factors: list[int]) -> None:
+    """Lay out a COG from a full-resolution raster and its overviews
+
+    A VRT attaches the overviews to the full-resolution raster, and the
+    GDAL COG driver copies both into the output with the image file
+    directories ahead of the tile data.
+
+    Parameters:
+        staging: staging directory holding the overviews
+        source: path of the full-resolution raster
+        output: COG output path
+        profile: output profile, supplying the compression and block size
+        factors: decimation factors of the overviews
+
+    """
+    vrt = os.path.join(staging, 'source.vrt')
+    rasterio.shutil.copy(source, vrt, driver='VRT')
+    tree = ET.parse(vrt)
+    band = tree.getroot().find('VRTRasterBand')
+    for factor in factors:
+        overview = ET.SubElement(band, 'Overview')
+        filename = ET.SubElement(overview, 'SourceFilename', relativeToVRT='1')
+        filename.text = 'overview-{}.tif'.format(factor)
+        ET.SubElement(overview, 'SourceBand').text = '1'
+    tree.write(vrt)
+
+    options = {
+        'compress': profile.get('compress', 'deflate'),
+        'blocksize': profile.get('blockxsize', 512) if profile.get('tiled') else 512,
+        'overviews': 'FORCE_USE_EXISTING',
+        'bigtiff': 'IF_SAFER',
+        'num_threads': profile.get('num_threads', 'ALL_CPUS'),
+    }
+    # the COG driver names the predictor and the codec level differently from GTiff
+    if profile.get('predictor'):
+        options['predictor'] = COG_PREDICTORS.get(profile['predictor'], 'YES')
+    level = profile.get('zlevel', profile.get('zstd_level'))
+    if level is not None:
+        options['level'] = level
+    if profile.get('max_z_error') is not None:
+        options['max_z_error'] = profile['max_z_error']
+    rasterio.shutil.copy(vrt, output, driver='COG', **options)
+
+
+def remove_staging(staging: str) -> None:
+    """Remove the staging directory of a COG"""
+    shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,2232 @@
+"""Bounded-queue block processing engine shared by the tiled commands."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import warnings
+import concurrent.futures
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from functools import partial
+from math import ceil
+from multiprocessing import shared_memory
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, union
+
+import rio_terrain.tools.messages as msg
+from rio_terrain.tools.numbers import valid_mask
+from rio_terrain.core.cog import OverviewWriter, staging_dir, write_cog, remove_staging
+from rio_terrain.core.tilefiles import TileWriter
+from rio_terrain.core.zarrstore import ZarrWriter, to_gtiff
+from rio_terrain.core.windowing import (
+    tile_grid, tile_grid_intersection, fit_blocks, margins, trim, is_raster_aligned,
+    is_raster_intersecting)
+
+
+ReadWindow = Union[Window, Tuple[Window, ...]]
+Reader = Callable[[ReadWindow], Tuple[np.ndarray, ...]]
+Kernel = Callable[..., np.ndarray]
+Writer = Callable[[np.ndarray, Window], None]
+
+
+def _curve_index(order: str, row: int, col: int, bits: int) -> int:
+    """Distance of a cell along a Z-order or Hilbert curve over 2**bits cells"""
+    if order == 'zorder':
+        index = 0
+        for bit in range(bits):
+            index |= ((col >> bit) & 1) << (2 * bit) | ((row >> bit) & 1) << (2 * bit + 1)
+        return index
+
+    index = 0
+    side = 1 << bits
+    s = side >> 1
+    while s > 0:
+        rx = 1 if col & s else 0
+        ry = 1 if row & s else 0
+        index += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                col = side - 1 - col
+                row = side - 1 - row
+            col, row = row, col
+        s >>= 1
+    return index
+
+
+def order_tiles(
+    read_windows: Iterable[ReadWindow],
+    write_windows: Iterable[Window],
+    order: str = 'row'
+) -> tuple[list[ReadWindow], list[Window]]:
+    """Order tiles along a space-filling curve
+
+    Row-major order reads the halo of a tile from blocks decoded a whole
+    row of tiles earlier. Along a Z-order or Hilbert curve the neighbours
+    of a tile were mostly visited recently, so halo reads are more likely
+    to find their blocks in the GDAL block cache. Write results with an
+    OrderedWriter with in_order=False so tiles are not held for their row.
+
+    Parameters:
+        read_windows: read windows, or tuples of read windows for multiple sources
+        write_windows: write windows paired with the read windows
+        order: 'row', 'zorder' or 'hilbert'
+
+    Returns:
+        read windows, write windows in the order to process them
+
+    """
+    tiles = list(zip(read_windows, write_windows))
+    if order != 'row' and tiles:
+        rows = {row: i for i, row in enumerate(sorted({ww.row_off for _, ww in tiles}))}
+        cols = {col: j for j, col in enumerate(sorted({ww.col_off for _, ww in tiles}))}
+        bits = (max(len(rows), len(cols)) - 1).bit_length()
+        tiles.sort(key=lambda tile: _curve_index(
+            order, rows[tile[1].row_off], cols[tile[1].col_off], bits))
+
+    return [rw for rw, _ in tiles], [ww for _, ww in tiles]
+
+
+# GDAL's block cache size when the physical memory is unknown
+GDAL_CACHE_DEFAULT = 40 * 2**20
+
+
+def _physical_memory() -> Optional[int]:
+    """Physical memory in bytes, None where os.sysconf cannot report it, as on Windows"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _gdal_cache_bytes() -> int:
+    """Size of the GDAL block cache, from GDAL_CACHEMAX or GDAL's default"""
+    try:
+        value = rasterio.env.getenv().get('GDAL_CACHEMAX')
+    except rasterio.errors.EnvError:
+        value = None
+    value = value or os.environ.get('GDAL_CACHEMAX')
+    physical = _physical_memory()
+    if value is None:
+        return GDAL_CACHE_DEFAULT if physical is None else physical // 20
+    value = str(value).strip()
+    if value.endswith('%'):
+        if physical is None:
+            return GDAL_CACHE_DEFAULT
+        return int(physical * float(value[:-1]) / 100)
+    value = int(value)
+    return value * 2**20 if value < 100000 else value
+
+
+class ReadStats:
+    """Count cells read and model block decodes through the GDAL block cache
+
+    Read amplification is the ratio of cells read to cells in the sources.
+    Blocks are decoded when a read misses a least-recently-used cache the
+    size of the GDAL block cache, so the decode ratio estimates how often
+    blocks are decompressed more than once.
+
+    Parameters:
+        cache_bytes: block cache size, defaults to the GDAL block cache size
+
+    """
+
+    def __init__(self, cache_bytes: Optional[int] = None) -> None:
+        self.cache_bytes = _gdal_cache_bytes() if cache_bytes is None else cache_bytes
+        self.cells = 0
+        self.decodes = 0
+        self._cached: OrderedDict[tuple, int] = OrderedDict()
+        self._cached_bytes = 0
+        self._blocks: set[tuple] = set()
+        self._source_cells: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, src: rasterio.DatasetReader, band: int, window: Window) -> None:
+        """Count a read of a window from a band of a source"""
+        bh, bw = src.block_shapes[band - 1]
+        nbytes = bh * bw * np.dtype(src.dtypes[band - 1]).itemsize
+        rows = range(int(window.row_off) // bh, ceil((window.row_off + window.height) / bh))
+        cols = range(int(window.col_off) // bw, ceil((window.col_off + window.width) / bw))
+        with self._lock:
+            self.cells += int(window.width * window.height)
+            self._source_cells[src.name] = src.width * src.height
+            for i in rows:
+                for j in cols:
+                    key = (src.name, band, i, j)
+                    self._blocks.add(key)
+                    if key in self._cached:
+                        self._cached.move_to_end(key)
+                        continue
+                    self.decodes += 1
+                    self._cached[key] = nbytes
+                    self._cached_bytes += nbytes
+                    while self._cached_bytes > self.cache_bytes and self._cached:
+                        _, evicted = self._cached.popitem(last=False)
+                        self._cached_bytes -= evicted
+
+    def amplification(self) -> tuple[float, float]:
+        """Return cells read per source cell and decodes per block read"""
+        cells = sum(self._source_cells.values())
+        return (self.cells / max(cells, 1), self.decodes / max(len(self._blocks), 1))
+
+
+def tiles_in_flight(njobs: int, prefetch: int = 0, max_pending: Optional[int] = None) -> int:
+    """Number of tiles process_tiles holds in memory at once
+
+    Parameters:
+        njobs: number of workers
+        prefetch: tiles read ahead when running sequentially
+        max_pending: maximum tiles in flight with concurrent workers
+
+    Returns:
+        number of tiles
+
+    """
+    if njobs < 2:
+        return 1 + max(prefetch, 0)
+    if max_pending is None:
+        max_pending = 2 * njobs
+    return max_pending
+
+
+def output_blocks(
+    profile: dict,
+    tiled: bool = True,
+    blocksize: Optional[int] = None
+) -> tuple[int, int]:
+    """Set the block layout of an output profile
+
+    Without a blocksize, tiled outputs keep the tile shape inherited from
+    a tiled source or otherwise use 256x256 tiles, and striped outputs keep
+    the inherited rows per strip.
+
+    Parameters:
+        profile: output profile with its width set, updated in place
+        tiled: write tiles rather than full-width strips
+        blocksize: tile size, or rows per strip, in cells
+
+    Returns:
+        output block height and width
+
+    """
+    inherited = profile.get('tiled') and 'blockxsize' in profile
+    if tiled:
+        if blocksize is not None:
+            shape = (blocksize, blocksize)
+        elif inherited:
+            shape = (profile['blockysize'], profile['blockxsize'])
+        else:
+            shape = (256, 256)
+        profile.update(tiled=True, blockysize=shape[0], blockxsize=shape[1])
+    else:
+        rows = blocksize or (None if inherited else profile.get('blockysize')) or 16
+        shape = (rows, profile['width'])
+        profile.pop('blockxsize', None)
+        profile.update(tiled=False, blockysize=rows)
+
+    return shape
+
+
+# creation options set by set_codec, dropped when a codec is set or an output is staged
+CODEC_KEYS = ('compress', 'predictor', 'zlevel', 'zstd_level', 'max_z_error', 'num_threads')
+
+# creation option holding the level of each codec that has one
+CODEC_LEVELS = {
+    'deflate': 'zlevel',
+    'zstd': 'zstd_level',
+    'lerc_deflate': 'zlevel',
+    'lerc_zstd': 'zstd_level',
+}
+
+
+class CodecError(ValueError):
+    """A compression option was given for a codec that does not take it"""
+
+
+def check_codec(
+    codec: str,
+    level: Optional[int] = None,
+    max_z_error: Optional[float] = None
+) -> None:
+    """Check that a codec takes the compression options given for it
+
+    Parameters:
+        codec: deflate, zstd, lzw, lerc, lerc_deflate, lerc_zstd or none
+        level: compression level
+        max_z_error: maximum error of LERC codecs
+
+    Raises:
+        CodecError: the codec has no level or is not a LERC codec
+
+    """
+    if level is not None and codec not in CODEC_LEVELS:
+        raise CodecError((msg.CODECLEVEL).format(codec))
+    if max_z_error is not None and not codec.startswith('lerc'):
+        raise CodecError((msg.MAXZERROR).format(codec))
+
+
+def set_codec(
+    profile: dict,
+    codec: str = 'deflate',
+    level: Optional[int] = None,
+    max_z_error: Optional[float] = None,
+    threads: Optional[int] = None
+) -> dict:
+    """Set the compression of an output profile
+
+    Compression options inherited from the source are replaced. Floating
+    point outputs compressed with deflate or zstd use the floating point
+    predictor, and integer ones the horizontal predictor. The LERC codecs
+    are lossless unless max_z_error is set, in which case each cell is
+    kept within max_z_error of its value.
+
+    Parameters:
+        profile: output profile with its dtype set, updated in place
+        codec: deflate, zstd, lzw, lerc, lerc_deflate, lerc_zstd or none
+        level: compression level of deflate, zstd and the LERC variants using them
+        max_z_error: maximum error of LERC codecs, in the units of the output
+        threads: threads GDAL compresses blocks with, 0 for all CPUs
+
+    Returns:
+        profile
+
+    """
+    check_codec(codec, level=level, max_z_error=max_z_error)
+
+    for key in CODEC_KEYS:
+        profile.pop(key, None)
+    profile['compress'] = codec
+    if codec in ('deflate', 'zstd'):
+        profile['predictor'] = 3 if np.dtype(profile['dtype']).kind == 'f' else 2
+    if level is not None:
+        profile[CODEC_LEVELS[codec]] = level
+    if max_z_error is not None:
+        profile['max_z_error'] = max_z_error
+    if threads is not None and threads != 1:
+        profile['num_threads'] = threads or 'ALL_CPUS'
+
+    return profile
+
+
+# nodata of quantized outputs, outside the range values are packed into
+QUANTIZE_NODATA = {'int16': int(np.iinfo(np.int16).min), 'uint16': int(np.iinfo(np.uint16).max)}
+
+
+def quantize(
+    arr: np.ndarray,
+    dtype: str = 'int16',
+    scale: float = 1.0,
+    offset: float = 0.0,
+    missing: Optional[float] = None
+) -> np.ndarray:
+    """Pack values into integers so that value = packed * scale + offset
+
+    Values are rounded to the nearest step of scale and clipped to the
+    range of the type, less the nodata value of QUANTIZE_NODATA.
+
+    Parameters:
+        arr: values to pack
+        dtype: int16 or uint16
+        scale: value of a step of the packed integers
+        offset: value of a packed zero
+        missing: value of invalid cells besides nan
+
+    Returns:
+        packed array, invalid cells set to the nodata value of the type
+
+    Raises:
+        ValueError: scale is zero
+
+    """
+    if scale == 0:
+        raise ValueError(msg.ZEROSCALE)
+
+    info = np.iinfo(dtype)
+    nodata = QUANTIZE_NODATA[dtype]
+    packed = np.round((arr - offset) / scale)
+    invalid = np.isnan(packed)
+    if missing is not None and not np.isnan(missing):
+        invalid |= arr == missing
+    np.clip(packed, info.min + (nodata == info.min), info.max - (nodata == info.max), out=packed)
+    packed[invalid] = nodata
+
+    return packed.astype(dtype)
+
+
+def quantized(
+    *arrays: np.ndarray,
+    kernel: Kernel,
+    dtype: str = 'int16',
+    scale: float = 1.0,
+    offset: float = 0.0,
+    missing: Optional[float] = None
+) -> np.ndarray:
+    """Run a kernel and pack its result, see quantize_kernel"""
+    return quantize(kernel(*arrays), dtype, scale, offset, missing)
+
+
+def quantize_kernel(
+    kernel: Kernel,
+    profile: dict,
+    dtype: str = 'int16',
+    scale: float = 1.0,
+    offset: float = 0.0
+) -> Kernel:
+    """Pack the results of a kernel into integers in the workers
+
+    Sets the type and nodata value of the output profile. A floating point
+    predictor set by set_codec becomes the horizontal predictor. The scale
+    and offset are written to the output by open_output, so readers
+    applying them get back the values of the kernel.
+
+    Parameters:
+        kernel: kernel with a floating point result
+        profile: output profile, updated in place
+        dtype: int16 or uint16
+        scale: value of a step of the packed integers
+        offset: value of a packed zero
+
+    Returns:
+        kernel returning packed results
+
+    Raises:
+        ValueError: scale is zero
+
+    """
+    if scale == 0:
+        raise ValueError(msg.ZEROSCALE)
+
+    missing = profile.get('nodata')
+    profile.update(dtype=dtype, nodata=QUANTIZE_NODATA[dtype])
+    if profile.get('predictor') == 3:
+        profile['predictor'] = 2
+
+    return partial(
+        quantized, kernel=kernel, dtype=dtype, scale=scale, offset=offset, missing=missing)
+
+
+def snap_shape(shape: tuple[int, int], block_shape: Optional[tuple[int, int]]) -> tuple[int, int]:
+    """Round a tile shape up to whole blocks
+
+    Tiles of a grid starting at the origin then begin and end on block
+    boundaries, so each output block is written once, complete.
+
+    Parameters:
+        shape: tile height and width
+        block_shape: block height and width, or None to keep the shape
+
+    Returns:
+        tile height and width
+
+    """
+    if block_shape is None:
+        return shape
+
+    return (
+        ceil(shape[0] / block_shape[0]) * block_shape[0],
+        ceil(shape[1] / block_shape[1]) * block_shape[1])
+
+
+def is_striped(src: rasterio.DatasetReader) -> bool:
+    """Whether the internal blocks of a source are full-width strips
+
+    Parameters:
+        src: rasterio read source
+
+    Returns:
+        True when a block spans the width of the raster
+
+    """
+    return src.block_shapes[0][1] >= src.width
+
+
+def strip_rows(src: rasterio.DatasetReader, blocks: int = 1) -> int:
+    """Height of the row bands planned for a striped source
+
+    Bands hold about as many cells as a tile of blocks 128x128 blocks,
+    the tile shape used before striped sources were planned as bands,
+    rounded up to whole strips.
+
+    Parameters:
+        src: rasterio read source
+        blocks: multiple of a 128x128 block giving the cells per band
+
+    Returns:
+        band height in rows, a multiple of the rows per strip
+
+    """
+    rows_per_strip = src.block_shapes[0][0]
+    rows = ceil((128 * blocks) ** 2 / src.width)
+
+    return rows_per_strip * max(1, ceil(rows / rows_per_strip))
+
+
+def plan_tiles(
+    src: rasterio.DatasetReader,
+    blocks: int = 1,
+    overlap: int = 0,
+    whole: bool = False,
+    max_memory: Optional[int] = None,
+    temporaries: float = 1.0,
+    ntiles: int = 1,
+    out_blocks: Optional[tuple[int, int]] = None
+) -> tuple[list[Window], list[Window]]:
+    """Plan read and write windows from the internal blocks of a source
+
+    Striped sources are planned as full-width row bands whose height is
+    a multiple of the rows per strip, see strip_rows, so that no strip
+    is decoded for more than one band.
+
+    With max_memory the blocks multiple is instead sized so that ntiles
+    tiles, their halo and the float64 temporaries a kernel allocates for
+    each cell fit within the budget. Bands are then sized by their height
+    alone, see plan_bands.
+
+    Parameters:
+        src: rasterio read source
+        blocks: multiple of the internal block shape to use as the tile shape
+        overlap: read-window overlap in cells
+        whole: plan a single window covering the whole raster
+        max_memory: memory budget in bytes
+        temporaries: number of tile-sized float64 arrays the kernel allocates
+        ntiles: number of tiles held in memory at once, see tiles_in_flight
+        out_blocks: output block shape to snap the tiles to, see snap_shape
+
+    Returns:
+        read windows, write windows
+
+    """
+    if whole:
+        full_window = Window(0, 0, src.width, src.height)
+        return [full_window], [full_window]
+
+    blockshape = (list(src.block_shapes))[0]
+    if is_striped(src):
+        if max_memory is None:
+            rows = strip_rows(src, blocks)
+        else:
+            rows = None
+        return plan_bands(
+            src, overlap=overlap, rows=rows, max_memory=max_memory,
+            temporaries=temporaries, ntiles=ntiles, out_blocks=out_blocks)
+    if (blockshape[0] == 1) or (blockshape[1] == 1):
+        warnings.warn((msg.STRIPED).format(blockshape))
+
+    if max_memory is not None:
+        bytes_per_cell = np.dtype(src.dtypes[0]).itemsize + 8 * temporaries
+        limit = max(ceil(src.height / blockshape[0]), ceil(src.width / blockshape[1]))
+        blocks = fit_blocks(
+            blockshape, max_memory, bytes_per_cell, halo=overlap, ntiles=ntiles, limit=limit)
+
+    rows, cols = snap_shape((blockshape[0] * blocks, blockshape[1] * blocks), out_blocks)
+
+    read_windows = list(tile_grid(
+        src.width,
+        src.height,
+        cols,
+        rows,
+        overlap=overlap,
+    ))
+    write_windows = list(tile_grid(
+        src.width,
+        src.height,
+        cols,
+        rows,
+        overlap=0,
+    ))
+
+    return read_windows, write_windows
+
+
+def plan_bands(
+    src: rasterio.DatasetReader,
+    overlap: int = 0,
+    rows: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    temporaries: float = 1.0,
+    ntiles: int = 1,
+    out_blocks: Optional[tuple[int, int]] = None
+) -> tuple[list[Window], list[Window]]:
+    """Plan full-width row bands for streaming with a RowBandReader
+
+    Bands are a multiple of the block height, at least 256 rows unless
+    max_memory sizes them so that ntiles bands, their halo rows and the
+    float64 temporaries a kernel allocates for each cell fit within the
+    budget. Bands are never less than one block high.
+
+    Parameters:
+        src: rasterio read source
+        overlap: read-window overlap in rows
+        rows: band height in rows, overrides the block height multiple
+        max_memory: memory budget in bytes
+        temporaries: number of band-sized float64 arrays the kernel allocates
+        ntiles: number of bands held in memory at once, see tiles_in_flight
+        out_blocks: output block shape to snap the bands to, see snap_shape
+
+    Returns:
+        read windows, write windows
+
+    """
+    if rows is None:
+        block_rows = src.block_shapes[0][0]
+        if max_memory is None:
+            rows = block_rows * ceil(256 / block_rows)
+        else:
+            # band memory grows with the height alone, less the halo above and below
+            bytes_per_cell = np.dtype(src.dtypes[0]).itemsize + 8 * temporaries
+            fit = int(max_memory // (ntiles * src.width * bytes_per_cell)) - 2 * overlap
+            nblocks = min(max(1, fit // block_rows), ceil(src.height / block_rows))
+            rows = block_rows * nblocks
+    rows, _ = snap_shape((rows, src.width), out_blocks)
+
+    read_windows = list(tile_grid(src.width, src.height, src.width, rows, overlap=overlap))
+    write_windows = list(tile_grid(src.width, src.height, src.width, rows, overlap=0))
+
+    return read_windows, write_windows
+
+
+class ShardError(ValueError):
+    """More shards were requested than a run has rows of tiles"""
+
+
+def shard_tiles(
+    read_windows: Iterable[ReadWindow],
+    write_windows: Iterable[Window],
+    shard: Optional[tuple[int, int]] = None
+) -> tuple[list[ReadWindow], list[Window], Window]:
+    """Select the tiles of one shard of a run
+
+    Rows of tiles are split into count contiguous runs so that each shard
+    covers a rectangular region of the output and writes it to its own
+    fragment. The split depends only on the windows, so every shard of a
+    run agrees on it. More shards than rows of tiles raise a ShardError.
+
+    Parameters:
+        read_windows: read windows, or tuples of read windows for multiple sources
+        write_windows: write windows paired with the read windows
+        shard: shard index and count, or None for the whole run
+
+    Returns:
+        read windows, write windows and the region of the output they cover
+
+    """
+    tiles = list(zip(read_windows, write_windows))
+    if shard is not None:
+        index, count = shard
+        rows = sorted({window.row_off for _, window in tiles})
+        if count > len(rows):
+            raise ShardError((msg.EMPTYSHARD).format(count, len(rows)))
+        selected = set(rows[index * len(rows) // count:(index + 1) * len(rows) // count])
+        tiles = [(rw, ww) for rw, ww in tiles if ww.row_off in selected]
+
+    region = union(*[window for _, window in tiles])
+
+    return [rw for rw, _ in tiles], [ww for _, ww in tiles], region
+
+
+def merge_fragments(
+    fragments: list[str],
+    output: str,
+    bar: Any = None,
+    **kwargs: Any
+) -> None:
+    """Stitch aligned fragments into one raster
+
+    Fragments, such as those written by the shards of a run, are copied
+    block by block into the window they occupy in the union of their
+    bounds. Cells no fragment covers are left as nodata. Fragments are
+    opened one at a time, so any number of them can be merged. The scales
+    and offsets of the first fragment are kept, and its mask band if it has
+    one.
+
+    Parameters:
+        fragments: paths to the fragments
+        output: output path
+        bar: optional click progressbar updated with the cells copied
+        kwargs: creation options updating the profile of the first fragment
+
+    """
+    with rasterio.open(fragments[0]) as first:
+        profile = first.profile
+        res = first.res
+        scales, offsets = first.scales, first.offsets
+        masked = has_mask_band(first)
+        left, bottom, right, top = first.bounds
+        for path in fragments[1:]:
+            with rasterio.open(path) as fragment:
+                if (fragment.crs != first.crs or fragment.count != first.count
+                        or fragment.dtypes != first.dtypes
+                        or not is_raster_aligned(first, fragment)):
+                    raise ValueError(msg.NONALIGNED)
+                left = min(left, fragment.bounds.left)
+                bottom = min(bottom, fragment.bounds.bottom)
+                right = max(right, fragment.bounds.right)
+                top = max(top, fragment.bounds.top)
+
+    transform = rasterio.Affine(res[0], 0.0, left, 0.0, -res[1], top)
+    profile.update(
+        width=int(round((right - left) / res[0])),
+        height=int(round((top - bottom) / res[1])),
+        transform=transform,
+        **kwargs)
+
+    with rasterio.open(output, 'w', **profile) as dst:
+        dst.scales, dst.offsets = scales, offsets
+        for path in fragments:
+            with rasterio.open(path) as fragment:
+                col, row = ~transform * (fragment.transform.c, fragment.transform.f)
+                col, row = int(round(col)), int(round(row))
+                for _, window in fragment.block_windows(1):
+                    target = Window(
+                        window.col_off + col, window.row_off + row, window.width, window.height)
+                    dst.write(fragment.read(window=window), window=target)
+                    if masked:
+                        dst.write_mask(fragment.read_masks(1, window=window), window=target)
+                    if bar is not None:
+                        bar.update(window.width * window.height)
+
+
+EMPTY, PARTIAL, FULL = 0, 1, 2
+
+
+def _is_sparse(src: rasterio.DatasetReader, band: int, i: int, j: int) -> bool:
+    """Test whether a GeoTIFF block was never written"""
+    offset = src.get_tag_item('BLOCK_OFFSET_{}_{}'.format(j, i), 'TIFF', bidx=band)
+    return offset in (None, '0')
+
+
+def scan_blocks(src: rasterio.DatasetReader, band: int = 1) -> np.ndarray:
+    """Classify the internal blocks of a band as empty, partial or full
+
+    Sources without a mask are full. Blocks a sparse GeoTIFF never wrote
+    read as nodata and are empty without reading them. Other blocks are
+    classified from the dataset mask, which reads the block when the mask
+    derives from a nodata value.
+
+    Parameters:
+        src: rasterio read source
+        band: band to scan
+
+    Returns:
+        block classes EMPTY, PARTIAL or FULL in block rows and columns
+
+    """
+    bh, bw = src.block_shapes[band - 1]
+    codes = np.full((ceil(src.height / bh), ceil(src.width / bw)), FULL, dtype=np.uint8)
+    if rasterio.enums.MaskFlags.all_valid in src.mask_flag_enums[band - 1]:
+        return codes
+
+    sparse = src.driver == 'GTiff' and src.nodata is not None
+    for (i, j), window in src.block_windows(band):
+        if sparse and _is_sparse(src, band, i, j):
+            codes[i, j] = EMPTY
+            continue
+        mask = src.read_masks(band, window=window)
+        if not mask.any():
+            codes[i, j] = EMPTY
+        elif not mask.all():
+            codes[i, j] = PARTIAL
+
+    return codes
+
+
+def scan_tiles(
+    sources: Iterable[rasterio.DatasetReader],
+    read_windows: Iterable[ReadWindow],
+    band: int = 1
+) -> list[int]:
+    """Classify tiles as empty, partial or full from the blocks they read
+
+    A tile is empty when its read windows hold no valid cells in any
+    source, and full when they hold only valid cells in every source.
+
+    Parameters:
+        sources: rasterio read sources
+        read_windows: read windows, or tuples of read windows for multiple sources
+        band: band to scan
+
+    Returns:
+        tile classes EMPTY, PARTIAL or FULL
+
+    """
+    sources = list(sources)
+    grids = [(scan_blocks(src, band), src.block_shapes[band - 1]) for src in sources]
+
+    classes = []
+    for read_window in read_windows:
+        if isinstance(read_window, Window):
+            read_window = (read_window,)
+        codes = []
+        for (grid, (bh, bw)), window in zip(grids, read_window):
+            rows = slice(int(window.row_off) // bh, ceil((window.row_off + window.height) / bh))
+            cols = slice(int(window.col_off) // bw, ceil((window.col_off + window.width) / bw))
+            codes.append(grid[rows, cols])
+        if all((code == EMPTY).all() for code in codes):
+            classes.append(EMPTY)
+        elif all((code == FULL).all() for code in codes):
+            classes.append(FULL)
+        else:
+            classes.append(PARTIAL)
+
+    return classes
+
+
+def empty_tiles(
+    sources: Iterable[rasterio.DatasetReader],
+    read_windows: Iterable[ReadWindow],
+    write_windows: Iterable[Window],
+    band: int = 1
+) -> set[tuple[int, ...]]:
+    """Return the write windows of tiles reading no valid cells, see process_tiles
+
+    Parameters:
+        sources: rasterio read sources
+        read_windows: read windows, or tuples of read windows for multiple sources
+        write_windows: write windows paired with the read windows
+        band: band to scan
+
+    Returns:
+        flattened write windows of the empty tiles
+
+    """
+    classes = scan_tiles(sources, read_windows, band)
+
+    return {
+        tuple(window.flatten()) for window, tile_class in zip(write_windows, classes)
+        if tile_class == EMPTY}
+
+
+class BufferPool:
+    """Hand out preallocated arrays and reuse them between tiles
+
+    Arrays are kept in free lists keyed by shape and type. Tiles of a plan
+    share a handful of shapes, so after the first few tiles acquiring an
+    array no longer allocates.
+
+    """
+
+    def __init__(self) -> None:
+        self._free: dict[tuple[tuple[int, ...], str], list[np.ndarray]] = {}
+        self._lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape: tuple[int, ...], dtype: Any) -> np.ndarray:
+        """Get an uninitialized array
+
+        Parameters:
+            shape: array shape
+            dtype: array data type
+
+        Returns:
+            array from the pool, or a new array
+
+        """
+        key = (tuple(int(n) for n in shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.allocated += 1
+        return np.empty(key[0], dtype=dtype)
+
+    def release(self, arr: np.ndarray, keep: Optional[np.ndarray] = None) -> None:
+        """Return an array to the pool
+
+        Parameters:
+            arr: array obtained from acquire
+            keep: an array still in use, arr is not reused if they share memory
+
+        """
+        if keep is not None and np.may_share_memory(arr, keep):
+            return
+        key = (arr.shape, arr.dtype.str)
+        with self._lock:
+            self._free.setdefault(key, []).append(arr)
+
+
+class BandReader:
+    """Read a band from one or more sources
+
+    A read window is a single window for one source, or a tuple holding
+    one window for each source. With per_thread each thread reading
+    opens its own handle on the sources, so reads can run concurrently
+    in the worker threads instead of the thread scheduling the tiles.
+    With reuse, tiles are read into arrays from a BufferPool which are
+    returned to the pool by release once the tile is computed.
+
+    Parameters:
+        sources: rasterio read sources
+        nan_nodata: set invalid cells to nan, those masked by a per-dataset mask
+            band if the source has one, otherwise those at or near its nodata value
+        band: band to read
+        per_thread: open one dataset handle per reading thread
+        reuse: read into pooled arrays
+        stats: counter of the cells and blocks read
+
+    """
+
+    def __init__(
+        self,
+        *sources: rasterio.DatasetReader,
+        nan_nodata: bool = True,
+        band: int = 1,
+        per_thread: bool = False,
+        reuse: bool = True,
+        stats: Optional[ReadStats] = None
+    ) -> None:
+        self.sources = sources
+        self.nan_nodata = nan_nodata
+        self.band = band
+        self.per_thread = per_thread
+        self.pool = BufferPool() if reuse else None
+        self.stats = stats
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._handles: list[rasterio.DatasetReader] = []
+
+    def __call__(self, read_window: ReadWindow) -> tuple[np.ndarray, ...]:
+        if isinstance(read_window, Window):
+            read_window = (read_window,)
+        arrays = []
+        for src, window in zip(self._datasets(), read_window):
+            if self.stats is not None:
+                self.stats.record(src, self.band, window)
+            if self.pool is None:
+                arr = src.read(self.band, window=window)
+            else:
+                shape = (round(window.height), round(window.width))
+                arr = self.pool.acquire(shape, src.dtypes[self.band - 1])
+                src.read(self.band, window=window, out=arr)
+            if self.nan_nodata:
+                self._nan_nodata(arr, src, window)
+            arrays.append(arr)
+        return tuple(arrays)
+
+    def _nan_nodata(self, arr: np.ndarray, src: rasterio.DatasetReader, window: Window) -> None:
+        if has_mask_band(src, self.band):
+            # a bitmask read replaces a comparison of every cell with nodata
+            valid = self.pool.acquire(arr.shape, np.uint8) if self.pool else None
+            valid = src.read_masks(self.band, window=window, out=valid)
+            arr[valid == 0] = np.nan
+            if self.pool is not None:
+                self.pool.release(valid)
+            return
+        if src.nodata is None:
+            return
+        if self.pool is None:
+            arr[arr <= src.nodata + 1] = np.nan
+            return
+        mask = self.pool.acquire(arr.shape, bool)
+        np.less_equal(arr, src.nodata + 1, out=mask)
+        arr[mask] = np.nan
+        self.pool.release(mask)
+
+    def release(self, arrays: tuple[np.ndarray, ...], result: np.ndarray) -> None:
+        """Return tile arrays to the pool once the result is computed
+
+        Parameters:
+            arrays: arrays returned by a read
+            result: result computed from the arrays, arrays it shares memory with are kept
+
+        """
+        if self.pool is None:
+            return
+        for arr in arrays:
+            self.pool.release(arr, keep=result)
+
+    def __enter__(self) -> BandReader:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+    def _datasets(self) -> tuple[rasterio.DatasetReader, ...]:
+        if not self.per_thread:
+            return self.sources
+        datasets = getattr(self._local, 'datasets', None)
+        if datasets is None:
+            datasets = tuple(reopen(src) for src in self.sources)
+            self._local.datasets = datasets
+            with self._lock:
+                self._handles.extend(datasets)
+        return datasets
+
+    def close(self) -> None:
+        """Close the per-thread dataset handles"""
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles = []
+        self._local = threading.local()
+
+
+class RowBandReader(BandReader):
+    """Read full-width row bands of a source, reading each row once
+
+    Bands planned with plan_bands overlap by twice the halo. The last rows
+    of each band are kept in a carry buffer and copied into the next band,
+    so only rows not read before are read and decoded. Bands must be read
+    top to bottom for the carry to apply, other reads are read in full.
+    Reads happen in the thread scheduling the bands, so they stay ordered
+    while bands are computed concurrently.
+
+    Parameters:
+        src: rasterio read source
+        halo: overlap of the read windows in rows
+        kwargs: keyword arguments passed to BandReader, except per_thread
+
+    """
+
+    def __init__(self, src: rasterio.DatasetReader, halo: int = 0, **kwargs: Any) -> None:
+        super().__init__(src, per_thread=False, **kwargs)
+        self.halo = halo
+        self._carry: Optional[np.ndarray] = None
+        self._carry_window: Optional[Window] = None
+
+    def __call__(self, read_window: ReadWindow) -> tuple[np.ndarray, ...]:
+        window = read_window if isinstance(read_window, Window) else read_window[0]
+        src = self.sources[0]
+        shape = (round(window.height), round(window.width))
+        dtype = src.dtypes[self.band - 1]
+        arr = self.pool.acquire(shape, dtype) if self.pool is not None else np.empty(shape, dtype)
+
+        with self._lock:
+            carried = 0
+            carry = self._carry_window
+            if (carry is not None and carry.col_off == window.col_off
+                    and carry.width == window.width
+                    and carry.row_off <= window.row_off < carry.row_off + carry.height):
+                start = int(window.row_off - carry.row_off)
+                carried = min(int(carry.height) - start, shape[0])
+                arr[:carried] = self._carry[start:start + carried]
+
+            if carried < shape[0]:
+                rest = Window(
+                    window.col_off, window.row_off + carried, window.width, shape[0] - carried)
+                if self.stats is not None:
+                    self.stats.record(src, self.band, rest)
+                src.read(self.band, window=rest, out=arr[carried:])
+                if self.nan_nodata:
+                    self._nan_nodata(arr[carried:], src, rest)
+
+            keep = min(2 * self.halo, shape[0])
+            if keep > 0:
+                if self._carry is None or self._carry.shape != (keep, shape[1]):
+                    self._carry = np.empty((keep, shape[1]), dtype=dtype)
+                self._carry[...] = arr[shape[0] - keep:]
+                self._carry_window = Window(
+                    window.col_off, window.row_off + shape[0] - keep, window.width, keep)
+
+        return (arr,)
+
+
+def reopen(src: rasterio.DatasetReader) -> rasterio.DatasetReader:
+    """Open a new handle on a source
+
+    Sources with a reopen method, such as mosaic.MosaicDataset, open
+    their own, other sources are opened again by name.
+
+    Parameters:
+        src: rasterio read source
+
+    Returns:
+        dataset
+
+    """
+    if hasattr(src, 'reopen'):
+        return src.reopen()
+    return rasterio.open(src.name)
+
+
+def has_mask_band(src: rasterio.DatasetReader, band: int = 1) -> bool:
+    """Whether a band is masked by a per-dataset mask band
+
+    Parameters:
+        src: rasterio dataset
+        band: band
+
+    Returns:
+        True if the band has a per-dataset mask
+
+    """
+    return rasterio.enums.MaskFlags.per_dataset in src.mask_flag_enums[band - 1]
+
+
+def band_writer(
+    dst: rasterio.io.DatasetWriter,
+    dtype: Optional[str] = None,
+    band: int = 1,
+    bar: Any = None,
+    reuse: bool = True,
+    region: Optional[Window] = None,
+    mask: bool = False
+) -> Writer:
+    """Create a writer for a band of a destination
+
+    Parameters:
+        dst: rasterio write destination
+        dtype: data type to cast results to, defaults to the destination type
+        band: band to write
+        bar: optional click progressbar updated with the cells written
+        reuse: cast results into pooled arrays
+        region: window of the full output covered by dst, see shard_tiles
+        mask: also write the valid cells of results to the per-dataset mask band
+
+    Returns:
+        function writing a result to a window
+
+    """
+    if dtype is None:
+        dtype = dst.dtypes[band - 1]
+    pool = BufferPool() if reuse else None
+
+    def write(result: np.ndarray, window: Window) -> None:
+        if region is not None:
+            window = Window(
+                window.col_off - region.col_off, window.row_off - region.row_off,
+                window.width, window.height)
+        if pool is None or result.dtype == dtype:
+            dst.write(result.astype(dtype, copy=False), band, window=window)
+        else:
+            out = pool.acquire(result.shape, dtype)
+            np.copyto(out, result, casting='unsafe')
+            dst.write(out, band, window=window)
+            pool.release(out)
+        if mask:
+            dst.write_mask(valid_mask(result, dst.nodata), window=window)
+        if bar is not None:
+            bar.update(result.size)
+
+    return write
+
+
+class Journal:
+    """Record the completed write windows of a run in a sidecar file
+
+    The journal is written next to the output. Its first line holds a
+    signature of the planned write windows, so a run is only resumed with
+    the same plan, and each following line a completed window.
+
+    The writers of a run close the journal, see open_output. Used as a
+    context manager, a journal the writers did not close is closed on exit,
+    and removed unless it resumes an earlier run or recorded windows, so a
+    run failing before its output is opened leaves no journal behind.
+
+    Parameters:
+        output: output path, the journal is output.journal, None keeps no journal file
+        windows: planned write windows
+        resume: load the completed windows of an earlier run
+        written: path the tiles are written to, defaults to output, a run
+            only resumes when it exists
+
+    """
+
+    def __init__(
+        self,
+        output: Optional[str],
+        windows: Iterable[Window],
+        resume: bool = False,
+        written: Optional[str] = None
+    ) -> None:
+        self.windows = list(windows)
+        self.completed: list[Window] = []
+        self.resuming = False
+        self._recorded = 0
+        self._file: Optional[Any] = None
+        if output is None:
+            self.path = None
+            return
+
+        self.path = output + '.journal'
+        windows = self.windows
+        signature = hashlib.sha1(
+            repr([window.flatten() for window in windows]).encode()).hexdigest()
+        self.resuming = (
+            resume and os.path.exists(self.path) and os.path.exists(written or output))
+
+        if self.resuming:
+            with open(self.path) as f:
+                header = json.loads(f.readline())
+                if header.get('signature') != signature:
+                    raise ValueError((msg.JOURNALMISMATCH).format(self.path))
+                for line in f:
+                    if line.endswith('\n'):
+                        self.completed.append(Window(*json.loads(line)))
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self._file.write(json.dumps({'signature': signature}) + '\n')
+            self._sync()
+
+    def _sync(self) -> None:
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def is_completed(self, window: Window) -> bool:
+        """Test whether a window lies within a completed window"""
+        return any(
+            done.col_off <= window.col_off
+            and done.row_off <= window.row_off
+            and window.col_off + window.width <= done.col_off + done.width
+            and window.row_off + window.height <= done.row_off + done.height
+            for done in self.completed)
+
+    def remaining(
+        self,
+        read_windows: Iterable[ReadWindow],
+        write_windows: Iterable[Window]
+    ) -> tuple[list[ReadWindow], list[Window]]:
+        """Drop the tiles an earlier run completed
+
+        Parameters:
+            read_windows: read windows paired with the write windows
+            write_windows: planned write windows
+
+        Returns:
+            read windows, write windows still to process
+
+        """
+        tiles = [
+            (rw, ww) for rw, ww in zip(read_windows, write_windows) if not self.is_completed(ww)]
+
+        return [rw for rw, _ in tiles], [ww for _, ww in tiles]
+
+    def record(self, windows: Iterable[Window]) -> None:
+        """Append completed windows, syncing the journal to disk"""
+        if self._file is None:
+            return
+        windows = list(windows)
+        self._recorded += len(windows)
+        for window in windows:
+            self._file.write(json.dumps([int(value) for value in window.flatten()]) + '\n')
+        self._sync()
+
+    def close(self, remove: bool = False) -> None:
+        """Close the journal, removing it once the run has completed"""
+        if self._file is None or self._file.closed:
+            return
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+    def __enter__(self) -> Journal:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(remove=not self.resuming and not self._recorded)
+
+
+class JournalWriter:
+    """Write a band of the output, checkpointing completed windows to a journal
+
+    GDAL caches written blocks, so at each checkpoint the output is closed,
+    flushing them to disk, before the windows written since the last
+    checkpoint are recorded in the journal. The output is then reopened in
+    update mode. A resumed run opens the output in update mode from the start.
+
+    With cog the full-resolution output is written to a staging directory,
+    with overviews accumulated from the written tiles by an OverviewWriter,
+    and laid out as a Cloud-Optimized GeoTIFF once the run completes.
+
+    Parameters:
+        output: output path
+        profile: output profile
+        journal: journal of the run
+        interval: seconds between checkpoints
+        cog: write a Cloud-Optimized GeoTIFF
+        scaling: scale and offset of quantized values, see quantize_kernel
+        kwargs: keyword arguments passed to band_writer
+
+    """
+
+    def __init__(
+        self,
+        output: str,
+        profile: dict,
+        journal: Journal,
+        interval: float = 60.0,
+        cog: bool = False,
+        scaling: Optional[tuple[float, float]] = None,
+        **kwargs: Any
+    ) -> None:
+        self.output = output
+        self.journal = journal
+        self.interval = interval
+        self.profile = profile
+        self._kwargs = kwargs
+        self._pending: list[Window] = []
+        self.overviews: Optional[OverviewWriter] = None
+        self.path = output
+        if cog:
+            # staged rasters are compressed once, by the COG driver
+            profile = {k: v for k, v in profile.items() if k not in CODEC_KEYS}
+            staging = staging_dir(output)
+            self.overviews = OverviewWriter(staging, profile, resume=journal.resuming)
+            self.path = os.path.join(staging, 'full.tif')
+        if journal.resuming:
+            self.dst = rasterio.open(self.path, 'r+')
+        else:
+            self.dst = rasterio.open(self.path, 'w', **profile)
+            if scaling is not None:
+                self.dst.scales, self.dst.offsets = (scaling[0],), (scaling[1],)
+        self._write = band_writer(self.dst, **kwargs)
+        self._checkpointed = time.monotonic()
+
+    def __call__(self, result: np.ndarray, window: Window) -> None:
+        self._write(result, window)
+        if self.overviews is not None:
+            region = self._kwargs.get('region') or Window(0, 0, 0, 0)
+            self.overviews(result, Window(
+                window.col_off - region.col_off, window.row_off - region.row_off,
+                window.width, window.height))
+        self._pending.append(window)
+        if time.monotonic() - self._checkpointed > self.interval:
+            self.checkpoint()
+
+    def __enter__(self) -> JournalWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(completed=exc_type is None)
+
+    def checkpoint(self) -> None:
+        """Flush the output and record the windows written since the last checkpoint"""
+        self.dst.close()
+        if self.overviews is not None:
+            self.overviews.close()
+        self.journal.record(self._pending)
+        self._pending = []
+        self.dst = rasterio.open(self.path, 'r+')
+        if self.overviews is not None:
+            self.overviews.open()
+        self._write = band_writer(self.dst, **self._kwargs)
+        self._checkpointed = time.monotonic()
+
+    def close(self, completed: bool = True) -> None:
+        """Close the output, and the journal, removing it when the run completed"""
+        self.dst.close()
+        if self.overviews is not None:
+            self.overviews.close()
+        self.journal.record(self._pending)
+        self._pending = []
+        if completed and self.overviews is not None:
+            self.overviews.finish(self.path)
+            write_cog(
+                self.overviews.staging, self.path, self.output, self.profile,
+                self.overviews.factors)
+            remove_staging(self.overviews.staging)
+        self.journal.close(remove=completed)
+
+
+class OrderedWriter:
+    """Write tiles in raster order from a dedicated thread
+
+    Results are queued by the caller and written by a writer thread, so
+    compute workers never block on the destination. Tiles are held until
+    their tile row is complete, then adjacent windows in the row are
+    merged into strips and rows are written top to bottom. Tiles
+    processed along a space-filling curve complete rows late, so with
+    in_order False they are written as they arrive instead.
+
+    A slow tile holds back the rows after it, so the cells held are
+    bounded by max_held. Once they exceed it, the held tiles are written
+    out of order and the rows they belong to completed as their remaining
+    tiles arrive.
+
+    Parameters:
+        write: function writing a result to a window, see band_writer
+        windows: planned write windows
+        max_queue: maximum results queued for the writer thread
+        coalesce: merge adjacent windows in a row into a single write
+        in_order: hold tiles to write rows in raster order
+        max_held: maximum cells held, defaults to those of four tile rows
+
+    """
+
+    def __init__(
+        self,
+        write: Writer,
+        windows: Iterable[Window],
+        max_queue: int = 8,
+        coalesce: bool = True,
+        in_order: bool = True,
+        max_held: Optional[int] = None
+    ) -> None:
+        self._write = write
+        self._coalesce = coalesce
+        self._in_order = in_order
+        self._expected: dict[tuple[int, int], int] = {}
+        cells: dict[tuple[int, int], int] = {}
+        for window in windows:
+            key = (window.row_off, window.height)
+            self._expected[key] = self._expected.get(key, 0) + 1
+            cells[key] = cells.get(key, 0) + int(window.width * window.height)
+        if max_held is None:
+            max_held = 4 * max(cells.values(), default=0)
+        self._max_held = max_held
+        self._held = 0
+        self._rows = sorted(self._expected)
+        self._next = 0
+        self._pending: dict[tuple[int, int], list[tuple[np.ndarray, Window]]] = {}
+        self._written: dict[tuple[int, int], int] = {}
+        self._error: Optional[BaseException] = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, result: np.ndarray, window: Window) -> None:
+        if self._error is not None:
+            raise self._error
+        self._queue.put((result, window))
+
+    def __enter__(self) -> OrderedWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(flush=exc_type is None)
+
+    def close(self, flush: bool = True) -> None:
+        """Write the remaining tiles and stop the writer thread
+
+        Parameters:
+            flush: write tiles remaining in incomplete rows
+
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if flush:
+            for key in self._rows[self._next:]:
+                self._write_row(self._pending.pop(key, []))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._add(*item)
+            except BaseException as err:
+                self._error = err
+
+    def _add(self, result: np.ndarray, window: Window) -> None:
+        key = (window.row_off, window.height)
+        if not self._in_order or key not in self._expected:
+            self._write(result, window)
+            return
+        self._pending.setdefault(key, []).append((result, window))
+        self._held += int(window.width * window.height)
+        while self._next < len(self._rows):
+            key = self._rows[self._next]
+            tiles = self._pending.get(key, [])
+            if len(tiles) + self._written.get(key, 0) < self._expected[key]:
+                break
+            self._release(key)
+            self._next += 1
+        if self._held > self._max_held:
+            for key in list(self._pending):
+                self._release(key)
+
+    def _release(self, key: tuple[int, int]) -> None:
+        tiles = self._pending.pop(key, [])
+        self._write_row(tiles)
+        self._written[key] = self._written.get(key, 0) + len(tiles)
+        self._held -= sum(int(window.width * window.height) for _, window in tiles)
+
+    def _write_row(self, tiles: list[tuple[np.ndarray, Window]]) -> None:
+        tiles = sorted(tiles, key=lambda tile: tile[1].col_off)
+        if not self._coalesce:
+            for result, window in tiles:
+                self._write(result, window)
+            return
+        run: list[tuple[np.ndarray, Window]] = []
+        for tile in tiles:
+            if run and tile[1].col_off != run[-1][1].col_off + run[-1][1].width:
+                self._write_run(run)
+                run = []
+            run.append(tile)
+        if run:
+            self._write_run(run)
+
+    def _write_run(self, run: list[tuple[np.ndarray, Window]]) -> None:
+        if len(run) == 1:
+            self._write(*run[0])
+            return
+        first = run[0][1]
+        width = sum(window.width for _, window in run)
+        strip = np.concatenate([result for result, _ in run], axis=1)
+        self._write(strip, Window(first.col_off, first.row_off, width, first.height))
+
+
+@contextmanager
+def open_output(
+    output: str,
+    profile: dict,
+    journal: Journal,
+    windows: list[Window],
+    output_format: str = 'gtiff',
+    order: str = 'row',
+    cog: bool = False,
+    to_gtiff_path: Optional[str] = None,
+    tile_outputs: Optional[str] = None,
+    scaling: Optional[tuple[float, float]] = None,
+    mask: bool = False,
+    **kwargs: Any
+) -> Iterator[Writer]:
+    """Open the journaled writer of a run
+
+    GTiff outputs are written by a JournalWriter behind an OrderedWriter.
+    Zarr outputs are written by a ZarrWriter with chunks shaped like the
+    write windows, and tile outputs by a TileWriter writing a file per
+    write window with a VRT mosaic at the output path. The workers call
+    both of these directly.
+
+    Parameters:
+        output: output path
+        profile: output profile
+        journal: journal of the run
+        windows: write windows of the run
+        output_format: 'gtiff' or 'zarr'
+        order: tile order, rows of tiles are written in order for 'row'
+        cog: write a Cloud-Optimized GeoTIFF
+        to_gtiff_path: convert a Zarr output to a GTiff once it completes
+        tile_outputs: directory to write a GTiff per write window to
+        scaling: scale and offset of quantized values, see quantize_kernel
+        mask: write an internal mask band of the valid cells, GTiff outputs only
+        kwargs: bar and region keyword arguments passed to the writer
+
+    Yields:
+        writer
+
+    """
+    if tile_outputs is not None:
+        if cog or output_format != 'gtiff':
+            raise ValueError(msg.TILEOUTPUTS)
+        with TileWriter(
+                output, profile, journal, tile_outputs, windows=journal.windows,
+                scaling=scaling, mask=mask, **kwargs) as writer:
+            yield writer
+        return
+
+    if output_format == 'zarr':
+        if cog:
+            raise ValueError(msg.ZARRCOG)
+        if mask:
+            raise ValueError(msg.ZARRMASK)
+        chunks = (
+            max((int(w.height) for w in windows), default=256),
+            max((int(w.width) for w in windows), default=256))
+        with ZarrWriter(output, profile, journal, chunks, scaling=scaling, **kwargs) as writer:
+            yield writer
+        if to_gtiff_path is not None:
+            to_gtiff(output, to_gtiff_path, **{
+                key: value for key, value in profile.items() if key in CODEC_KEYS})
+        return
+
+    # a profile copied from a VRT input would otherwise create a VRT
+    profile = dict(profile, driver='GTiff')
+    with JournalWriter(
+            output, profile, journal, cog=cog, scaling=scaling, mask=mask, **kwargs) as write, \
+            OrderedWriter(write, windows, in_order=(order == 'row')) as writer:
+        yield writer
+
+
+def _compute_and_write(
+    kernel: Kernel,
+    reader: Optional[Reader],
+    arrays: Optional[tuple[np.ndarray, ...]],
+    read_window: ReadWindow,
+    write_window: Window,
+    trim_halo: bool,
+    writer: Writer
+) -> None:
+    """Compute a tile and write it from the worker thread"""
+    writer(_compute(kernel, reader, arrays, read_window, write_window, trim_halo), write_window)
+
+
+def _compute(
+    kernel: Kernel,
+    reader: Optional[Reader],
+    arrays: Optional[tuple[np.ndarray, ...]],
+    read_window: ReadWindow,
+    write_window: Window,
+    trim_halo: bool
+) -> np.ndarray:
+    """Apply a kernel to a tile and trim the result to the write window
+
+    When arrays is None the tile is read first, in the calling thread.
+    Arrays are handed back to a reader that releases them after use.
+    """
+    if arrays is None:
+        arrays = reader(read_window)
+    arr = kernel(*arrays)
+    release = getattr(reader, 'release', None)
+    if release is not None:
+        release(arrays, arr)
+    if trim_halo:
+        if not isinstance(read_window, Window):
+            read_window = read_window[0]
+        arr = trim(arr, margins(read_window, write_window))
+    return arr
+
+
+def _fill_empty(
+    tasks: Iterable[tuple[ReadWindow, Window]],
+    empty: set[tuple[int, ...]],
+    reader: Reader,
+    kernel: Kernel,
+    writer: Writer,
+    trim_halo: bool,
+    read: Optional[Reader] = None
+) -> Iterable[tuple[ReadWindow, Window]]:
+    """Write empty tiles from cached results, yielding the other tiles
+
+    Empty tiles are read with read when given, rather than by the reader
+    in the calling thread.
+    """
+    fills: dict[tuple, np.ndarray] = {}
+    for read_window, write_window in tasks:
+        if tuple(write_window.flatten()) not in empty:
+            yield read_window, write_window
+            continue
+        windows = (read_window,) if isinstance(read_window, Window) else read_window
+        key = (
+            tuple((int(w.height), int(w.width)) for w in windows),
+            margins(windows[0], write_window) if trim_halo else None)
+        if key not in fills:
+            arrays = read(read_window) if read is not None else None
+            fills[key] = _compute(kernel, reader, arrays, read_window, write_window, trim_halo)
+        writer(fills[key], write_window)
+
+
+_WORKER: dict[str, Any] = {}
+
+
+def _init_process_worker(
+    paths: Optional[list[Any]],
+    nan_nodata: bool,
+    band: int,
+    slot_names: list[tuple[str, str]]
+) -> None:
+    """Open the sources and attach the shared tile buffers once per worker process"""
+    if paths is not None:
+        sources = [rasterio.open(path) if isinstance(path, str) else reopen(path) for path in paths]
+        _WORKER['reader'] = BandReader(*sources, nan_nodata=nan_nodata, band=band)
+    _WORKER['slots'] = [
+        (shared_memory.SharedMemory(name=name_in), shared_memory.SharedMemory(name=name_out))
+        for name_in, name_out in slot_names
+    ]
+
+
+def _process_task(
+    slot: int,
+    kernel: Kernel,
+    inputs: Optional[list[tuple[int, tuple[int, ...], str]]],
+    read_window: ReadWindow,
+    write_window: Window,
+    trim_halo: bool
+) -> tuple[tuple[int, ...], str]:
+    """Compute a tile in a worker process
+
+    Input arrays are taken from the slot input buffer, or read by the
+    worker when inputs is None. The result is copied to the slot output
+    buffer and only its shape and type are returned.
+    """
+    shm_in, shm_out = _WORKER['slots'][slot]
+    if inputs is None:
+        reader, arrays = _WORKER['reader'], None
+    else:
+        reader, arrays = None, tuple(
+            np.ndarray(shape, dtype=dtype, buffer=shm_in.buf, offset=offset)
+            for offset, shape, dtype in inputs
+        )
+    result = np.asarray(_compute(kernel, reader, arrays, read_window, write_window, trim_halo))
+    out = np.ndarray(result.shape, dtype=result.dtype, buffer=shm_out.buf)
+    out[...] = result
+
+    return result.shape, result.dtype.str
+
+
+def _window_cells(read_window: ReadWindow) -> int:
+    """Count the cells covered by a read window or tuple of read windows"""
+    if isinstance(read_window, Window):
+        read_window = (read_window,)
+    return int(sum(window.width * window.height for window in read_window))
+
+
+def _process_tiles_multiprocess(
+    tasks: Iterable[tuple[ReadWindow, Window]],
+    reader: BandReader,
+    kernel: Kernel,
+    writer: Writer,
+    njobs: int,
+    max_pending: int,
+    trim_halo: bool
+) -> None:
+    """Process tiles in a pool of worker processes
+
+    Each in-flight tile owns a slot of two shared memory buffers, one for
+    the input arrays and one for the result, so tiles cross the process
+    boundary without being pickled. When the reader opens per-thread
+    handles each worker opens the sources once and reads its own tiles.
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return
+    read_in_workers = reader.per_thread
+    itemsize = np.dtype(np.float64).itemsize
+    in_size = 1 if read_in_workers else itemsize * max(_window_cells(rw) for rw, _ in tasks)
+    out_size = itemsize * max(_window_cells(ww) for _, ww in tasks)
+
+    slots = [
+        (shared_memory.SharedMemory(create=True, size=in_size),
+         shared_memory.SharedMemory(create=True, size=out_size))
+        for _ in range(max_pending)
+    ]
+    free = list(range(max_pending))
+    initargs = (
+        [src if hasattr(src, 'reopen') else src.name for src in reader.sources]
+        if read_in_workers else None,
+        reader.nan_nodata,
+        reader.band,
+        [(shm_in.name, shm_out.name) for shm_in, shm_out in slots],
+    )
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=njobs,
+                initializer=_init_process_worker,
+                initargs=initargs) as executor:
+            pending: dict[concurrent.futures.Future, tuple[int, Window]] = {}
+
+            def drain() -> None:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    slot, write_window = pending.pop(future)
+                    shape, dtype = future.result()
+                    result = np.ndarray(shape, dtype=dtype, buffer=slots[slot][1].buf).copy()
+                    free.append(slot)
+                    writer(result, write_window)
+
+            for read_window, write_window in tasks:
+                if not free:
+                    drain()
+                slot = free.pop()
+                inputs = None
+                if not read_in_workers:
+                    inputs = []
+                    offset = 0
+                    arrays = reader(read_window)
+                    for arr in arrays:
+                        shared = np.ndarray(
+                            arr.shape, dtype=arr.dtype, buffer=slots[slot][0].buf, offset=offset)
+                        shared[...] = arr
+                        del shared
+                        inputs.append((offset, arr.shape, arr.dtype.str))
+                        offset += arr.nbytes
+                    reader.release(arrays, None)
+                future = executor.submit(
+                    _process_task, slot, kernel, inputs, read_window, write_window, trim_halo)
+                pending[future] = (slot, write_window)
+
+            while pending:
+                drain()
+    finally:
+        for shm_in, shm_out in slots:
+            for shm in (shm_in, shm_out):
+                shm.close()
+                shm.unlink()
+
+
+class _WindowTarget:
+    """Store target passing a dask chunk to a writer with its write window"""
+
+    def __init__(self, writer: Writer, window: Window) -> None:
+        self.writer = writer
+        self.window = window
+
+    def __setitem__(self, index: Any, value: np.ndarray) -> None:
+        self.writer(np.asarray(value), self.window)
+
+
+def _process_tiles_dask(
+    tasks: Iterable[tuple[ReadWindow, Window]],
+    reader: Reader,
+    kernel: Kernel,
+    writer: Writer,
+    njobs: int,
+    trim_halo: bool
+) -> None:
+    """Process tiles as the chunks of a dask array with map_overlap
+
+    The write windows, and the halo strips around them, become the chunks
+    of a dask array read lazily through the reader. The kernel runs with
+    map_overlap at a depth given by the read-window overlap, so chunks
+    borrow their halo from their neighbours, and each chunk matching a
+    write window is stored through the writer. Read windows of several
+    sources must be offset from one another by the same amount in every
+    tile, as with the windows of tile_grid_intersection.
+    """
+    try:
+        import dask
+        import dask.array as da
+    except ImportError:
+        raise ImportError(msg.NODASK) from None
+
+    tasks = [
+        ((rw,) if isinstance(rw, Window) else tuple(rw), ww) for rw, ww in tasks
+    ]
+    if not tasks:
+        return
+
+    # offsets of each source from the output grid, and the halo depth
+    first_read, first_write = tasks[0]
+    base = first_read[0] if trim_halo else first_write
+    offsets = [
+        (int(rw.row_off - base.row_off), int(rw.col_off - base.col_off)) for rw in first_read]
+    depth_rows = depth_cols = 0
+    if trim_halo:
+        for rw, ww in tasks:
+            left, lower, right, upper = margins(rw[0], ww)
+            depth_rows = max(depth_rows, lower, upper)
+            depth_cols = max(depth_cols, left, right)
+
+    region = union(*[
+        Window(rw[0].col_off - offsets[0][1], rw[0].row_off - offsets[0][0],
+               rw[0].width, rw[0].height)
+        for rw, _ in tasks])
+    row_edges = sorted(
+        {int(region.row_off), int(region.row_off + region.height)}
+        | {int(ww.row_off) for _, ww in tasks}
+        | {int(ww.row_off + ww.height) for _, ww in tasks})
+    col_edges = sorted(
+        {int(region.col_off), int(region.col_off + region.width)}
+        | {int(ww.col_off) for _, ww in tasks}
+        | {int(ww.col_off + ww.width) for _, ww in tasks})
+
+    lock = None if getattr(reader, 'per_thread', False) else threading.Lock()
+
+    def read_chunk(window: Window) -> tuple[np.ndarray, ...]:
+        read_window = tuple(
+            Window(window.col_off + col, window.row_off + row, window.width, window.height)
+            for row, col in offsets)
+        if lock is None:
+            return tuple(np.array(arr) for arr in reader(read_window))
+        with lock:
+            return tuple(np.array(arr) for arr in reader(read_window))
+
+    sample = read_chunk(Window(region.col_off, region.row_off, 1, 1))
+    delayed_read = dask.delayed(read_chunk, pure=True)
+    blocks: list[list[list]] = [[] for _ in offsets]
+    for top, bottom in zip(row_edges[:-1], row_edges[1:]):
+        for rows in blocks:
+            rows.append([])
+        for left, right in zip(col_edges[:-1], col_edges[1:]):
+            chunk = delayed_read(Window(left, top, right - left, bottom - top))
+            for k, arr in enumerate(sample):
+                blocks[k][-1].append(
+                    da.from_delayed(chunk[k], (bottom - top, right - left), dtype=arr.dtype))
+
+    arrays = [da.block(rows) for rows in blocks]
+    result = da.map_overlap(
+        kernel, *arrays, depth={0: depth_rows, 1: depth_cols}, boundary='none',
+        trim=True, dtype=np.float64, meta=np.empty((0, 0), dtype=np.float64))
+
+    sources, targets = [], []
+    for _, ww in tasks:
+        i = row_edges.index(int(ww.row_off))
+        j = col_edges.index(int(ww.col_off))
+        if (row_edges[i + 1], col_edges[j + 1]) != (ww.row_off + ww.height, ww.col_off + ww.width):
+            raise ValueError('Write window {} is not a chunk of the tile grid'.format(ww))
+        sources.append(result.blocks[i, j])
+        targets.append(_WindowTarget(writer, ww))
+
+    store_lock = not getattr(writer, 'concurrent', False)
+    da.store(sources, targets, lock=store_lock, scheduler='threads', num_workers=njobs)
+
+
+def process_tiles(
+    read_windows: Iterable[ReadWindow],
+    write_windows: Iterable[Window],
+    reader: Reader,
+    kernel: Kernel,
+    writer: Writer,
+    njobs: int = 1,
+    max_pending: Optional[int] = None,
+    trim_halo: bool = False,
+    backend: str = 'thread',
+    prefetch: int = 0,
+    empty: Optional[set[tuple[int, ...]]] = None
+) -> None:
+    """Read, process and write tiles keeping a bounded number in flight
+
+    Tiles are read lazily in the calling thread, or in the worker threads
+    when the reader opens per-thread handles (see BandReader). Running
+    sequentially, prefetch tiles are read ahead on a background thread so
+    reading overlaps the computation of the current tile. With more
+    than one job at most max_pending tiles are held between the read and
+    the write, so memory stays bounded regardless of the raster size.
+
+    Writers with a true concurrent attribute, such as ZarrWriter, are
+    called by the worker threads instead of the calling thread.
+
+    The process backend runs the kernel in worker processes, passing tiles
+    through shared memory. It needs a BandReader and a picklable kernel,
+    such as a module-level function or a partial of one. The dask backend
+    runs the kernel over the tiles with dask.array.map_overlap on the
+    threaded scheduler, and needs the optional dask dependency.
+
+    Tiles whose write windows are in empty, see empty_tiles, read only
+    nodata. The result of the first empty tile of each shape is computed
+    and written for the others without reading or computing them.
+
+    Kernels must be pure functions of their input arrays. Results are
+    shared between empty tiles with the same read shapes and halo margins,
+    so a kernel depending on the tile position or on state kept between
+    calls would write wrong results to the empty tiles.
+
+    Parameters:
+        read_windows: read windows, or tuples of read windows for multiple sources
+        write_windows: write windows paired with the read windows
+        reader: function returning a tuple of arrays for a read window
+        kernel: function computing a result from the arrays
+        writer: function writing a result to a write window
+        njobs: number of workers, 0 or 1 runs sequentially
+        max_pending: maximum tiles in flight, defaults to twice njobs
+        trim_halo: trim results from the (first) read window to the write window
+        backend: run workers as 'thread', 'process' or 'dask'
+        prefetch: number of tiles to read ahead when running sequentially
+        empty: flattened write windows of tiles reading no valid cells
+
+    """
+    tasks: Iterable[tuple[ReadWindow, Window]] = zip(read_windows, write_windows)
+    prefetching = njobs < 2 and prefetch >= 1
+    if empty and not prefetching:
+        tasks = _fill_empty(tasks, empty, reader, kernel, writer, trim_halo)
+
+    if njobs < 2 and prefetch < 1:
+        for read_window, write_window in tasks:
+            result = _compute(kernel, reader, None, read_window, write_window, trim_halo)
+            writer(result, write_window)
+        return
+
+    if njobs < 2:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as io:
+            if empty:
+                # empty tiles are read on the io thread too, behind the tiles read ahead
+                tasks = _fill_empty(
+                    tasks, empty, reader, kernel, writer, trim_halo,
+                    read=lambda window: io.submit(reader, window).result())
+            ahead: deque = deque()
+            for read_window, write_window in tasks:
+                ahead.append((io.submit(reader, read_window), read_window, write_window))
+                if len(ahead) > prefetch:
+                    future, read_window, write_window = ahead.popleft()
+                    result = _compute(
+                        kernel, reader, future.result(), read_window, write_window, trim_halo)
+                    writer(result, write_window)
+            while ahead:
+                future, read_window, write_window = ahead.popleft()
+                result = _compute(
+                    kernel, reader, future.result(), read_window, write_window, trim_halo)
+                writer(result, write_window)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * njobs
+
+    if backend == 'process':
+        _process_tiles_multiprocess(
+            tasks, reader, kernel, writer, njobs, max_pending, trim_halo)
+        return
+
+    if backend == 'dask':
+        _process_tiles_dask(tasks, reader, kernel, writer, njobs, trim_halo)
+        return
+
+    read_in_workers = getattr(reader, 'per_thread', False)
+    write_in_workers = getattr(writer, 'concurrent', False)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=njobs) as executor:
+        pending: dict[concurrent.futures.Future, Window] = {}
+
+        def drain() -> None:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                window = pending.pop(future)
+                if not write_in_workers:
+                    writer(result, window)
+
+        for read_window, write_window in tasks:
+            if len(pending) >= max_pending:
+                drain()
+            arrays = None if read_in_workers else reader(read_window)
+            if write_in_workers:
+                future = executor.submit(
+                    _compute_and_write, kernel, reader, arrays, read_window, write_window,
+                    trim_halo, writer)
+            else:
+                future = executor.submit(
+                    _compute, kernel, reader, arrays, read_window, write_window, trim_halo)
+            pending[future] = write_window
+
+        while pending:
+            drain()
+
+
+@dataclass
+class RunOptions:
+    """Options of a tiled run, shared by the tiled commands, see run
+
+    Parameters:
+        blocks: multiple of the source blocks in a tile, 0 for a single tile
+        njobs: number of concurrent jobs, 0 for a single tile in memory
+        parallel_reads: read tiles in the worker threads, see BandReader
+        backend: run workers as 'thread', 'process' or 'dask'
+        prefetch: tiles read ahead when running sequentially
+        shard: shard index and count, see shard_tiles
+        plan_only: path of a manifest to write instead of running, see manifest
+        resume: resume an interrupted run from its journal
+        skip_empty: skip tiles reading no valid cells, see empty_tiles
+        order: tile order, 'row', 'zorder' or 'hilbert'
+        stream: process full-width row bands with a RowBandReader
+        max_memory: memory budget in bytes sizing the tiles
+        autotune: choose blocks and njobs from a probe run
+        autotune_cache: reuse and store autotuned choices
+        out_tiled: write output tiles rather than strips, see output_blocks
+        out_blocksize: output tile size, or rows per strip
+        cog: write a Cloud-Optimized GeoTIFF
+        output_format: 'gtiff' or 'zarr'
+        to_gtiff: convert a Zarr output to a GTiff at this path
+        tile_outputs: directory to write a GTiff per tile to
+        codec: output compression, see set_codec
+        codec_level: compression level
+        max_z_error: maximum error of the LERC codecs
+        codec_threads: threads compressing output blocks
+        mask_band: write an internal mask band of the valid cells
+        quantize: pack results into int16 or uint16, see quantize_kernel
+        scale: value of a step of quantized integers
+        offset: value of a quantized zero
+        verbose: count and report read amplification
+
+    """
+
+    blocks: int = 1
+    njobs: int = 1
+    parallel_reads: bool = False
+    backend: str = 'thread'
+    prefetch: int = 1
+    shard: Optional[tuple[int, int]] = None
+    plan_only: Optional[str] = None
+    resume: bool = False
+    skip_empty: bool = False
+    order: str = 'row'
+    stream: bool = False
+    max_memory: Optional[int] = None
+    autotune: bool = False
+    autotune_cache: bool = True
+    out_tiled: bool = True
+    out_blocksize: Optional[int] = None
+    cog: bool = False
+    output_format: str = 'gtiff'
+    to_gtiff: Optional[str] = None
+    tile_outputs: Optional[str] = None
+    codec: Optional[str] = None
+    codec_level: Optional[int] = None
+    max_z_error: Optional[float] = None
+    codec_threads: Optional[int] = None
+    mask_band: bool = False
+    quantize: Optional[str] = None
+    scale: float = 1.0
+    offset: float = 0.0
+    verbose: bool = False
+
+
+def run(
+    sources: Sequence[rasterio.DatasetReader],
+    kernel: Kernel,
+    profile: dict,
+    output: str,
+    options: Optional[RunOptions] = None,
+    command: str = 'run',
+    overlap: int = 0,
+    temporaries: float = 1.0,
+    nan_nodata: bool = True,
+    intersect: bool = False,
+    codec: str = 'deflate',
+    journal: bool = True,
+    echo: Optional[Callable[[str], Any]] = None,
+    progressbar: Optional[Callable[..., Any]] = None
+) -> None:
+    """Run a kernel over the tiles of its sources and write the output
+
+    Tiles are planned from the blocks of the first source, or over the
+    intersection of the first two sources with intersect. Further sources
+    are read with the same windows as the first. The output profile is
+    completed with the block layout, compression and quantization of the
+    options, and the region of the shard, before the tiles are processed
+    by process_tiles and written through open_output.
+
+    Parameters:
+        sources: rasterio read sources
+        kernel: function computing a result from the tile arrays of the sources
+        profile: output profile with its dtype and nodata set, updated in place
+        output: output path
+        options: options of the run
+        command: command name, used in messages, manifests and the autotune cache
+        overlap: halo of cells the kernel needs, trimmed from its results
+        temporaries: number of tile-sized float64 arrays the kernel allocates
+        nan_nodata: set invalid cells of the sources to nan, see BandReader
+        intersect: plan tiles over the intersection of the first two sources,
+            raising a ValueError when they do not intersect
+        codec: compression used unless the options set one
+        journal: journal completed windows next to the output so the run can resume
+        echo: function reporting progress messages, such as click.echo
+        progressbar: function opening a progress bar, such as click.progressbar
+
+    """
+    from rio_terrain.core import manifest, tuning
+
+    t0 = time.time()
+    options = options or RunOptions()
+    echo = echo or (lambda message: None)
+    src = sources[0]
+
+    set_codec(
+        profile, options.codec or codec, level=options.codec_level,
+        max_z_error=options.max_z_error, threads=options.codec_threads)
+    scaling = None
+    if options.quantize:
+        kernel = quantize_kernel(
+            kernel, profile, options.quantize, scale=options.scale, offset=options.offset)
+        scaling = (options.scale, options.offset)
+
+    reader: BandReader = BandReader(
+        *sources, nan_nodata=nan_nodata, per_thread=options.parallel_reads)
+
+    blocks, njobs, max_memory = options.blocks, options.njobs, options.max_memory
+    if options.autotune:
+        blocks, njobs = tuning.autotune(
+            command, src, reader, kernel,
+            use_cache=options.autotune_cache,
+            overlap=overlap,
+            max_memory=max_memory,
+            temporaries=temporaries,
+            prefetch=options.prefetch,
+            backend=options.backend)
+        # the tuned blocks already fit the memory budget
+        max_memory = None
+        echo((msg.AUTOTUNED).format(blocks, njobs))
+
+    whole = njobs == 0 or blocks == 0
+    ntiles = tiles_in_flight(njobs, options.prefetch)
+    if intersect:
+        if not is_raster_intersecting(src, sources[1]):
+            raise ValueError(msg.NONINTERSECTING)
+        # the output covers the intersection, its strips span the intersection width
+        *_, affine, nrows, ncols = tile_grid_intersection(src, sources[1])
+        profile.update(height=nrows, width=ncols, transform=affine)
+    out_blocks = output_blocks(profile, tiled=options.out_tiled, blocksize=options.out_blocksize)
+    if intersect:
+        shape: tuple = (None, None)
+        if not whole:
+            shape = snap_shape(tuple(size * blocks for size in src.block_shapes[0]), out_blocks)
+        windows0, windows1, write_windows, *_ = tile_grid_intersection(
+            src, sources[1], blockxsize=shape[1], blockysize=shape[0])
+        read_windows: list = list(zip(windows0, windows1))
+        write_windows = list(write_windows)
+    else:
+        affine = src.transform
+        read_windows, write_windows = plan_tiles(
+            src, blocks=blocks, overlap=overlap, whole=whole,
+            max_memory=max_memory,
+            temporaries=temporaries,
+            ntiles=ntiles,
+            out_blocks=out_blocks)
+        if options.stream:
+            read_windows, write_windows = plan_bands(
+                src, overlap=overlap,
+                max_memory=max_memory,
+                temporaries=temporaries,
+                ntiles=ntiles,
+                out_blocks=out_blocks)
+            reader = RowBandReader(src, halo=overlap, nan_nodata=nan_nodata)
+        if len(sources) > 1:
+            read_windows = [(window,) * len(sources) for window in read_windows]
+
+    read_windows, write_windows, region = shard_tiles(read_windows, write_windows, options.shard)
+    profile.update(
+        height=region.height,
+        width=region.width,
+        transform=rasterio.windows.transform(region, affine))
+    trim_halo = overlap > 0
+
+    if options.plan_only:
+        manifest.write_manifest(
+            options.plan_only, command, kernel, reader, read_windows, write_windows,
+            output, profile, trim_halo=trim_halo, scaling=scaling, mask=options.mask_band)
+        echo((msg.WRITEOUT).format(options.plan_only))
+        return
+
+    if options.verbose:
+        reader.stats = ReadStats()
+
+    # a COG is laid out and a tile mosaic written once the run completes,
+    # until then tiles are in a staged raster or the tile directory
+    written = output
+    if options.tile_outputs is not None:
+        written = options.tile_outputs
+    elif options.cog:
+        written = os.path.join(staging_dir(output), 'full.tif')
+    with reader, \
+            Journal(
+                output if journal else None, write_windows, resume=options.resume,
+                written=written) as run_journal:
+        read_windows, write_windows = run_journal.remaining(read_windows, write_windows)
+        empty = None
+        if options.skip_empty:
+            empty = empty_tiles(reader.sources, read_windows, write_windows)
+        read_windows, write_windows = order_tiles(read_windows, write_windows, options.order)
+
+        echo((msg.STARTING).format(command, msg.runmode(njobs)))
+        length = sum(window.width * window.height for window in write_windows)
+        with (progressbar(length=length, label='Blocks done:')
+              if progressbar is not None else nullcontext()) as bar, \
+                open_output(
+                    output, profile, run_journal, write_windows,
+                    output_format=options.output_format, order=options.order, cog=options.cog,
+                    to_gtiff_path=options.to_gtiff, tile_outputs=options.tile_outputs,
+                    scaling=scaling, mask=options.mask_band,
+                    bar=bar, region=region) as writer:
+            process_tiles(
+                read_windows,
+                write_windows,
+                reader,
+                kernel,
+                writer,
+                njobs=njobs,
+                backend=options.backend,
+                prefetch=options.prefetch,
+                empty=empty,
+                trim_halo=trim_halo,
+            )
+
+    if options.verbose:
+        echo((msg.READSTATS).format(*reader.stats.amplification()))
+    echo((msg.WRITEOUT).format(output))
+    echo((msg.COMPLETION).format(msg.printtime(t0, time.time())))
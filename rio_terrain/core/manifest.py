@@ -0,0 +1,307 @@
+"""Task manifests describing a tiled run for external schedulers."""
+from __future__ import annotations
+
+import concurrent.futures
+import importlib
+import json
+import os
+from functools import partial
+from typing import Any, Optional
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from rio_terrain.core import engine, mosaic
+
+
+def _jsonable(value: Any) -> Any:
+    """Convert numpy scalars and tuples for the JSON encoder"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (tuple, list)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    return value
+
+
+def _window(window: Window) -> list[int]:
+    return [int(window.col_off), int(window.row_off), int(window.width), int(window.height)]
+
+
+def kernel_name(kernel: engine.Kernel) -> tuple[str, dict]:
+    """Return the import name and keyword arguments of a kernel
+
+    Keyword arguments that are themselves kernels, such as the kernel of
+    engine.quantized, are named the same way.
+
+    Parameters:
+        kernel: module-level function, or a partial of one with keyword arguments
+
+    Returns:
+        module:function name, keyword arguments
+
+    """
+    params: dict = {}
+    if isinstance(kernel, partial):
+        if kernel.args:
+            raise ValueError('Kernel partials must bind keyword arguments only')
+        params = dict(kernel.keywords)
+        kernel = kernel.func
+    for key, value in params.items():
+        if callable(value):
+            name, nested = kernel_name(value)
+            params[key] = {'kernel': name, 'params': nested}
+
+    return '{}:{}'.format(kernel.__module__, kernel.__qualname__), _jsonable(params)
+
+
+def load_kernel(name: str, params: dict) -> engine.Kernel:
+    """Import a kernel by name and bind its keyword arguments
+
+    Parameters:
+        name: module:function name
+        params: keyword arguments
+
+    Returns:
+        kernel
+
+    """
+    module, qualname = name.split(':')
+    func: Any = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        func = getattr(func, attr)
+    params = {
+        key: load_kernel(value['kernel'], value['params'])
+        if isinstance(value, dict) and set(value) == {'kernel', 'params'} else value
+        for key, value in params.items()}
+
+    return partial(func, **params)
+
+
+def write_manifest(
+    path: str,
+    command: str,
+    kernel: engine.Kernel,
+    reader: engine.BandReader,
+    read_windows: list[engine.ReadWindow],
+    write_windows: list[Window],
+    output: str,
+    profile: dict,
+    trim_halo: bool = False,
+    scaling: Optional[tuple[float, float]] = None,
+    mask: bool = False
+) -> None:
+    """Write the tasks of a run to a manifest
+
+    Parameters:
+        path: manifest path
+        command: command name
+        kernel: module-level function, or a partial of one with keyword arguments
+        reader: BandReader on the input sources
+        read_windows: read windows, or tuples of read windows for multiple sources
+        write_windows: write windows paired with the read windows
+        output: output path
+        profile: output profile
+        trim_halo: trim results from the (first) read window to the write window
+        scaling: scale and offset of quantized values, see engine.quantize_kernel
+        mask: write an internal mask band of the valid cells
+
+    """
+    name, params = kernel_name(kernel)
+
+    profile = dict(profile)
+    profile['crs'] = profile['crs'].to_wkt() if profile.get('crs') else None
+    profile['transform'] = list(profile['transform'])[:6]
+
+    tasks = []
+    for read_window, write_window in zip(read_windows, write_windows):
+        if isinstance(read_window, Window):
+            read_window = (read_window,)
+        tasks.append({
+            'read': [_window(window) for window in read_window],
+            'write': _window(write_window),
+        })
+
+    manifest = {
+        'command': command,
+        'kernel': name,
+        'params': params,
+        'inputs': [os.path.abspath(src.name) for src in reader.sources],
+        # handles each mosaic input keeps open, None for inputs read as a single dataset
+        'mosaics': [getattr(src, 'max_open', None) for src in reader.sources],
+        'band': reader.band,
+        'nan_nodata': reader.nan_nodata,
+        'trim_halo': trim_halo,
+        'scaling': _jsonable(scaling),
+        'mask': mask,
+        'output': os.path.abspath(output),
+        'fragments': os.path.abspath(output) + '.tasks',
+        'profile': _jsonable(profile),
+        'tasks': tasks,
+    }
+
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def read_manifest(path: str) -> dict:
+    """Read a manifest
+
+    Parameters:
+        path: manifest path
+
+    Returns:
+        manifest
+
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_tasks(spec: Optional[str], ntasks: int) -> list[int]:
+    """Parse a task selection such as 100-199 or 0-9,20
+
+    Parameters:
+        spec: comma-separated task ids and inclusive ranges, or None for all tasks
+        ntasks: number of tasks in the manifest
+
+    Returns:
+        sorted task ids
+
+    """
+    if spec is None:
+        return list(range(ntasks))
+
+    ids = set()
+    for part in spec.split(','):
+        first, _, last = part.strip().partition('-')
+        ids.update(range(int(first), int(last or first) + 1))
+    if ids and (min(ids) < 0 or max(ids) >= ntasks):
+        raise ValueError('Tasks {} are outside 0-{}'.format(spec, ntasks - 1))
+
+    return sorted(ids)
+
+
+def task_path(manifest: dict, task_id: int) -> str:
+    """Return the path of the fragment a task writes
+
+    Parameters:
+        manifest: manifest
+        task_id: task id
+
+    Returns:
+        fragment path
+
+    """
+    return os.path.join(manifest['fragments'], 'task-{:06d}.tif'.format(task_id))
+
+
+def run_tasks(manifest: dict, task_ids: list[int], bar: Any = None) -> None:
+    """Compute tasks, writing each to its own fragment
+
+    Fragments are written under a temporary name and then renamed, so
+    a fragment exists only once its task has completed. Running a task
+    again replaces its fragment.
+
+    Parameters:
+        manifest: manifest
+        task_ids: task ids to run
+        bar: optional click progressbar updated with the cells written
+
+    """
+    kernel = load_kernel(manifest['kernel'], manifest['params'])
+    scaling = manifest.get('scaling')
+    profile = dict(manifest['profile'], driver='GTiff')
+    transform = rasterio.Affine(*profile['transform'])
+    for key in ('blockxsize', 'blockysize', 'tiled'):
+        profile.pop(key, None)
+    os.makedirs(manifest['fragments'], exist_ok=True)
+
+    mosaics = manifest.get('mosaics') or [None] * len(manifest['inputs'])
+    srcs = [
+        mosaic.open_mosaic(path, max_open=max_open) if max_open else rasterio.open(path)
+        for path, max_open in zip(manifest['inputs'], mosaics)]
+    try:
+        reader = engine.BandReader(*srcs, nan_nodata=manifest['nan_nodata'], band=manifest['band'])
+        for task_id in task_ids:
+            task = manifest['tasks'][task_id]
+            read_window = tuple(Window(*window) for window in task['read'])
+            write_window = Window(*task['write'])
+            if len(read_window) == 1:
+                read_window = read_window[0]
+
+            path = task_path(manifest, task_id)
+            profile.update(
+                width=write_window.width,
+                height=write_window.height,
+                transform=rasterio.windows.transform(write_window, transform))
+            with rasterio.open(path + '.part', 'w', **profile) as dst:
+                if scaling is not None:
+                    dst.scales, dst.offsets = (scaling[0],), (scaling[1],)
+                writer = engine.band_writer(
+                    dst, bar=bar, region=write_window, mask=manifest.get('mask', False))
+                engine.process_tiles(
+                    [read_window], [write_window], reader, kernel, writer,
+                    trim_halo=manifest['trim_halo'])
+            os.replace(path + '.part', path)
+    finally:
+        for src in srcs:
+            src.close()
+
+
+def _run_manifest_tasks(path: str, task_ids: list[int]) -> int:
+    run_tasks(read_manifest(path), task_ids)
+    return len(task_ids)
+
+
+def run_local(path: str, task_ids: list[int], njobs: int = 1, bar: Any = None) -> None:
+    """Run tasks of a manifest in local worker processes
+
+    A stand-in for an external scheduler, each process runs a contiguous
+    batch of tasks.
+
+    Parameters:
+        path: manifest path
+        task_ids: task ids to run
+        njobs: number of worker processes
+        bar: optional click progressbar updated with the tasks done
+
+    """
+    if njobs < 2:
+        for task_id in task_ids:
+            _run_manifest_tasks(path, [task_id])
+            if bar is not None:
+                bar.update(1)
+        return
+
+    nbatches = min(len(task_ids), 4 * njobs)
+    bounds = [len(task_ids) * i // nbatches for i in range(nbatches + 1)]
+    batches = [task_ids[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=njobs) as executor:
+        futures = [executor.submit(_run_manifest_tasks, path, batch) for batch in batches]
+        for future in concurrent.futures.as_completed(futures):
+            done = future.result()
+            if bar is not None:
+                bar.update(done)
+
+
+def merge_tasks(manifest: dict, bar: Any = None) -> None:
+    """Merge the task fragments of a manifest into its output
+
+    Parameters:
+        manifest: manifest
+        bar: optional click progressbar updated with the cells copied
+
+    """
+    fragments = [task_path(manifest, task_id) for task_id in range(len(manifest['tasks']))]
+    missing = [path for path in fragments if not os.path.exists(path)]
+    if missing:
+        raise ValueError('{} of {} tasks have not completed'.format(len(missing), len(fragments)))
+
+    options = {
+        key: value for key, value in manifest['profile'].items()
+        if key not in ('width', 'height', 'transform', 'crs', 'count', 'dtype', 'nodata', 'driver')
+    }
+    engine.merge_fragments(fragments, manifest['output'], bar=bar, **options)
@@ -0,0 +1,439 @@
+"""Mosaic inputs read from many aligned source files through a cache of open handles."""
+from __future__ import annotations
+
+import glob
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from math import ceil, floor
+from typing import Any, Iterator, Optional, Union
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags
+from rasterio.windows import Window
+
+import rio_terrain.tools.messages as msg
+
+
+def _vrt_sources(path: str) -> tuple[dict, list[tuple[str, Window, tuple[int, int]]]]:
+    """Read the grid and the source footprints of a VRT mosaic without opening its sources"""
+    root = ET.parse(path).getroot()
+    base = os.path.dirname(os.path.abspath(path))
+    band = root.find('VRTRasterBand')
+    nodata = band.findtext('NoDataValue')
+    grid = {
+        'width': int(root.get('rasterXSize')),
+        'height': int(root.get('rasterYSize')),
+        'transform': rasterio.Affine.from_gdal(
+            *(float(value) for value in root.findtext('GeoTransform').split(','))),
+        'nodata': float(nodata) if nodata is not None else None,
+    }
+
+    sources = []
+    for source in band:
+        filename = source.find('SourceFilename')
+        if filename is None:
+            continue
+        src_rect, dst_rect = source.find('SrcRect'), source.find('DstRect')
+        # sources must be read as they are, without resampling, scaling or band selection
+        if (src_rect is None or dst_rect is None
+                or any(float(src_rect.get(key)) != float(dst_rect.get(key))
+                       for key in ('xSize', 'ySize'))
+                or source.findtext('SourceBand', '1') != '1'
+                or any(source.find(key) is not None
+                       for key in ('ScaleOffset', 'ScaleRatio', 'LUT'))):
+            raise ValueError((msg.MOSAICSOURCE).format(filename.text))
+        name = filename.text
+        if filename.get('relativeToVRT') == '1':
+            name = os.path.join(base, name)
+        rect = [int(float(dst_rect.get(key))) for key in ('xOff', 'yOff', 'xSize', 'ySize')]
+        offset = (int(float(src_rect.get('yOff'))), int(float(src_rect.get('xOff'))))
+        sources.append((name, Window(*rect), offset))
+
+    return grid, sources
+
+
+def source_paths(path: str) -> list[str]:
+    """List the sources of a mosaic input
+
+    A GeoTIFF is a mosaic of a single source. Other files are read as text
+    listing source paths, raising a ValueError naming the path when they
+    are not text.
+
+    Parameters:
+        path: directory of GeoTIFFs, GeoTIFF, or text file listing one source path per line
+
+    Returns:
+        source paths
+
+    """
+    if os.path.isdir(path):
+        return sorted(
+            glob.glob(os.path.join(path, '*.tif')) + glob.glob(os.path.join(path, '*.tiff')))
+    if path.lower().endswith(('.tif', '.tiff')):
+        return [os.path.abspath(path)]
+    base = os.path.dirname(os.path.abspath(path))
+    try:
+        with open(path) as f:
+            return [os.path.join(base, line.strip()) for line in f if line.strip()]
+    except UnicodeDecodeError:
+        raise ValueError((msg.MOSAICLIST).format(path)) from None
+
+
+class SourceIndex:
+    """Footprints of aligned sources in the grid of the mosaic they form
+
+    Footprints are bucketed in a coarse grid the size of the largest
+    source, so finding the sources a window touches looks at a few
+    buckets rather than every source.
+
+    Parameters:
+        paths: source paths
+        footprints: window of each source in the mosaic grid
+        transform: transform of the mosaic grid
+        width: mosaic width in columns
+        height: mosaic height in rows
+        offsets: row and column in each source of the corner of its footprint,
+            defaults to the corner of the source
+
+    """
+
+    def __init__(
+        self,
+        paths: list[str],
+        footprints: list[Window],
+        transform: rasterio.Affine,
+        width: int,
+        height: int,
+        offsets: Optional[list[tuple[int, int]]] = None
+    ) -> None:
+        if not paths:
+            raise ValueError(msg.MOSAICEMPTY)
+        self.paths = paths
+        self.footprints = footprints
+        self.offsets = offsets or [(0, 0)] * len(paths)
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.bucket_shape = (
+            max(int(fp.height) for fp in footprints), max(int(fp.width) for fp in footprints))
+        self._buckets: dict[tuple[int, int], list[int]] = {}
+        for i, footprint in enumerate(footprints):
+            for key in self._keys(footprint):
+                self._buckets.setdefault(key, []).append(i)
+
+    @classmethod
+    def from_sources(cls, paths: list[str]) -> SourceIndex:
+        """Index sources by opening each once, checking they share a grid
+
+        Parameters:
+            paths: source paths
+
+        Returns:
+            source index
+
+        """
+        transforms, shapes = [], []
+        for path in paths:
+            with rasterio.open(path) as src:
+                transforms.append(src.transform)
+                shapes.append((src.height, src.width))
+        if not transforms:
+            raise ValueError(msg.MOSAICEMPTY)
+
+        first = transforms[0]
+        left = min(t.c for t in transforms)
+        top = max(t.f for t in transforms) if first.e < 0 else min(t.f for t in transforms)
+        transform = rasterio.Affine(first.a, 0.0, left, 0.0, first.e, top)
+        footprints = []
+        for t, (height, width) in zip(transforms, shapes):
+            col, row = ~transform * (t.c, t.f)
+            if ((t.a, t.b, t.d, t.e) != (first.a, first.b, first.d, first.e)
+                    or abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6):
+                raise ValueError(msg.NONALIGNED)
+            footprints.append(Window(round(col), round(row), width, height))
+
+        return cls(
+            paths, footprints, transform,
+            max(int(fp.col_off + fp.width) for fp in footprints),
+            max(int(fp.row_off + fp.height) for fp in footprints))
+
+    def _keys(self, window: Window) -> Iterator[tuple[int, int]]:
+        bh, bw = self.bucket_shape
+        for i in range(floor(window.row_off / bh), ceil((window.row_off + window.height) / bh)):
+            for j in range(floor(window.col_off / bw), ceil((window.col_off + window.width) / bw)):
+                yield i, j
+
+    def query(self, window: Window) -> list[int]:
+        """Return the sources whose footprints intersect a window, in index order
+
+        Parameters:
+            window: window in the mosaic grid
+
+        Returns:
+            source indices
+
+        """
+        found = set()
+        for key in self._keys(window):
+            for i in self._buckets.get(key, ()):
+                footprint = self.footprints[i]
+                if (footprint.col_off < window.col_off + window.width
+                        and window.col_off < footprint.col_off + footprint.width
+                        and footprint.row_off < window.row_off + window.height
+                        and window.row_off < footprint.row_off + footprint.height):
+                    found.add(i)
+
+        return sorted(found)
+
+
+class HandleCache:
+    """Least-recently-used cache of open source datasets
+
+    Parameters:
+        maxsize: number of datasets kept open
+
+    """
+
+    def __init__(self, maxsize: int = 64) -> None:
+        self.maxsize = max(1, maxsize)
+        self.opens = 0
+        self._handles: OrderedDict[str, Any] = OrderedDict()
+
+    def get(self, path: str) -> rasterio.DatasetReader:
+        """Return an open dataset, opening it and closing the least recently used if needed"""
+        if path in self._handles:
+            self._handles.move_to_end(path)
+            return self._handles[path]
+        while len(self._handles) >= self.maxsize:
+            _, handle = self._handles.popitem(last=False)
+            handle.close()
+        handle = rasterio.open(path)
+        self.opens += 1
+        self._handles[path] = handle
+        return handle
+
+    def close(self) -> None:
+        """Close the open datasets"""
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = OrderedDict()
+
+
+class MosaicDataset:
+    """Read a mosaic of aligned sources as a single-band dataset
+
+    Stands in for a rasterio dataset as the source of a BandReader. A read
+    looks up the sources its window touches in a SourceIndex and reads
+    each one through a HandleCache, so sources stay open between reads
+    of neighbouring tiles and a read touches only the sources it needs.
+    Cells no source covers are read as nodata, and where sources overlap
+    the last one wins. Reads are serialized, use reopen for a reader with
+    its own handles.
+
+    Parameters:
+        name: path of the mosaic input
+        index: source index
+        profile: dtype, nodata, crs and block shape of the sources
+        max_open: number of source datasets kept open
+
+    """
+
+    driver = 'Mosaic'
+    compression = None
+
+    def __init__(self, name: str, index: SourceIndex, profile: dict, max_open: int = 64) -> None:
+        self.name = name
+        self.index = index
+        self.max_open = max_open
+        self.cache = HandleCache(max_open)
+        self.width = index.width
+        self.height = index.height
+        self.transform = index.transform
+        self.crs = profile.get('crs')
+        self.nodata = profile.get('nodata')
+        self.count = 1
+        self.dtypes = (profile['dtype'],)
+        self.is_tiled = bool(profile.get('tiled'))
+        self.block_shapes = [(profile['blockysize'], profile['blockxsize'])]
+        self.res = (abs(self.transform.a), abs(self.transform.e))
+        self.bounds = rasterio.windows.bounds(
+            Window(0, 0, self.width, self.height), self.transform)
+        self.mask_flag_enums = (
+            [MaskFlags.nodata] if self.nodata is not None else [MaskFlags.all_valid],)
+        self.closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def profile(self) -> dict:
+        profile = {
+            'driver': 'GTiff',
+            'dtype': self.dtypes[0],
+            'nodata': self.nodata,
+            'width': self.width,
+            'height': self.height,
+            'count': 1,
+            'crs': self.crs,
+            'transform': self.transform,
+            'tiled': self.is_tiled,
+        }
+        # the strips of striped sources span a source, not the mosaic, so outputs lay out their own
+        if self.is_tiled:
+            profile.update(blockxsize=self.block_shapes[0][1], blockysize=self.block_shapes[0][0])
+        return profile
+
+    def reopen(self) -> MosaicDataset:
+        """Return a dataset sharing the index, with its own handles"""
+        profile = dict(
+            self.profile, blockysize=self.block_shapes[0][0], blockxsize=self.block_shapes[0][1])
+        return MosaicDataset(self.name, self.index, profile, max_open=self.max_open)
+
+    def __getstate__(self) -> dict:
+        # handles and locks stay with the process that opened them
+        state = dict(self.__dict__)
+        del state['cache'], state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.cache = HandleCache(self.max_open)
+        self._lock = threading.Lock()
+
+    def block_windows(self, bidx: int = 0) -> Iterator[tuple[tuple[int, int], Window]]:
+        """Yield the block indices and windows of the mosaic, blocked like its first source"""
+        bh, bw = self.block_shapes[0]
+        for i in range(ceil(self.height / bh)):
+            for j in range(ceil(self.width / bw)):
+                yield (i, j), Window(
+                    j * bw, i * bh, min(bw, self.width - j * bw), min(bh, self.height - i * bh))
+
+    def read_masks(
+        self,
+        indexes: int = 1,
+        window: Optional[Window] = None,
+        out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Read the valid cells of a window of the mosaic, 0 for nodata and 255 elsewhere"""
+        arr = self.read(indexes, window=window)
+        valid = np.ones(arr.shape, dtype=bool)
+        if arr.dtype.kind == 'f':
+            valid &= ~np.isnan(arr)
+        if self.nodata is not None:
+            valid &= arr != self.nodata
+        if out is None:
+            out = np.empty(arr.shape, dtype=np.uint8)
+        np.multiply(valid, 255, out=out, casting='unsafe')
+        return out
+
+    def read(
+        self,
+        indexes: int = 1,
+        window: Optional[Window] = None,
+        out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Read a window of the mosaic
+
+        Parameters:
+            indexes: band, only band 1
+            window: window to read, defaults to the whole mosaic
+            out: array to read into
+
+        Returns:
+            array of the window
+
+        """
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        shape = (round(window.height), round(window.width))
+        if out is None:
+            out = np.empty(shape, dtype=self.dtypes[0])
+        fill = self.nodata if self.nodata is not None else (np.nan if out.dtype.kind == 'f' else 0)
+        out.fill(fill)
+
+        with self._lock:
+            for i in self.index.query(window):
+                footprint = self.index.footprints[i]
+                src_row, src_col = self.index.offsets[i]
+                top = max(row_off, int(footprint.row_off))
+                left = max(col_off, int(footprint.col_off))
+                bottom = min(row_off + shape[0], int(footprint.row_off + footprint.height))
+                right = min(col_off + shape[1], int(footprint.col_off + footprint.width))
+                src = self.cache.get(self.index.paths[i])
+                src.read(
+                    indexes,
+                    window=Window(
+                        src_col + left - int(footprint.col_off),
+                        src_row + top - int(footprint.row_off),
+                        right - left, bottom - top),
+                    out=out[top - row_off:bottom - row_off, left - col_off:right - col_off])
+
+        return out
+
+    def close(self) -> None:
+        self.cache.close()
+        self.closed = True
+
+    def __enter__(self) -> MosaicDataset:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+
+def open_mosaic(path: str, max_open: int = 64) -> MosaicDataset:
+    """Open a mosaic input
+
+    A VRT is indexed from the footprints it records, without opening its
+    sources. A directory of GeoTIFFs, a GeoTIFF, or a text file listing
+    source paths, is indexed by opening each source once.
+
+    Parameters:
+        path: VRT, directory of GeoTIFFs, GeoTIFF, or text file listing source paths
+        max_open: number of source datasets kept open
+
+    Returns:
+        mosaic dataset
+
+    """
+    if path.lower().endswith('.vrt'):
+        grid, sources = _vrt_sources(path)
+        index = SourceIndex(
+            [name for name, _, _ in sources], [footprint for _, footprint, _ in sources],
+            grid['transform'], grid['width'], grid['height'],
+            offsets=[offset for _, _, offset in sources])
+    else:
+        index = SourceIndex.from_sources(source_paths(path))
+        grid = {}
+
+    with rasterio.open(index.paths[0]) as first:
+        profile = dict(first.profile)
+        if grid.get('nodata') is not None:
+            profile['nodata'] = grid['nodata']
+        profile.setdefault('blockxsize', first.block_shapes[0][1])
+        profile.setdefault('blockysize', first.block_shapes[0][0])
+
+    return MosaicDataset(path, index, profile, max_open=max_open)
+
+
+def open_input(
+    path: str,
+    mosaic: bool = False,
+    max_open: int = 64
+) -> Union[rasterio.DatasetReader, MosaicDataset]:
+    """Open the input of a command, as a mosaic or a single dataset
+
+    Parameters:
+        path: input path
+        mosaic: read the input as a mosaic of its sources, see open_mosaic
+        max_open: number of source datasets a mosaic keeps open
+
+    Returns:
+        dataset
+
+    """
+    if mosaic:
+        return open_mosaic(path, max_open=max_open)
+    return rasterio.open(path)
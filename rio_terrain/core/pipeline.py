@@ -0,0 +1,339 @@
+"""Python API running the commands on open datasets, chaining them in memory.
+
+Each function takes open rasterio datasets and returns its output opened
+for reading, so the output of one step is the input of the next. Outputs
+are written to a new MemoryFile unless a path, which may be a /vsimem/
+path, or a MemoryFile is given. In-memory outputs are tiled like their
+input, so each step of a chain plans the same tiles, and uncompressed.
+Close them with discard to free their memory.
+
+Example:
+
+    with rasterio.open('t0.tif') as t0, rasterio.open('t1.tif') as t1, \
+            rasterio.open('uncertainty.tif') as uncertainty:
+        diff = pipeline.difference(t0, t1)
+        changed = pipeline.threshold(diff, uncertainty, 1.96)
+        labels = pipeline.label(changed)
+        features = pipeline.labelbounds(labels, intensity=diff)
+        for dataset in (diff, changed, labels):
+            pipeline.discard(dataset)
+
+"""
+from __future__ import annotations
+
+from functools import partial
+from typing import Any, Optional, Union
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+import rio_terrain.tools.messages as msg
+from rio_terrain.core import engine, focalstatistics, regions, terrain
+from rio_terrain.core.windowing import is_raster_aligned
+
+
+Destination = Union[None, str, MemoryFile]
+
+
+def _open_destination(dst: Destination, profile: dict) -> tuple[Any, Optional[MemoryFile]]:
+    if dst is None:
+        dst = MemoryFile()
+    if isinstance(dst, MemoryFile):
+        return dst.open(**profile), dst
+    return rasterio.open(dst, 'w', **profile), None
+
+
+def run(
+    kernel: engine.Kernel,
+    *sources: rasterio.DatasetReader,
+    dst: Destination = None,
+    dtype: str = 'float32',
+    nodata: Optional[float] = None,
+    overlap: int = 0,
+    blocks: int = 40,
+    njobs: int = 1,
+    backend: str = 'thread',
+    nan_nodata: bool = True,
+    codec: Optional[str] = None
+) -> rasterio.DatasetReader:
+    """Run a kernel over the tiles of one or two sources
+
+    Parameters:
+        kernel: function of the tile arrays of the sources
+        sources: one source, or two intersecting sources
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        dtype: output data type
+        nodata: output nodata value, defaults to that of the first source
+        overlap: halo of cells the kernel needs, trimmed from its result
+        blocks: multiple of the source blocks in a tile, 0 for a single tile
+        njobs: number of concurrent jobs
+        backend: thread, process or dask
+        nan_nodata: set invalid cells of the sources to nan
+        codec: output compression, defaults to none in memory and deflate otherwise
+
+    Returns:
+        output opened for reading
+
+    """
+    profile = dict(sources[0].profile, driver='GTiff', dtype=dtype, count=1, bigtiff='IF_SAFER')
+    if nodata is not None:
+        profile['nodata'] = nodata
+
+    memfile = MemoryFile() if dst is None else None
+    if isinstance(dst, MemoryFile):
+        memfile = dst
+    output = memfile.name if memfile is not None else dst
+    options = engine.RunOptions(
+        blocks=blocks, njobs=njobs, backend=backend, prefetch=0, codec=codec)
+    engine.run(
+        sources, kernel, profile, output, options,
+        overlap=overlap,
+        nan_nodata=nan_nodata,
+        intersect=len(sources) > 1,
+        codec='none' if dst is None else 'deflate',
+        journal=False)
+
+    if memfile is not None:
+        return memfile.open()
+    return rasterio.open(output)
+
+
+def discard(dataset: rasterio.DatasetReader) -> None:
+    """Close a dataset, deleting it if it is held in memory
+
+    Parameters:
+        dataset: dataset returned by a function of this module
+
+    """
+    name = dataset.name
+    dataset.close()
+    if name.startswith('/vsimem/'):
+        rasterio.shutil.delete(name)
+
+
+def slope(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    units: str = 'grade',
+    neighbors: int = 8,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Calculate the slope of a raster, see rio slope
+
+    Parameters:
+        src: elevation
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        units: grade, rise, sqrt, degrees or percent
+        neighbors: 4 or 8
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        slope opened for reading
+
+    """
+    res = (src.transform.a, src.transform.e)
+    kernel = partial(terrain.slope, res=res, units=units, neighbors=neighbors)
+    return run(kernel, src, dst=dst, overlap=2, **kwargs)
+
+
+def aspect(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    pcs: str = 'cartesian',
+    neighbors: int = 8,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Calculate the aspect of a raster, see rio aspect
+
+    Parameters:
+        src: elevation
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        pcs: compass or cartesian
+        neighbors: 4 or 8
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        aspect opened for reading
+
+    """
+    res = (src.transform.a, src.transform.e)
+    kernel = partial(terrain.aspect, res=res, pcs=pcs, neighbors=neighbors)
+    return run(kernel, src, dst=dst, overlap=2, **kwargs)
+
+
+def curvature(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    neighbors: int = 4,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Calculate the curvature of a raster, see rio curvature
+
+    Parameters:
+        src: elevation
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        neighbors: 4 or 8
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        curvature opened for reading
+
+    """
+    res = (src.transform.a, src.transform.e)
+    kernel = partial(terrain.curvature, res=res, neighbors=neighbors)
+    return run(kernel, src, dst=dst, overlap=2, **kwargs)
+
+
+def mad(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    neighborhood: int = 3,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Calculate the focal median absolute deviation of a raster, see rio mad
+
+    Parameters:
+        src: raster
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        neighborhood: neighborhood size in cells
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        median absolute deviation opened for reading
+
+    """
+    kernel = partial(focalstatistics.mad, size=(neighborhood, neighborhood))
+    return run(kernel, src, dst=dst, overlap=neighborhood, **kwargs)
+
+
+def std(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    neighborhood: int = 3,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Calculate the focal standard deviation of a raster, see rio std
+
+    Parameters:
+        src: raster
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        neighborhood: neighborhood size in cells
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        standard deviation opened for reading
+
+    """
+    kernel = partial(focalstatistics.std, size=(neighborhood, neighborhood))
+    return run(kernel, src, dst=dst, overlap=neighborhood, **kwargs)
+
+
+def difference(
+    src0: rasterio.DatasetReader,
+    src1: rasterio.DatasetReader,
+    dst: Destination = None,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Subtract a raster at time t0 from one at time t1, see rio difference
+
+    Parameters:
+        src0: raster at time t0
+        src1: raster at time t1
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        difference opened for reading
+
+    """
+    return run(regions.difference, src0, src1, dst=dst, **kwargs)
+
+
+def threshold(
+    src: rasterio.DatasetReader,
+    uncertainty: rasterio.DatasetReader,
+    level: float,
+    dst: Destination = None,
+    **kwargs: Any
+) -> rasterio.DatasetReader:
+    """Threshold a raster by a multiple of an uncertainty raster, see rio threshold
+
+    Parameters:
+        src: intensity raster
+        uncertainty: uncertainty raster aligned with src
+        level: multiple of the uncertainty a cell must exceed
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        kwargs: keyword arguments passed to run
+
+    Returns:
+        1, -1 or nodata for cells above, below or within the threshold, opened for reading
+
+    """
+    if not is_raster_aligned(src, uncertainty):
+        raise ValueError(msg.NONALIGNED)
+    nodata = int(np.iinfo(np.int32).min)
+    kernel = partial(regions.threshold, level=level, default=nodata)
+    kwargs.setdefault('codec', None if dst is None else 'lzw')
+    return run(
+        kernel, src, uncertainty, dst=dst, dtype='int32', nodata=nodata, nan_nodata=False,
+        **kwargs)
+
+
+def label(
+    src: rasterio.DatasetReader,
+    dst: Destination = None,
+    diagonals: bool = False,
+    zeros: bool = False
+) -> rasterio.DatasetReader:
+    """Label connected regions of non-zero cells, see rio label
+
+    Regions may span the whole raster, so it is labeled in memory.
+
+    Parameters:
+        src: raster
+        dst: output path or MemoryFile, defaults to a new MemoryFile
+        diagonals: connect diagonal cells
+        zeros: write zeros rather than nodata outside regions
+
+    Returns:
+        labels opened for reading
+
+    """
+    nodata = int(np.iinfo(np.int32).min)
+    profile = dict(src.profile, driver='GTiff', dtype='int32', nodata=nodata, count=1)
+    engine.output_blocks(profile)
+    engine.set_codec(profile, 'none' if dst is None else 'lzw')
+
+    labels, _ = regions.label(src.read(1), nodata, diagonals=diagonals, zeros=zeros)
+
+    out, memfile = _open_destination(dst, profile)
+    with out:
+        out.write(labels, 1)
+
+    if memfile is not None:
+        return memfile.open()
+    return rasterio.open(out.name)
+
+
+def labelbounds(
+    skeleton: rasterio.DatasetReader,
+    intensity: Optional[rasterio.DatasetReader] = None,
+    blocks: int = 40
+) -> list[dict]:
+    """Calculate the bounding boxes of labeled regions, see rio labelbounds
+
+    Parameters:
+        skeleton: labeled raster
+        intensity: raster aligned with skeleton, its extremes within each box are reported
+        blocks: multiple of the skeleton blocks in a tile
+
+    Returns:
+        GeoJSON-like features with the id, min and max of each label
+
+    """
+    read_windows, _ = engine.plan_tiles(skeleton, blocks=blocks, overlap=0)
+    windows, intensities = regions.region_windows(skeleton, read_windows, intensity=intensity)
+
+    return regions.region_features(windows, intensities, skeleton.transform)
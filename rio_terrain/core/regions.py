@@ -0,0 +1,241 @@
+"""Kernels detecting change between rasters and delineating the regions it forms."""
+from __future__ import annotations
+
+import warnings
+from typing import Any, Iterable, Optional, Union
+
+import numpy as np
+import rasterio
+from rasterio import Affine
+from rasterio.windows import Window
+from scipy import ndimage
+from shapely.geometry import box, mapping
+
+from rio_terrain.core import engine
+
+
+# structuring elements connecting cells to their 8 and 4 neighbors
+BOX = np.ones((3, 3))
+CROSS = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]])
+
+
+def difference(img0: np.ndarray, img1: np.ndarray) -> np.ndarray:
+    """Subtract an image at time t0 from an image at time t1.
+
+    Parameters:
+        img0: image at time t0
+        img1: image at time t1
+
+    Returns:
+        difference of img1 and img0
+
+    """
+    return img1 - img0
+
+
+def threshold(
+    img0: np.ndarray,
+    img1: np.ndarray,
+    level: Union[int, float],
+    default: Union[int, float] = 0
+) -> np.ndarray:
+    """Threshold an image based on another image
+
+    Parameters:
+        img0: intensity image
+        img1: uncertainty image
+        level: multiple of the uncertainty a cell must exceed
+        default: value of cells within the threshold
+
+    Returns:
+        1, -1 or default for cells above, below or within the threshold
+
+    """
+    conditions = [img0 >= img1 * level, img0 <= -img1 * level]
+    choices = [1, -1]
+    result = np.select(conditions, choices, default=default)
+    return result
+
+
+def label(
+    img: np.ndarray,
+    nodata: int,
+    diagonals: bool = False,
+    zeros: bool = False
+) -> tuple[np.ndarray, int]:
+    """Label connected regions of non-zero cells
+
+    Parameters:
+        img: image, cells equal to nodata are outside any region
+        nodata: nodata value of the image and of the labels
+        diagonals: connect diagonal cells
+        zeros: set cells outside regions to zero rather than nodata
+
+    Returns:
+        int32 labels, number of regions
+
+    """
+    labels, count = ndimage.label(img, structure=BOX if diagonals else CROSS)
+    false_val = 0 if zeros else nodata
+    labels[img == nodata] = false_val
+    labels[labels == 0] = false_val
+
+    return labels.astype('int32'), count
+
+
+def slices_to_windows(
+    slices: list[tuple[slice, slice]]
+) -> tuple[list[Window], list[Any]]:
+    """Create a list of labels and windows
+
+    Parameters:
+        slices: slices of each label, the output of ndimage.find_objects
+
+    Returns:
+        raster windows, integer labels
+
+    """
+    windows = []
+    labels = []
+    # find_objects returns the slices of label 1 first
+    for label, islice in enumerate(slices, start=1):
+        if islice:
+            try:
+                slicex = slice(islice[0].start, islice[0].stop, 1)
+                slicey = slice(islice[1].start, islice[1].stop, 1)
+                window = Window.from_slices(slicex, slicey)
+                windows.append(window)
+                labels.append(label)
+            except (ValueError) as err:
+                warnings.warn(str(err))
+                pass
+
+    return windows, labels
+
+
+def shape_intensity(
+    intensities: dict[Any, list[Any]],
+    skeleton: np.ndarray,
+    intensity: np.ndarray
+) -> dict[Any, list[Any]]:
+    """Maintain a dictionary of the intensity range of labeled shapes
+
+    Parameters:
+        intensities: minimum and maximum intensity keyed by label, updated in place
+        skeleton: labeled shapes
+        intensity: intensity aligned with skeleton
+
+    Returns:
+        intensities
+
+    """
+    for label in np.unique(skeleton):
+        tmp_min = np.nanmin(intensity[skeleton == label])
+        tmp_max = np.nanmax(intensity[skeleton == label])
+        if label in intensities:
+            intensities[label] = [np.minimum(tmp_min, (intensities[label])[0]),
+                                  np.maximum(tmp_max, (intensities[label])[1])]
+        else:
+            intensities[label] = [tmp_min, tmp_max]
+
+    return intensities
+
+
+def shape_windows(
+    bounds: dict[Any, Window],
+    shapes: np.ndarray,
+    read_window: Optional[Window] = None
+) -> dict[Any, Window]:
+    """Maintain a dictionary of the windows of labeled shapes
+
+    Parameters:
+        bounds: windows keyed by label, updated in place
+        shapes: labeled shapes
+        read_window: window of shapes within the data source
+
+    Returns:
+        bounds
+
+    """
+    slices = ndimage.find_objects(shapes)
+    windows, labels = slices_to_windows(slices)
+
+    if read_window:
+        read_row_off = read_window.row_off
+        read_col_off = read_window.col_off
+    else:
+        read_row_off = 0
+        read_col_off = 0
+
+    for label, window in zip(labels, windows):
+
+        window = Window(
+            window.col_off + read_col_off,
+            window.row_off + read_row_off,
+            window.width,
+            window.height)
+
+        if label in bounds:
+            bounds[label] = rasterio.windows.union(bounds[label], window)
+        else:
+            bounds[label] = window
+
+    return bounds
+
+
+def region_windows(
+    skeleton: rasterio.DatasetReader,
+    read_windows: Iterable[Window],
+    intensity: Optional[rasterio.DatasetReader] = None
+) -> tuple[dict[Any, Window], dict[Any, list[Any]]]:
+    """Find the window and the intensity range of each labeled region
+
+    Parameters:
+        skeleton: labeled raster
+        read_windows: windows covering the skeleton, read in turn
+        intensity: raster aligned with skeleton, its nodata cells are ignored
+
+    Returns:
+        windows and minimum and maximum intensities keyed by label
+
+    """
+    reader = engine.BandReader(intensity, nan_nodata=True) if intensity is not None else None
+
+    windows: dict = {}
+    intensities: dict = {}
+    for read_window in read_windows:
+        labels = skeleton.read(1, window=read_window)
+        if reader is not None:
+            (values,) = reader(read_window)
+            intensities = shape_intensity(intensities, labels, values.astype('float64'))
+            reader.release((values,), labels)
+        windows = shape_windows(windows, labels, read_window=read_window)
+
+    return windows, intensities
+
+
+def region_features(
+    windows: dict[Any, Window],
+    intensities: dict[Any, list[Any]],
+    transform: Affine
+) -> list[dict]:
+    """Make GeoJSON-like bounding box features of labeled regions
+
+    Parameters:
+        windows: windows keyed by label, see region_windows
+        intensities: minimum and maximum intensities keyed by label
+        transform: transform of the labeled raster
+
+    Returns:
+        features with the id, min and max of each label
+
+    """
+    features = []
+    for key, window in windows.items():
+        vals = intensities.get(key, [np.nan, np.nan])
+        features.append({
+            'geometry': mapping(box(*rasterio.windows.bounds(window, transform))),
+            'properties': {'id': int(key), 'min': float(vals[0]), 'max': float(vals[1])},
+        })
+
+    return features
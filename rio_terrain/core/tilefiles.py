@@ -0,0 +1,211 @@
+"""Per-tile output files mosaicked by a VRT."""
+from __future__ import annotations
+
+import glob
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Iterable, Optional
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from rio_terrain.tools.numbers import valid_mask
+
+
+TILE_NAME = 'tile-r{:07d}-c{:07d}.tif'
+TILE_PATTERN = re.compile(r'tile-r(\d+)-c(\d+)\.tif$')
+
+
+def tile_path(directory: str, window: Window) -> str:
+    """Return the path of the file holding a write window
+
+    Parameters:
+        directory: tile directory
+        window: write window in the coordinates of the output
+
+    Returns:
+        tile path
+
+    """
+    return os.path.join(directory, TILE_NAME.format(int(window.row_off), int(window.col_off)))
+
+
+class TileWriter:
+    """Write each tile to its own GTiff, journaling completed windows
+
+    Tiles are written by the thread that computed them, each to its own
+    file, under a temporary name that is renamed once the file is complete.
+    A rerun replaces the files of the tiles it writes again, and a resumed
+    run keeps the files of the tiles its journal records. Closing a
+    completed run writes a VRT mosaic of the tile files of the planned
+    windows to the output path, so files left by other runs in the
+    directory are not mosaicked.
+
+    Parameters:
+        output: path of the VRT mosaic
+        profile: output profile
+        journal: journal of the run
+        directory: tile directory
+        windows: planned write windows of the run, defaults to the tile files in the directory
+        interval: seconds between checkpoints
+        bar: optional click progressbar updated with the cells written
+        region: window of the full output covered by the mosaic, see shard_tiles
+        scaling: scale and offset of quantized values
+        mask: write the valid cells of each tile to an internal mask band
+
+    """
+
+    # process_tiles lets the worker threads call a concurrent writer
+    concurrent = True
+
+    def __init__(
+        self,
+        output: str,
+        profile: dict,
+        journal: Any,
+        directory: str,
+        windows: Optional[Iterable[Window]] = None,
+        interval: float = 60.0,
+        bar: Any = None,
+        region: Optional[Window] = None,
+        scaling: Optional[tuple[float, float]] = None,
+        mask: bool = False
+    ) -> None:
+        self.output = output
+        self.profile = profile
+        self.journal = journal
+        self.directory = directory
+        self.interval = interval
+        self.bar = bar
+        self.region = region or Window(0, 0, profile['width'], profile['height'])
+        self.windows = None if windows is None else [self._local(window) for window in windows]
+        self.scaling = scaling
+        self.mask = mask
+        self._lock = threading.Lock()
+        self._pending: list[Window] = []
+        self._checkpointed = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def _local(self, window: Window) -> Window:
+        """Return a window of the full output in the coordinates of the mosaic"""
+        return Window(
+            window.col_off - self.region.col_off, window.row_off - self.region.row_off,
+            window.width, window.height)
+
+    def __call__(self, result: np.ndarray, window: Window) -> None:
+        local = self._local(window)
+        path = tile_path(self.directory, local)
+        profile = dict(
+            self.profile,
+            driver='GTiff',
+            width=int(window.width),
+            height=int(window.height),
+            transform=rasterio.windows.transform(local, self.profile['transform']))
+        with rasterio.open(path + '.part', 'w', **profile) as dst:
+            dst.write(result.astype(dst.dtypes[0], copy=False), 1)
+            if self.scaling is not None:
+                dst.scales, dst.offsets = (self.scaling[0],), (self.scaling[1],)
+            if self.mask:
+                dst.write_mask(valid_mask(result, dst.nodata))
+        os.replace(path + '.part', path)
+
+        with self._lock:
+            self._pending.append(window)
+            if self.bar is not None:
+                self.bar.update(result.size)
+            if time.monotonic() - self._checkpointed > self.interval:
+                self.journal.record(self._pending)
+                self._pending = []
+                self._checkpointed = time.monotonic()
+
+    def __enter__(self) -> TileWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(completed=exc_type is None)
+
+    def close(self, completed: bool = True) -> None:
+        """Record the remaining windows, and write the mosaic when the run completed"""
+        with self._lock:
+            self.journal.record(self._pending)
+            self._pending = []
+        if completed:
+            write_vrt(
+                self.output, self.profile, self.directory, self.scaling, self.mask,
+                windows=self.windows)
+        self.journal.close(remove=completed)
+
+
+def write_vrt(
+    output: str,
+    profile: dict,
+    directory: str,
+    scaling: Optional[tuple[float, float]] = None,
+    mask: bool = False,
+    windows: Optional[Iterable[Window]] = None
+) -> None:
+    """Write a VRT mosaic of the tile files in a directory
+
+    Parameters:
+        output: VRT path
+        profile: output profile
+        directory: tile directory
+        scaling: scale and offset of quantized values
+        mask: mosaic the mask bands of the tiles into the mask band of the VRT
+        windows: windows of the tiles to mosaic, defaults to every tile file in the directory
+
+    """
+    root = ET.Element(
+        'VRTDataset', rasterXSize=str(profile['width']), rasterYSize=str(profile['height']))
+    if profile.get('crs'):
+        ET.SubElement(root, 'SRS').text = profile['crs'].to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = ', '.join(
+        repr(float(value)) for value in profile['transform'].to_gdal())
+
+    dtype = rasterio.dtypes.typename_fwd[rasterio.dtypes.dtype_rev[np.dtype(profile['dtype']).name]]
+    band = ET.SubElement(root, 'VRTRasterBand', dataType=dtype, band='1')
+    if profile.get('nodata') is not None:
+        ET.SubElement(band, 'NoDataValue').text = repr(float(profile['nodata']))
+    if scaling is not None:
+        ET.SubElement(band, 'Offset').text = repr(float(scaling[1]))
+        ET.SubElement(band, 'Scale').text = repr(float(scaling[0]))
+
+    mask_band = None
+    if mask:
+        mask_band = ET.SubElement(
+            ET.SubElement(root, 'MaskBand'), 'VRTRasterBand', dataType='Byte')
+
+    if windows is None:
+        windows = []
+        for path in sorted(glob.glob(os.path.join(directory, 'tile-*.tif'))):
+            match = TILE_PATTERN.search(path)
+            if match is None:
+                continue
+            with rasterio.open(path) as src:
+                windows.append(
+                    Window(int(match.group(2)), int(match.group(1)), src.width, src.height))
+
+    base = os.path.dirname(os.path.abspath(output))
+    for window in windows:
+        path = tile_path(directory, window)
+        col, row = int(window.col_off), int(window.row_off)
+        width, height = int(window.width), int(window.height)
+        # the mask band of a tile is read as its source band 'mask,1'
+        for parent, source_band in ((band, '1'), (mask_band, 'mask,1')):
+            if parent is None:
+                continue
+            source = ET.SubElement(parent, 'SimpleSource')
+            filename = ET.SubElement(source, 'SourceFilename', relativeToVRT='1')
+            filename.text = os.path.relpath(os.path.abspath(path), base)
+            ET.SubElement(source, 'SourceBand').text = source_band
+            ET.SubElement(
+                source, 'SrcRect', xOff='0', yOff='0', xSize=str(width), ySize=str(height))
+            ET.SubElement(
+                source, 'DstRect', xOff=str(col), yOff=str(row),
+                xSize=str(width), ySize=str(height))
+
+    ET.ElementTree(root).write(output)
@@ -0,0 +1,239 @@
+"""Probe runs choosing the tile size and number of jobs for a machine and file layout."""
+from __future__ import annotations
+
+import json
+import os
+import time
+from multiprocessing import cpu_count
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import rasterio
+
+from rio_terrain.core import engine
+from rio_terrain.core.windowing import fit_blocks
+
+
+BLOCKS = (1, 2, 4, 8, 16)
+
+
+def cache_path() -> Path:
+    """Return the path of the autotune cache
+
+    The cache lives in RIO_TERRAIN_CACHE_DIR when set, otherwise in the
+    rio-terrain directory of the user cache directory.
+
+    Returns:
+        path to the cache file
+
+    """
+    cache_dir = os.environ.get('RIO_TERRAIN_CACHE_DIR')
+    if cache_dir is None:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        cache_dir = os.path.join(base, 'rio-terrain')
+
+    return Path(cache_dir) / 'autotune.json'
+
+
+def cache_key(command: str, src: rasterio.DatasetReader) -> str:
+    """Return the cache key for a command run on a source layout
+
+    Parameters:
+        command: command name
+        src: rasterio read source
+
+    Returns:
+        key of the command, block shape, compression and data type
+
+    """
+    height, width = src.block_shapes[0]
+    compression = src.compression.value if src.compression else 'none'
+
+    return '{}:{}x{}:{}:{}'.format(command, height, width, compression.lower(), src.dtypes[0])
+
+
+def read_cache(key: str, path: Optional[Path] = None) -> Optional[dict]:
+    """Return a cached choice, or None when there is none
+
+    Parameters:
+        key: cache key
+        path: cache file, defaults to cache_path()
+
+    Returns:
+        cached blocks and njobs
+
+    """
+    path = path or cache_path()
+    try:
+        with open(path) as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(key: str, choice: dict, path: Optional[Path] = None) -> None:
+    """Store a choice in the cache
+
+    Parameters:
+        key: cache key
+        choice: blocks and njobs
+        path: cache file, defaults to cache_path()
+
+    """
+    path = path or cache_path()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    cache[key] = choice
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def _max_blocks(
+    src: rasterio.DatasetReader,
+    max_memory: int,
+    overlap: int,
+    temporaries: float,
+    ntiles: int
+) -> int:
+    """Largest blocks multiple fitting the memory budget"""
+    bytes_per_cell = np.dtype(src.dtypes[0]).itemsize + 8 * temporaries
+
+    return fit_blocks(
+        src.block_shapes[0], max_memory, bytes_per_cell, halo=overlap, ntiles=ntiles)
+
+
+def _sample(read_windows: list, write_windows: list, n: int) -> tuple[list, list]:
+    """Pick n full-size tiles spread across the raster"""
+    full = max(w.height * w.width for w in write_windows)
+    index = [i for i, w in enumerate(write_windows) if w.height * w.width == full]
+    if len(index) > n:
+        step = len(index) / n
+        index = [index[int(i * step)] for i in range(n)]
+
+    return [read_windows[i] for i in index], [write_windows[i] for i in index]
+
+
+def probe(
+    src: rasterio.DatasetReader,
+    reader: engine.Reader,
+    kernel: engine.Kernel,
+    overlap: int = 0,
+    max_memory: Optional[int] = None,
+    temporaries: float = 1.0,
+    prefetch: int = 0,
+    backend: str = 'thread',
+    max_njobs: Optional[int] = None
+) -> dict:
+    """Time a few tiles at several tile sizes and job counts
+
+    Tile sizes and then job counts grow while the throughput improves.
+    Each combination runs two tiles per job, or one tile with a single job,
+    so the probe stays short on large rasters.
+
+    Parameters:
+        src: rasterio read source
+        reader: function returning a tuple of arrays for a read window
+        kernel: function computing a result from the arrays
+        overlap: read-window overlap in cells
+        max_memory: memory budget in bytes limiting the tile size
+        temporaries: number of tile-sized float64 arrays the kernel allocates
+        prefetch: number of tiles to read ahead when running sequentially
+        backend: run workers as 'thread' or 'process'
+        max_njobs: largest number of jobs to try, defaults to the cpu count
+
+    Returns:
+        the fastest blocks and njobs, and its throughput in cells per second
+
+    """
+    if max_njobs is None:
+        max_njobs = cpu_count()
+    njobs_options = [1]
+    while njobs_options[-1] * 2 <= max_njobs:
+        njobs_options.append(njobs_options[-1] * 2)
+    if njobs_options[-1] < max_njobs:
+        njobs_options.append(max_njobs)
+
+    nsources = len(getattr(reader, 'sources', (src,)))
+    best = {'blocks': 1, 'njobs': 1, 'rate': 0.0}
+    ntiles_last = None
+
+    for blocks in BLOCKS:
+        read_windows, write_windows = engine.plan_tiles(src, blocks=blocks, overlap=overlap)
+        if len(write_windows) == ntiles_last:
+            break
+        ntiles_last = len(write_windows)
+        if nsources > 1:
+            read_windows = [(window,) * nsources for window in read_windows]
+
+        best_here = None
+        for njobs in njobs_options:
+            if max_memory is not None and blocks > _max_blocks(
+                    src, max_memory, overlap, temporaries, engine.tiles_in_flight(njobs, prefetch)):
+                break
+
+            sample_read, sample_write = _sample(read_windows, write_windows, 2 * njobs)
+            cells = sum(w.height * w.width for w in sample_write)
+
+            t0 = time.perf_counter()
+            engine.process_tiles(
+                sample_read, sample_write, reader, kernel, lambda result, window: None,
+                njobs=njobs, trim_halo=True, backend=backend, prefetch=prefetch)
+            rate = cells / max(time.perf_counter() - t0, 1e-9)
+
+            if best_here is not None and rate <= best_here['rate']:
+                break
+            best_here = {'blocks': blocks, 'njobs': njobs, 'rate': rate}
+
+        if best_here is None:
+            break
+        if best_here['rate'] <= best['rate']:
+            break
+        best = best_here
+
+    return best
+
+
+def autotune(
+    command: str,
+    src: rasterio.DatasetReader,
+    reader: engine.Reader,
+    kernel: engine.Kernel,
+    use_cache: bool = True,
+    **kwargs
+) -> tuple[int, int]:
+    """Choose blocks and njobs from the cache or a probe run
+
+    Parameters:
+        command: command name used in the cache key
+        src: rasterio read source
+        reader: function returning a tuple of arrays for a read window
+        kernel: function computing a result from the arrays
+        use_cache: reuse and store the choice in the autotune cache
+        kwargs: keyword arguments passed to probe
+
+    Returns:
+        blocks, njobs
+
+    """
+    key = cache_key(command, src)
+    choice = read_cache(key) if use_cache else None
+    if choice is None:
+        choice = probe(src, reader, kernel, **kwargs)
+        if use_cache:
+            write_cache(key, choice)
+
+    blocks, njobs = choice['blocks'], choice['njobs']
+
+    # a cached choice may come from a run with a larger memory budget
+    if kwargs.get('max_memory') is not None:
+        blocks = min(blocks, _max_blocks(
+            src, kwargs['max_memory'], kwargs.get('overlap', 0), kwargs.get('temporaries', 1.0),
+            engine.tiles_in_flight(njobs, kwargs.get('prefetch', 0))))
+
+    return blocks, njobs
@@ -89,6 +89,40 @@ def tile_dims(
     return xx, yy
 
 
+def fit_blocks(
+    block_shape: tuple[int, int],
+    max_memory: int,
+    bytes_per_cell: float,
+    halo: int = 0,
+    ntiles: int = 1,
+    limit: Union[None, int] = None
+) -> int:
+    """Find the largest multiple of a block shape fitting a memory budget
+
+    Parameters:
+        block_shape: block height and width in cells
+        max_memory: memory budget in bytes
+        bytes_per_cell: bytes held per tile cell, including kernel temporaries
+        halo: read-window overlap in cells added to each side of a tile
+        ntiles: number of tiles held in memory at once
+        limit: largest multiple to consider
+
+    Returns:
+        number of blocks along each side of a tile, at least 1
+
+    """
+    def tile_bytes(k: int) -> float:
+        rows = k * block_shape[0] + 2 * halo
+        cols = k * block_shape[1] + 2 * halo
+        return ntiles * rows * cols * bytes_per_cell
+
+    k = 1
+    while (limit is None or k < limit) and tile_bytes(k + 1) <= max_memory:
+        k += 1
+
+    return k
+
+
 def block_count(
     shape: tuple[int, int],
     block_shapes: list[tuple[int, int]],
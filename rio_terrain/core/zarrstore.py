@@ -0,0 +1,185 @@
+"""Zarr output stores written a chunk per tile."""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Optional
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+import rio_terrain.tools.messages as msg
+
+
+def _zarr() -> Any:
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(msg.NOZARR) from None
+    return zarr
+
+
+def _attr(value: Any) -> Any:
+    """Convert a numpy scalar to a Python number for the JSON attributes"""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def create_store(
+    path: str,
+    profile: dict,
+    chunks: tuple[int, int],
+    resume: bool = False,
+    scaling: Optional[tuple[float, float]] = None
+) -> Any:
+    """Create, or open to resume, a Zarr array for an output
+
+    The CRS, transform and nodata value of the profile, and the scale and
+    offset of quantized values, are stored as attributes of the array.
+
+    Parameters:
+        path: store path
+        profile: output profile
+        chunks: chunk height and width
+        resume: open the existing store of an interrupted run
+        scaling: scale and offset of quantized values
+
+    Returns:
+        zarr array
+
+    """
+    zarr = _zarr()
+    if resume:
+        return zarr.open_array(path, mode='r+')
+
+    nodata = profile.get('nodata')
+    arr = zarr.open_array(
+        path, mode='w', shape=(profile['height'], profile['width']),
+        chunks=chunks, dtype=profile['dtype'],
+        fill_value=nodata if nodata is not None else 0)
+    arr.attrs.update({
+        'crs': profile['crs'].to_wkt() if profile.get('crs') else None,
+        'transform': list(profile['transform'])[:6],
+        'nodata': _attr(nodata),
+    })
+    if scaling is not None:
+        arr.attrs.update({'scale': _attr(scaling[0]), 'offset': _attr(scaling[1])})
+
+    return arr
+
+
+class ZarrWriter:
+    """Write tiles to the chunks of a Zarr store, journaling completed windows
+
+    Tiles aligned to the chunks are written by the thread that computed
+    them, each to its own chunk objects, so writes need no shared dataset
+    handle or lock. A chunk is on disk once its write returns, so windows
+    are recorded in the journal at each checkpoint without reopening the
+    store.
+
+    Parameters:
+        output: store path
+        profile: output profile
+        journal: journal of the run
+        chunks: chunk height and width, the shape of the planned tiles
+        interval: seconds between checkpoints
+        bar: optional click progressbar updated with the cells written
+        region: window of the full output covered by the store, see shard_tiles
+        scaling: scale and offset of quantized values
+
+    """
+
+    # process_tiles lets the worker threads call a concurrent writer
+    concurrent = True
+
+    def __init__(
+        self,
+        output: str,
+        profile: dict,
+        journal: Any,
+        chunks: tuple[int, int],
+        interval: float = 60.0,
+        bar: Any = None,
+        region: Optional[Window] = None,
+        scaling: Optional[tuple[float, float]] = None
+    ) -> None:
+        self.journal = journal
+        self.interval = interval
+        self.bar = bar
+        self.region = region
+        self.array = create_store(
+            output, profile, chunks, resume=journal.resuming, scaling=scaling)
+        self.dtype = np.dtype(profile['dtype'])
+        self._lock = threading.Lock()
+        self._pending: list[Window] = []
+        self._checkpointed = time.monotonic()
+
+    def __call__(self, result: np.ndarray, window: Window) -> None:
+        local = window
+        if self.region is not None:
+            local = Window(
+                window.col_off - self.region.col_off, window.row_off - self.region.row_off,
+                window.width, window.height)
+        rows, cols = local.toslices()
+        self.array[rows, cols] = result.astype(self.dtype, copy=False)
+        with self._lock:
+            self._pending.append(window)
+            if self.bar is not None:
+                self.bar.update(result.size)
+            if time.monotonic() - self._checkpointed > self.interval:
+                self.journal.record(self._pending)
+                self._pending = []
+                self._checkpointed = time.monotonic()
+
+    def __enter__(self) -> ZarrWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(completed=exc_type is None)
+
+    def close(self, completed: bool = True) -> None:
+        """Record the remaining windows and close the journal, removing it when the run completed"""
+        with self._lock:
+            self.journal.record(self._pending)
+            self._pending = []
+        self.journal.close(remove=completed)
+
+
+def to_gtiff(store: str, output: str, bar: Any = None, **kwargs: Any) -> None:
+    """Convert a Zarr store written by ZarrWriter to a GTiff
+
+    Parameters:
+        store: store path
+        output: GTiff path
+        bar: optional click progressbar updated with the cells copied
+        kwargs: creation options, defaults to 256 cell deflate tiles
+
+    """
+    arr = _zarr().open_array(store, mode='r')
+    attrs = arr.attrs
+    profile = {
+        'driver': 'GTiff',
+        'width': arr.shape[1],
+        'height': arr.shape[0],
+        'count': 1,
+        'dtype': arr.dtype.name,
+        'nodata': attrs.get('nodata'),
+        'crs': attrs.get('crs'),
+        'transform': rasterio.Affine(*attrs['transform']),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+        'bigtiff': 'yes',
+    }
+    profile.update(kwargs)
+
+    rows = arr.chunks[0]
+    with rasterio.open(output, 'w', **profile) as dst:
+        if 'scale' in attrs:
+            dst.scales, dst.offsets = (attrs['scale'],), (attrs['offset'],)
+        for row in range(0, arr.shape[0], rows):
+            data = arr[row:row + rows, :]
+            dst.write(data, 1, window=Window(0, row, arr.shape[1], data.shape[0]))
+            if bar is not None:
+                bar.update(data.size)
@@ -1,5 +1,9 @@
 from pkg_resources import iter_entry_points
 
+import numpy as np
+import pytest
+import rasterio
+
 from click.testing import CliRunner
 
 from rasterio.rio.main import main_group
@@ -122,3 +126,116 @@ def test_uncertainty():
     runner = CliRunner()
     result = runner.invoke(main_group, ['uncertainty', '--help'])
     assert result.exit_code == 0
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+@pytest.fixture
+def inputs(tmpdir):
+    """Write a DEM with a hole of nodata and a categorical raster of two classes"""
+    with rasterio.open(testdem) as src:
+        dem = src.read(1)
+        profile = src.profile
+    valid = dem > src.nodata
+    holed = dem.copy()
+    holed[100:110, 100:110] = src.nodata
+    categories = np.where(dem > np.median(dem[valid]), 2, 1).astype('int32')
+    categories[~valid] = -1
+
+    paths = {'holed': str(tmpdir.join('holed.tif')), 'categories': str(tmpdir.join('cat.tif'))}
+    with rasterio.open(paths['holed'], 'w', **profile) as dst:
+        dst.write(holed, 1)
+    with rasterio.open(paths['categories'], 'w', **dict(profile, dtype='int32', nodata=-1)) as dst:
+        dst.write(categories, 1)
+
+    return dict(paths, dem=np.where(valid, dem, np.nan), valid=valid)
+
+
+def _run(runner, tmpdir, args):
+    output = str(tmpdir.join('out.tif'))
+    result = runner.invoke(main_group, args + [output, '-j', '2'], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(output) as src:
+        return src.read(1, masked=True)
+
+
+@pytest.mark.parametrize('command', ['slope', 'aspect', 'curvature', 'mad', 'std'])
+def test_run_terrain(command, inputs, tmpdir, runner):
+    out = _run(runner, tmpdir, [command, testdem])
+    assert out.shape == inputs['dem'].shape
+    assert out.count() > 0
+
+
+def test_run_fillnodata(inputs, tmpdir, runner):
+    out = _run(runner, tmpdir, ['fillnodata', inputs['holed']])
+    assert not out.mask[100:110, 100:110].any()
+
+
+def test_run_difference(inputs, tmpdir, runner):
+    out = _run(runner, tmpdir, ['difference', testdem, testdem])
+    assert np.allclose(out[inputs['valid']], 0)
+
+
+def test_run_difference_striped_intersection(inputs, tmpdir, runner):
+    cropped = str(tmpdir.join('cropped.tif'))
+    with rasterio.open(testdem) as src:
+        window = rasterio.windows.Window(40, 30, src.width - 100, src.height - 60)
+        profile = dict(
+            src.profile, width=window.width, height=window.height,
+            transform=src.window_transform(window))
+        with rasterio.open(cropped, 'w', **profile) as dst:
+            dst.write(src.read(1, window=window), 1)
+
+    output = str(tmpdir.join('out.tif'))
+    result = runner.invoke(
+        main_group, ['difference', testdem, cropped, output, '--out-striped', '-j', '2'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(output) as src:
+        assert (src.height, src.width) == (window.height, window.width)
+        assert src.block_shapes[0][1] == window.width
+        out = src.read(1, masked=True)
+    assert np.allclose(out[inputs['valid'][window.toslices()]], 0)
+
+
+def test_run_uncertainty(inputs, tmpdir, runner):
+    out = _run(runner, tmpdir, ['uncertainty', testdem, testdem])
+    dem = inputs['dem'][inputs['valid']]
+    assert np.allclose(out[inputs['valid']], np.sqrt(2) * dem)
+
+
+def test_run_extract(inputs, tmpdir, runner):
+    output = str(tmpdir.join('out.tif'))
+    result = runner.invoke(
+        main_group, ['extract', testdem, inputs['categories'], output, '-c', '2', '-j', '2'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(output) as src, rasterio.open(inputs['categories']) as cat:
+        out = src.read(1)
+        lower = cat.read(1) == 1
+    assert (out[lower] == 0).all()
+
+
+def test_run_slice(inputs, tmpdir, runner):
+    minimum = float(np.nanmedian(inputs['dem']))
+    out = _run(runner, tmpdir, ['slice', testdem, '--minimum', str(minimum)])
+    assert (out.filled(0) == (inputs['dem'] >= minimum)).all()
+
+
+def test_run_threshold(inputs, tmpdir, runner):
+    output = str(tmpdir.join('out.tif'))
+    result = runner.invoke(
+        main_group, ['threshold', testdem, testdem, output, '0.5', '-j', '2'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(output) as src:
+        out = src.read(1)
+    # positive elevations exceed half of themselves
+    assert (out[inputs['dem'] > 0] == 1).all()
+
+
+def test_run_copynodata(inputs, tmpdir, runner):
+    out = _run(runner, tmpdir, ['copynodata', testdem, inputs['holed']])
+    assert out.mask[100:110, 100:110].all()
+    assert not out.mask[inputs['valid']][:100].any()
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.windows import Window
+from rasterio.rio.main import main_group
+
+import rio_terrain as rt
+from rio_terrain.core import cog, engine
+
+
+testdem = 'rio_terrain/tests/data/dem_5m.tif'
+
+
+def test_decimate():
+    arr = np.array([[1.0, 3.0, 5.0], [np.nan, 5.0, -9999.0]])
+    assert np.array_equal(cog.decimate(arr, 2, nodata=-9999.0), [[3.0, 5.0]])
+    assert np.array_equal(cog.decimate(arr, 2, average=False), [[1.0, 5.0]])
+    assert cog.overview_factors(1400, 920, 256) == [2, 4, 8]
+
+
+def test_overview_writer_decimates_misaligned_overviews(tmpdir):
+    arr = np.random.default_rng(0).random((64, 64)).astype('float32')
+    profile = {
+        'driver': 'GTiff', 'width': 64, 'height': 64, 'count': 1, 'dtype': 'float32',
+        'nodata': None, 'tiled': True, 'blockxsize': 16, 'blockysize': 16,
+        'transform': rasterio.transform.from_origin(0, 64, 1, 1)}
+    source = str(tmpdir.join('full.tif'))
+    with rasterio.open(source, 'w', **profile) as dst:
+        dst.write(arr, 1)
+
+    overviews = cog.OverviewWriter(str(tmpdir.join('staging')), profile)
+    assert overviews.factors == [2, 4]
+    # bands of 6 rows cover whole 1/2 overview cells but not 1/4 ones
+    for row in range(0, 64, 6):
+        window = Window(0, row, 64, min(6, 64 - row))
+        overviews(arr[window.toslices()], window)
+    overviews.finish(source)
+
+    for factor in overviews.factors:
+        with rasterio.open(overviews.path(factor)) as src:
+            assert np.allclose(src.read(1), cog.decimate(arr, factor))
+
+
+def test_slope_cog(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-b', '1'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2', '--cog',
+                     '--out-blocksize', '128'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not tmpdir.join('out.tif.cog').check()
+
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert src.overviews(1) == [2, 4, 8, 16]
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+        full = ref.read(1)
+        for factor in (2, 16):
+            overview = src.read(1, out_shape=(-(-src.height // factor), -(-src.width // factor)))
+            assert np.allclose(
+                overview, cog.decimate(full, factor, nodata=src.nodata), equal_nan=True)
+
+
+def test_resume_cog(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-b', '1'], catch_exceptions=False)
+    calls = []
+    with rasterio.open(testdem) as src:
+        res = (src.transform.a, src.transform.e)
+
+    def failing(arr):
+        calls.append(1)
+        if len(calls) > 10:
+            raise RuntimeError('interrupted')
+        return rt.slope(arr, res=res, neighbors=8)
+
+    def counting(arr):
+        calls.append(1)
+        return rt.slope(arr, res=res, neighbors=8)
+
+    with rasterio.open(testdem) as src:
+        for kernel, resume in ((failing, False), (counting, True)):
+            calls.clear()
+            profile = dict(src.profile, dtype='float32', count=1)
+            options = engine.RunOptions(cog=True, resume=resume, prefetch=0)
+            if kernel is failing:
+                with pytest.raises(RuntimeError):
+                    engine.run([src], kernel, profile, outfile, options, overlap=2)
+            else:
+                engine.run([src], kernel, profile, outfile, options, overlap=2)
+
+    # the first of the four rows of six tiles were journaled, the others are computed
+    assert len(calls) == 24 - 6
+    assert not tmpdir.join('out.tif.journal').check()
+    assert not tmpdir.join('out.tif.cog').check()
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+        overview = src.read(1, out_shape=(-(-src.height // 4), -(-src.width // 4)))
+        assert np.allclose(
+            overview, cog.decimate(ref.read(1), 4, nodata=src.nodata), equal_nan=True)
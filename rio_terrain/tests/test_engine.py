@@ -0,0 +1,720 @@
+import threading
+
+import numpy as np
+import pytest
+import rasterio
+import scipy.ndimage
+from rasterio.windows import Window
+from rasterio.rio.main import main_group
+
+import rio_terrain as rt
+from rio_terrain.core import engine
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+def make_tiles(shape, tile, overlap=0):
+    read_windows = rt.tile_grid(shape[1], shape[0], tile, tile, overlap=overlap)
+    write_windows = rt.tile_grid(shape[1], shape[0], tile, tile, overlap=0)
+    return read_windows, write_windows
+
+
+def test_process_tiles_matches_whole_array():
+    arr = np.random.default_rng(0).random((50, 70))
+    expected = rt.slope(arr)
+
+    for njobs, prefetch in ((1, 0), (1, 2), (3, 0)):
+        out = np.zeros_like(arr)
+
+        def reader(window):
+            return (arr[window.toslices()],)
+
+        def writer(result, window):
+            out[window.toslices()] = result
+
+        read_windows, write_windows = make_tiles(arr.shape, 16, overlap=2)
+        engine.process_tiles(
+            read_windows, write_windows, reader, rt.slope, writer,
+            njobs=njobs, trim_halo=True, prefetch=prefetch)
+        assert np.allclose(out, expected)
+
+
+def test_process_tiles_bounds_tiles_in_flight():
+    arr = np.ones((64, 64))
+    lock = threading.Lock()
+    counts = {'read': 0, 'written': 0, 'max': 0}
+
+    def reader(window):
+        with lock:
+            counts['read'] += 1
+            counts['max'] = max(counts['max'], counts['read'] - counts['written'])
+        return (arr[window.toslices()],)
+
+    def writer(result, window):
+        with lock:
+            counts['written'] += 1
+
+    read_windows, write_windows = make_tiles(arr.shape, 4)
+    engine.process_tiles(
+        read_windows, write_windows, reader, np.negative, writer, njobs=2, max_pending=3)
+    assert counts['written'] == 256
+    assert counts['max'] <= 3
+
+
+def test_plan_tiles_whole():
+    with rasterio.open(testdem) as src:
+        read_windows, write_windows = engine.plan_tiles(src, overlap=2, whole=True)
+        assert list(read_windows) == [Window(0, 0, src.width, src.height)]
+        assert list(write_windows) == [Window(0, 0, src.width, src.height)]
+
+
+def test_plan_tiles_max_memory():
+    with rasterio.open(testdem) as src:
+        # a 256 cell block per tile when the budget is tight, one tile when it is generous
+        _, write_windows = engine.plan_tiles(src, overlap=2, max_memory=1, temporaries=6)
+        assert len(list(write_windows)) == 2
+        _, write_windows = engine.plan_tiles(
+            src, overlap=2, max_memory=2**30, temporaries=6, ntiles=4)
+        assert list(write_windows) == [Window(0, 0, src.width, src.height)]
+
+    assert engine.tiles_in_flight(1, prefetch=1) == 2
+    assert engine.tiles_in_flight(4) == 8
+
+
+def make_striped(path, rows_per_strip=16):
+    with rasterio.open(testdem) as src:
+        profile = dict(src.profile, tiled=False, blockysize=rows_per_strip)
+        profile.pop('blockxsize')
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(src.read())
+
+
+def test_plan_bands_max_memory(tmpdir):
+    path = str(tmpdir.join('striped.tif'))
+    make_striped(path)
+    bytes_per_cell = 4 + 8 * 6
+
+    with rasterio.open(path) as src:
+        # 100 rows and the halo fit, whole strips give 96 rows per band
+        max_memory = 2 * src.width * bytes_per_cell * (100 + 2 * 2)
+        read_windows, write_windows = engine.plan_bands(
+            src, overlap=2, max_memory=max_memory, temporaries=6, ntiles=2)
+        assert write_windows[0].height == 96
+        assert read_windows[0].height == 96 + 2
+        assert read_windows[1].height == 96 + 2 * 2
+        assert 2 * src.width * bytes_per_cell * read_windows[1].height <= max_memory
+
+        # one strip when the budget is tight, the whole raster when it is generous
+        _, write_windows = engine.plan_bands(src, overlap=2, max_memory=1, temporaries=6)
+        assert write_windows[0].height == 16
+        _, write_windows = engine.plan_bands(src, overlap=2, max_memory=2**30, temporaries=6)
+        assert write_windows == [Window(0, 0, src.width, src.height)]
+
+
+def test_striped_slope_plans_bands(tmpdir, runner):
+    path = str(tmpdir.join('striped.tif'))
+    make_striped(path)
+
+    with rasterio.open(path) as src:
+        assert engine.is_striped(src)
+        read_windows, write_windows = engine.plan_tiles(src, blocks=1, overlap=2)
+        assert len(write_windows) == 5
+        assert all(w.width == src.width for w in read_windows)
+        assert all(w.height % 16 == 0 for w in write_windows[:-1])
+
+        # bands grow to the budget rather than to a square of strips
+        max_memory = 4 * src.width * (4 + 8 * 6) * (100 + 2 * 2)
+        read_windows, write_windows = engine.plan_tiles(
+            src, overlap=2, max_memory=max_memory, temporaries=6, ntiles=4)
+        assert [w.height for w in write_windows] == [96, 96, 38]
+        assert max(w.height for w in read_windows) == 96 + 2 * 2
+
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', path, outfile, '-b', '1', '-j', '2'], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_slope_concurrent_matches_inmemory(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2'], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_plan_tiles_snaps_to_output_blocks():
+    with rasterio.open('rio_terrain/tests/data/dem_5m.tif') as src:
+        profile = dict(src.profile)
+        out_blocks = engine.output_blocks(profile, blocksize=384)
+        assert out_blocks == (384, 384)
+        assert profile['blockxsize'] == profile['blockysize'] == 384
+
+        _, write_windows = engine.plan_tiles(src, blocks=1, overlap=2, out_blocks=out_blocks)
+        assert all(w.row_off % 384 == 0 and w.col_off % 384 == 0 for w in write_windows)
+        assert (write_windows[0].height, write_windows[0].width) == (384, 384)
+
+        out_blocks = engine.output_blocks(profile, tiled=False, blocksize=32)
+        assert out_blocks == (32, src.width)
+        assert not profile['tiled'] and 'blockxsize' not in profile
+        _, write_windows = engine.plan_tiles(src, blocks=1, overlap=2, out_blocks=out_blocks)
+        assert all(w.width == src.width and w.row_off % 32 == 0 for w in write_windows)
+
+
+def test_slope_out_blocksize(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    for args in (['--out-blocksize', '128'], ['--out-striped', '--out-blocksize', '16']):
+        result = runner.invoke(
+            main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2'] + args,
+            catch_exceptions=False)
+        assert result.exit_code == 0
+        with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+            assert src.block_shapes[0] == ((128, 128) if len(args) == 2 else (16, src.width))
+            assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+    result = runner.invoke(main_group, ['slope', testdem, outfile, '--out-blocksize', '100'])
+    assert result.exit_code == 2
+
+
+def test_set_codec():
+    profile = {'dtype': 'float32', 'compress': 'lzw', 'zlevel': 9}
+    assert engine.set_codec(profile, 'zstd', level=15, threads=0) == {
+        'dtype': 'float32', 'compress': 'zstd', 'predictor': 3, 'zstd_level': 15,
+        'num_threads': 'ALL_CPUS'}
+    assert engine.set_codec({'dtype': 'int32'}, 'lzw') == {'dtype': 'int32', 'compress': 'lzw'}
+    assert engine.set_codec(profile, 'lerc', max_z_error=0.01)['max_z_error'] == 0.01
+    with pytest.raises(ValueError):
+        engine.set_codec(profile, 'deflate', max_z_error=0.01)
+    with pytest.raises(ValueError):
+        engine.set_codec(profile, 'lerc', level=5)
+
+
+def test_slope_codecs(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    with rasterio.open(expected) as ref:
+        full = ref.read(1)
+    for args, exact in (
+            (['--codec', 'zstd', '--codec-level', '9', '--codec-threads', '2'], True),
+            (['--codec', 'lerc', '--max-z-error', '0.001'], False)):
+        result = runner.invoke(
+            main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2'] + args,
+            catch_exceptions=False)
+        assert result.exit_code == 0
+        with rasterio.open(outfile) as src:
+            assert src.compression.value == args[1].upper()
+            if exact:
+                assert np.array_equal(src.read(1), full, equal_nan=True)
+            else:
+                assert np.nanmax(np.abs(src.read(1) - full)) <= 0.001 * 1.01
+
+
+def test_codec_options_are_usage_errors(tmpdir, runner):
+    outfile = str(tmpdir.join('out.tif'))
+    for args, message in (
+            (['--codec', 'lzw', '--codec-level', '3'], '--codec-level applies'),
+            (['--max-z-error', '0.1'], '--max-z-error applies')):
+        result = runner.invoke(main_group, ['slope', testdem, outfile] + args)
+        assert result.exit_code == 2
+        assert message in result.output
+        assert not tmpdir.join('out.tif').check()
+
+
+def test_quantize():
+    arr = np.array([[0.004, 0.006, -1000.0], [np.nan, 1000.0, -9999.0]])
+    packed = engine.quantize(arr, 'int16', scale=0.01, missing=-9999.0)
+    assert packed.tolist() == [[0, 1, -32767], [-32768, 32767, -32768]]
+    packed = engine.quantize(arr, 'uint16', scale=0.01, offset=-1.0)
+    assert packed.tolist() == [[100, 101, 0], [65535, 65534, 0]]
+    with pytest.raises(ValueError):
+        engine.quantize(arr, 'int16', scale=0)
+
+
+def test_slope_quantize(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(
+        main_group, ['slope', testdem, expected, '-j', '0', '-u', 'degrees'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2', '-u', 'degrees',
+                     '--quantize', 'uint16', '--scale', '0.01', '--offset', '-1'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.dtypes[0] == 'uint16'
+        assert src.nodata == 65535
+        assert (src.scales, src.offsets) == ((0.01,), (-1.0,))
+        packed, full = src.read(1, masked=True), ref.read(1)
+        assert np.array_equal(packed.mask, np.isnan(full))
+        unpacked = packed.filled(0) * 0.01 - 1.0
+        assert np.allclose(unpacked[~packed.mask], full[~packed.mask], atol=0.005 + 1e-6)
+
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '--quantize', 'int16', '--scale', '0'])
+    assert result.exit_code == 2
+    assert '--scale' in result.output
+
+
+def test_slope_mask_band(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2', '--mask-band'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert engine.has_mask_band(src)
+        assert not engine.has_mask_band(ref)
+        full = ref.read(1)
+        assert np.array_equal(src.read_masks(1) == 0, np.isnan(full))
+        assert np.array_equal(src.read(1), full, equal_nan=True)
+
+    # inputs with a mask band are masked by it rather than by their nodata value
+    for path in (expected, outfile):
+        runner.invoke(
+            main_group, ['slope', path, path + '.slope.tif', '-b', '1', '-j', '2'],
+            catch_exceptions=False)
+    with rasterio.open(outfile + '.slope.tif') as src, \
+            rasterio.open(expected + '.slope.tif') as ref:
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_ordered_writer_coalesces_rows_in_order():
+    arr = np.arange(24 * 30).reshape(24, 30)
+    windows = list(rt.tile_grid(30, 24, 10, 8))
+    writes = []
+
+    def write(result, window):
+        writes.append((window, result.copy()))
+
+    with engine.OrderedWriter(write, windows) as writer:
+        for window in reversed(windows):
+            writer(arr[window.toslices()], window)
+
+    assert [window for window, _ in writes] == [
+        Window(0, 0, 30, 8), Window(0, 8, 30, 8), Window(0, 16, 30, 8)]
+    for window, result in writes:
+        assert np.array_equal(result, arr[window.toslices()])
+
+
+def test_ordered_writer_bounds_held_tiles():
+    arr = np.arange(320 * 320).reshape(320, 320)
+    windows = list(rt.tile_grid(320, 320, 10, 10))
+    out = np.zeros_like(arr)
+
+    def write(result, window):
+        out[window.toslices()] = result
+
+    # the first tile stalls, all others arrive, four rows of 32 tiles are held at most
+    writer = engine.OrderedWriter(write, windows)
+    peak = 0
+    for window in windows[1:] + windows[:1]:
+        writer._add(arr[window.toslices()], window)
+        peak = max(peak, sum(len(tiles) for tiles in writer._pending.values()))
+    writer.close()
+
+    assert peak <= 4 * 32 + 1
+    assert not writer._pending
+    assert np.array_equal(out, arr)
+
+
+def test_band_reader_per_thread():
+    with rasterio.open(testdem) as src:
+        expected = src.read(1)
+        expected[expected <= src.nodata + 1] = np.nan
+        out = np.zeros_like(expected)
+        threads = set()
+
+        def kernel(arr):
+            threads.add(threading.current_thread().name)
+            return arr
+
+        def writer(result, window):
+            out[window.toslices()] = result
+
+        read_windows, write_windows = make_tiles(src.shape, 64)
+        with engine.BandReader(src, per_thread=True) as reader:
+            engine.process_tiles(read_windows, write_windows, reader, kernel, writer, njobs=3)
+            assert 1 <= len(reader._handles) <= 3
+        assert reader._handles == []
+        assert threading.current_thread().name not in threads
+        assert np.array_equal(out, expected, equal_nan=True)
+
+
+def test_process_backend_matches_threads():
+    with rasterio.open(testdem) as src:
+        outputs = []
+        for backend, per_thread in (('thread', False), ('process', False), ('process', True)):
+            out = np.zeros(src.shape)
+
+            def writer(result, window):
+                out[window.toslices()] = result
+
+            read_windows, write_windows = make_tiles(src.shape, 64, overlap=2)
+            with engine.BandReader(src, per_thread=per_thread) as reader:
+                engine.process_tiles(
+                    read_windows, write_windows, reader, rt.slope, writer,
+                    njobs=2, trim_halo=True, backend=backend)
+            outputs.append(out)
+
+        assert np.array_equal(outputs[0], outputs[1], equal_nan=True)
+        assert np.array_equal(outputs[0], outputs[2], equal_nan=True)
+
+
+def test_dask_backend_matches_threads(tmpdir, runner):
+    pytest.importorskip('dask.array')
+    with rasterio.open(testdem) as src:
+        outputs = []
+        for backend in ('thread', 'dask'):
+            out = np.zeros(src.shape)
+
+            def writer(result, window):
+                out[window.toslices()] = result
+
+            read_windows, write_windows = map(list, make_tiles(src.shape, 64, overlap=2))
+            # a resumed run covers only some of the tiles
+            with engine.BandReader(src) as reader:
+                engine.process_tiles(
+                    read_windows[3:], write_windows[3:], reader, rt.slope, writer,
+                    njobs=2, trim_halo=True, backend=backend)
+            outputs.append(out)
+
+        assert np.array_equal(outputs[0], outputs[1], equal_nan=True)
+
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['std', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['std', testdem, outfile, '-b', '1', '-j', '2', '--backend', 'dask'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert np.allclose(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_buffer_pool_reuses_arrays():
+    pool = engine.BufferPool()
+    arr = pool.acquire((8, 8), 'float32')
+    pool.release(arr)
+    assert pool.acquire((8, 8), 'float32') is arr
+    assert pool.acquire((8, 8), 'float32') is not arr
+    assert pool.allocated == 2
+
+    # arrays sharing memory with a result in use are not reused
+    pool.release(arr, keep=arr[1:, 1:])
+    assert pool.acquire((8, 8), 'float32') is not arr
+
+
+def test_band_reader_reads_into_pool():
+    with rasterio.open(testdem) as src:
+        expected = src.read(1)
+        expected[expected <= src.nodata + 1] = np.nan
+        out = np.zeros_like(expected)
+
+        def writer(result, window):
+            out[window.toslices()] = result
+
+        reader = engine.BandReader(src)
+        read_windows, write_windows = make_tiles(src.shape, 64)
+        engine.process_tiles(read_windows, write_windows, reader, np.negative, writer)
+        # 24 tiles of four shapes, each shape with a nodata mask
+        assert reader.pool.allocated == 8
+        assert np.array_equal(out, -expected, equal_nan=True)
+
+
+def test_shard_tiles_splits_rows():
+    read_windows, write_windows = map(list, make_tiles((50, 40), 10, overlap=2))
+    regions = []
+    for index in range(3):
+        _, shard_windows, region = engine.shard_tiles(read_windows, write_windows, (index, 3))
+        assert all(window.row_off >= region.row_off for window in shard_windows)
+        regions.append((region.row_off, region.height))
+    assert regions == [(0, 10), (10, 20), (30, 20)]
+
+
+def test_shard_more_than_rows_is_a_usage_error(tmpdir, runner):
+    result = runner.invoke(
+        main_group, ['slope', testdem, str(tmpdir.join('out.tif')), '--shard', '0/1000'])
+    assert result.exit_code == 2
+    assert '--shard' in result.output
+    assert 'Cannot split 1000 shards' in result.output
+
+
+def test_sharded_slope_matches_single_run(tmpdir, runner):
+    infile = str(tmpdir.join('dem.tif'))
+    with rasterio.open(testdem) as src:
+        profile = src.profile
+        profile.update(blockxsize=64, blockysize=64, tiled=True)
+        with rasterio.open(infile, 'w', **profile) as dst:
+            dst.write(src.read())
+
+    expected = str(tmpdir.join('expected.tif'))
+    runner.invoke(main_group, ['slope', infile, expected, '-b', '1'], catch_exceptions=False)
+
+    fragments = []
+    for index in range(3):
+        fragments.append(str(tmpdir.join('slope_{}.tif'.format(index))))
+        result = runner.invoke(
+            main_group,
+            ['slope', infile, fragments[-1], '-b', '1', '--shard', '{}/3'.format(index)],
+            catch_exceptions=False)
+        assert result.exit_code == 0
+
+    outfile = str(tmpdir.join('merged.tif'))
+    result = runner.invoke(
+        main_group, ['terrain-merge'] + fragments + [outfile], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.transform == ref.transform
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_journal_resumes_interrupted_run(tmpdir):
+    outfile = str(tmpdir.join('out.tif'))
+    with rasterio.open(testdem) as src:
+        expected = rt.slope(src.read(1).astype('float64'))
+        profile = src.profile
+        read_windows, write_windows = map(list, make_tiles(src.shape, 64, overlap=2))
+        calls = []
+
+        def failing(arr):
+            calls.append(1)
+            if len(calls) > 10:
+                raise RuntimeError('interrupted')
+            return rt.slope(arr)
+
+        journal = engine.Journal(outfile, write_windows)
+        with pytest.raises(RuntimeError):
+            with engine.BandReader(src, nan_nodata=False) as reader, \
+                    engine.JournalWriter(outfile, profile, journal, interval=0) as write, \
+                    engine.OrderedWriter(write, write_windows) as writer:
+                engine.process_tiles(
+                    read_windows, write_windows, reader, failing, writer, trim_halo=True)
+
+        # a journal only resumes the plan it was written for
+        with pytest.raises(ValueError):
+            engine.Journal(outfile, write_windows[:-1], resume=True)
+
+        # the first tile row of six tiles was completed
+        journal = engine.Journal(outfile, write_windows, resume=True)
+        remaining_read, remaining_write = journal.remaining(read_windows, write_windows)
+        assert len(remaining_write) == len(write_windows) - 6
+
+        with engine.BandReader(src, nan_nodata=False) as reader, \
+                engine.JournalWriter(outfile, profile, journal) as write, \
+                engine.OrderedWriter(write, remaining_write) as writer:
+            engine.process_tiles(
+                remaining_read, remaining_write, reader, rt.slope, writer, trim_halo=True)
+
+    assert not tmpdir.join('out.tif.journal').check()
+    with rasterio.open(outfile) as src:
+        assert np.allclose(src.read(1), expected, equal_nan=True)
+
+
+def test_run_failing_before_output_leaves_no_journal(tmpdir, monkeypatch):
+    outfile = str(tmpdir.join('out.tif'))
+
+    def failing(*args, **kwargs):
+        raise RuntimeError('interrupted')
+
+    monkeypatch.setattr(engine, 'empty_tiles', failing)
+    with rasterio.open(testdem) as src:
+        profile = dict(src.profile, dtype='float32', count=1)
+        with pytest.raises(RuntimeError):
+            engine.run(
+                [src], rt.slope, profile, outfile, engine.RunOptions(skip_empty=True),
+                overlap=2)
+
+    assert not tmpdir.join('out.tif.journal').check()
+    assert not tmpdir.join('out.tif').check()
+
+
+def make_sparse(path):
+    """256 x 256 raster of 64 cell blocks with data in the upper left 2 x 2 blocks"""
+    profile = {
+        'driver': 'GTiff', 'width': 256, 'height': 256, 'count': 1, 'dtype': 'float32',
+        'nodata': -9999.0, 'tiled': True, 'blockxsize': 64, 'blockysize': 64,
+        'sparse_ok': True, 'crs': 'EPSG:32610',
+        'transform': rasterio.transform.from_origin(0, 256, 1, 1)}
+    arr = np.random.default_rng(0).random((128, 128)).astype('float32')
+    arr[100:, 100:] = -9999.0
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(arr, 1, window=Window(0, 0, 128, 128))
+
+
+def test_scan_tiles_classifies_sparse_blocks(tmpdir):
+    path = str(tmpdir.join('sparse.tif'))
+    make_sparse(path)
+    with rasterio.open(path) as src:
+        codes = engine.scan_blocks(src)
+        assert codes.tolist() == [
+            [engine.FULL, engine.FULL, engine.EMPTY, engine.EMPTY],
+            [engine.FULL, engine.PARTIAL, engine.EMPTY, engine.EMPTY],
+            [engine.EMPTY] * 4,
+            [engine.EMPTY] * 4]
+
+        # halos reach into neighbouring blocks
+        read_windows, _ = make_tiles(src.shape, 64, overlap=2)
+        classes = engine.scan_tiles([src], read_windows)
+        assert classes.count(engine.EMPTY) == 16 - 4 - 3 - 2
+
+
+def test_process_tiles_skips_empty_tiles(tmpdir):
+    path = str(tmpdir.join('sparse.tif'))
+    make_sparse(path)
+    with rasterio.open(path) as src:
+        outputs = []
+        for skip in (False, True):
+            out = np.zeros(src.shape)
+            calls = []
+
+            def kernel(arr):
+                calls.append(arr.shape)
+                return rt.slope(arr)
+
+            def writer(result, window):
+                out[window.toslices()] = result
+
+            read_windows, write_windows = map(list, make_tiles(src.shape, 64, overlap=2))
+            empty = engine.empty_tiles([src], read_windows, write_windows) if skip else None
+            with engine.BandReader(src) as reader:
+                engine.process_tiles(
+                    read_windows, write_windows, reader, kernel, writer,
+                    trim_halo=True, empty=empty)
+            outputs.append((out, len(calls)))
+
+    assert np.array_equal(outputs[0][0], outputs[1][0], equal_nan=True)
+    assert outputs[0][1] == 16
+    # nine tiles with data, and one empty tile for each read shape and halo,
+    # the right column, the bottom row and the three corners
+    assert outputs[1][1] == 9 + 5
+
+
+def test_process_tiles_fills_empty_edge_tiles_with_halo(tmpdir):
+    path = str(tmpdir.join('sparse.tif'))
+    make_sparse(path)
+
+    def kernel(arr):
+        # pure, but the result depends on where the tile edges cut the halo
+        return scipy.ndimage.uniform_filter(
+            np.isnan(arr).astype('float64'), size=5, mode='constant')
+
+    with rasterio.open(path) as src:
+        outputs = []
+        for skip in (False, True):
+            out = np.zeros(src.shape)
+
+            def writer(result, window):
+                out[window.toslices()] = result
+
+            # first and last tiles in a row read the same shape, with halos on opposite sides
+            read_windows, write_windows = map(list, make_tiles(src.shape, 64, overlap=2))
+            empty = engine.empty_tiles([src], read_windows, write_windows) if skip else None
+            with engine.BandReader(src) as reader:
+                engine.process_tiles(
+                    read_windows, write_windows, reader, kernel, writer,
+                    trim_halo=True, empty=empty)
+            outputs.append(out)
+
+        assert empty
+    assert np.array_equal(outputs[0], outputs[1])
+
+
+def test_process_tiles_prefetch_reads_empty_tiles_on_io_thread(tmpdir):
+    path = str(tmpdir.join('sparse.tif'))
+    make_sparse(path)
+    with rasterio.open(path) as src:
+        out = np.zeros(src.shape)
+        threads = set()
+
+        def writer(result, window):
+            out[window.toslices()] = result
+
+        read_windows, write_windows = map(list, make_tiles(src.shape, 64, overlap=2))
+        empty = engine.empty_tiles([src], read_windows, write_windows)
+        with engine.BandReader(src) as band_reader:
+            def reader(window):
+                threads.add(threading.current_thread())
+                return band_reader(window)
+
+            engine.process_tiles(
+                read_windows, write_windows, reader, rt.slope, writer,
+                trim_halo=True, prefetch=2, empty=empty)
+            expected = rt.slope(band_reader(Window(0, 0, src.width, src.height))[0])
+
+    # the shared handle is only read from the prefetch thread
+    assert len(threads) == 1
+    assert threading.main_thread() not in threads
+    assert np.array_equal(out, expected, equal_nan=True)
+
+
+def test_order_tiles_along_curves():
+    read_windows, write_windows = map(list, make_tiles((40, 40), 10))
+    for order in ('zorder', 'hilbert'):
+        ordered_read, ordered_write = engine.order_tiles(read_windows, write_windows, order)
+        assert sorted(ordered_write, key=lambda w: (w.row_off, w.col_off)) == write_windows
+        assert ordered_read == ordered_write
+    # consecutive tiles along a Hilbert curve are neighbours
+    for w0, w1 in zip(ordered_write, ordered_write[1:]):
+        assert abs(w0.row_off - w1.row_off) + abs(w0.col_off - w1.col_off) == 10
+
+
+def test_gdal_cache_bytes_without_sysconf(monkeypatch):
+    monkeypatch.delattr(engine.os, 'sysconf', raising=False)
+    monkeypatch.delenv('GDAL_CACHEMAX', raising=False)
+    assert engine._gdal_cache_bytes() == engine.GDAL_CACHE_DEFAULT
+    monkeypatch.setenv('GDAL_CACHEMAX', '10%')
+    assert engine._gdal_cache_bytes() == engine.GDAL_CACHE_DEFAULT
+    monkeypatch.setenv('GDAL_CACHEMAX', '256')
+    assert engine._gdal_cache_bytes() == 256 * 2**20
+
+
+def test_read_stats_counts_decodes():
+    with rasterio.open(testdem) as src:
+        block = src.block_shapes[0]
+        stats = engine.ReadStats(cache_bytes=0)
+        reader = engine.BandReader(src, stats=stats)
+        reader(Window(0, 0, 10, 10))
+        reader(Window(5, 5, 10, 10))
+        assert stats.cells == 200
+        assert stats.decodes == 2
+
+        stats = engine.ReadStats(cache_bytes=block[0] * block[1] * 4)
+        reader = engine.BandReader(src, stats=stats)
+        reader(Window(0, 0, 10, 10))
+        reader(Window(5, 5, 10, 10))
+        assert stats.decodes == 1
+        assert stats.amplification() == (200 / (src.width * src.height), 1.0)
+
+
+def test_row_band_reader_reads_rows_once():
+    with rasterio.open(testdem) as src:
+        with engine.BandReader(src) as reader:
+            expected = rt.slope(reader(Window(0, 0, src.width, src.height))[0])
+        out = np.zeros(src.shape)
+
+        def writer(result, window):
+            out[window.toslices()] = result
+
+        read_windows, write_windows = engine.plan_bands(src, overlap=2, rows=40)
+        assert all(window.width == src.width for window in read_windows)
+        stats = engine.ReadStats()
+        with engine.RowBandReader(src, halo=2, stats=stats) as reader:
+            engine.process_tiles(
+                read_windows, write_windows, reader, rt.slope, writer,
+                njobs=2, trim_halo=True)
+
+        assert stats.cells == src.width * src.height
+        assert np.array_equal(out, expected, equal_nan=True)
@@ -0,0 +1,67 @@
+import json
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.rio.main import main_group
+
+from rio_terrain.core import manifest
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+def test_parse_tasks():
+    assert manifest.parse_tasks(None, 3) == [0, 1, 2]
+    assert manifest.parse_tasks('0-2,5', 6) == [0, 1, 2, 5]
+    with pytest.raises(ValueError):
+        manifest.parse_tasks('4-6', 6)
+
+
+def test_plan_only_and_worker_match_single_run(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-b', '1'], catch_exceptions=False)
+
+    outfile = str(tmpdir.join('out.tif'))
+    plan = str(tmpdir.join('plan.json'))
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '--plan-only', plan],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with open(plan) as f:
+        tasks = json.load(f)['tasks']
+    assert len(tasks) == 2
+
+    # an incomplete run cannot be merged
+    runner.invoke(main_group, ['terrain-worker', plan, '--tasks', '0'], catch_exceptions=False)
+    with pytest.raises(ValueError):
+        runner.invoke(
+            main_group, ['terrain-worker', plan, '--tasks', '0', '--merge'],
+            catch_exceptions=False)
+
+    result = runner.invoke(
+        main_group, ['terrain-worker', plan, '--tasks', '1', '--merge'], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.transform == ref.transform
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_quantized_plan_round_trips(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    plan = str(tmpdir.join('plan.json'))
+    args = ['-b', '1', '--quantize', 'int16', '--scale', '0.01']
+    runner.invoke(main_group, ['slope', testdem, expected] + args, catch_exceptions=False)
+    runner.invoke(
+        main_group, ['slope', testdem, outfile, '--plan-only', plan] + args, catch_exceptions=False)
+    with open(plan) as f:
+        assert json.load(f)['params']['kernel']['kernel'] == 'rio_terrain.core.terrain:slope'
+
+    result = runner.invoke(
+        main_group, ['terrain-worker', plan, '--merge'], catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.dtypes[0] == 'int16'
+        assert src.scales == (0.01,)
+        assert np.array_equal(src.read(1), ref.read(1))
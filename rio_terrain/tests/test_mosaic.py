@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.rio.main import main_group
+from rasterio.windows import Window
+
+from rio_terrain.core import mosaic, tilefiles
+
+
+testdem = 'rio_terrain/tests/data/dem_5m.tif'
+
+
+@pytest.fixture
+def sources(tmpdir):
+    """Split the 920 x 1400 test raster into 300 x 400 cell source files"""
+    directory = tmpdir.mkdir('sources')
+    with rasterio.open(testdem) as src:
+        for row in range(0, src.height, 300):
+            for col in range(0, src.width, 400):
+                window = Window(col, row, min(400, src.width - col), min(300, src.height - row))
+                profile = dict(
+                    src.profile, width=int(window.width), height=int(window.height),
+                    transform=src.window_transform(window), blockxsize=128, blockysize=128)
+                path = tilefiles.tile_path(str(directory), window)
+                with rasterio.open(path, 'w', **profile) as dst:
+                    dst.write(src.read(1, window=window), 1)
+        tilefiles.write_vrt(str(tmpdir.join('mosaic.vrt')), src.profile, str(directory))
+
+    return directory
+
+
+def test_mosaic_read(sources, tmpdir):
+    with rasterio.open(testdem) as ref:
+        expected = ref.read(1)
+        for path in (str(sources), str(tmpdir.join('mosaic.vrt'))):
+            with mosaic.open_mosaic(path, max_open=2) as src:
+                assert (src.height, src.width) == (ref.height, ref.width)
+                assert src.transform == ref.transform
+                assert src.nodata == ref.nodata
+                assert len(src.index.paths) == 4 * 4
+                assert np.array_equal(src.read(1), expected)
+
+                # a window across four sources reads only those, keeping two open
+                window = Window(350, 250, 100, 100)
+                assert len(src.index.query(window)) == 4
+                opens = src.cache.opens
+                assert np.array_equal(
+                    src.read(1, window=window), ref.read(1, window=window))
+                assert src.cache.opens == opens + 4
+                assert len(src.cache._handles) == 2
+
+
+def test_mosaic_rejects_nonaligned(sources):
+    path = str(sources.join('tile-r0000000-c0000000.tif'))
+    with rasterio.open(path, 'r+') as dst:
+        dst.transform = dst.transform * rasterio.Affine.translation(0.5, 0)
+    with pytest.raises(ValueError):
+        mosaic.open_mosaic(str(sources))
+
+
+def test_mosaic_inputs(sources, tmpdir):
+    path = str(sources.join('tile-r0000000-c0000000.tif'))
+    with mosaic.open_mosaic(path) as src, rasterio.open(path) as ref:
+        assert len(src.index.paths) == 1
+        assert (src.height, src.width) == (ref.height, ref.width)
+        assert np.array_equal(src.read(1), ref.read(1))
+
+    # a file that is neither text nor a GeoTIFF
+    binary = tmpdir.join('sources.bin')
+    binary.write_binary(b'\xff\xfe\x00\x80')
+    with pytest.raises(ValueError, match='sources.bin'):
+        mosaic.open_mosaic(str(binary))
+
+
+def test_slope_mosaic(sources, tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    for i, args in enumerate((
+            [str(sources), '--max-open', '2'],
+            [str(tmpdir.join('mosaic.vrt')), '-j', '2', '--parallel-reads'])):
+        outfile = str(tmpdir.join('out{}.tif'.format(i)))
+        result = runner.invoke(
+            main_group, ['slope'] + args[:1] + [outfile, '-b', '1', '--mosaic'] + args[1:],
+            catch_exceptions=False)
+        assert result.exit_code == 0
+        with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+            assert src.driver == 'GTiff'
+            assert src.transform == ref.transform
+            assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_slope_mosaic_striped_sources(sources, tmpdir, runner):
+    striped = tmpdir.mkdir('striped')
+    for path in sources.listdir():
+        with rasterio.open(str(path)) as src:
+            profile = dict(src.profile, tiled=False, blockysize=1)
+            profile.pop('blockxsize')
+            with rasterio.open(str(striped.join(path.basename)), 'w', **profile) as dst:
+                dst.write(src.read(1), 1)
+
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    with mosaic.open_mosaic(str(striped)) as src:
+        assert not src.profile['tiled']
+        assert 'blockxsize' not in src.profile
+    result = runner.invoke(
+        main_group, ['slope', str(striped), outfile, '-j', '2', '--mosaic'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
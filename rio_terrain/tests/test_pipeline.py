@@ -0,0 +1,79 @@
+import fiona
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.rio.main import main_group
+
+from rio_terrain.core import pipeline
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+def test_slope_matches_command(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-b', '1'], catch_exceptions=False)
+    with rasterio.open(testdem) as src, rasterio.open(expected) as ref:
+        out = pipeline.slope(src, blocks=1, njobs=2)
+        assert out.name.startswith('/vsimem/')
+        assert out.block_shapes == src.block_shapes
+        assert out.transform == ref.transform
+        assert np.array_equal(out.read(1), ref.read(1), equal_nan=True)
+        pipeline.discard(out)
+
+        # a path, including a /vsimem/ one, or a MemoryFile may be given
+        with MemoryFile() as memfile:
+            out = pipeline.slope(src, dst=memfile, blocks=1)
+            assert np.array_equal(out.read(1), ref.read(1), equal_nan=True)
+            out.close()
+
+
+def test_chain_in_memory(tmpdir, runner):
+    shifted = str(tmpdir.join('shifted.tif'))
+    with rasterio.open(testdem) as src:
+        profile = src.profile
+        arr = src.read(1)
+    arr[arr > src.nodata + 1] += np.linspace(0, 4, arr.shape[1], dtype='float32')[
+        np.nonzero(arr > src.nodata + 1)[1]]
+    with rasterio.open(shifted, 'w', **profile) as dst:
+        dst.write(arr, 1)
+
+    # the chain of commands on disk
+    paths = {name: str(tmpdir.join(name + '.tif')) for name in ('diff', 'changed', 'labels')}
+    runner.invoke(
+        main_group, ['difference', testdem, shifted, paths['diff']], catch_exceptions=False)
+    runner.invoke(
+        main_group, ['threshold', paths['diff'], paths['diff'], paths['changed'], '0.5'],
+        catch_exceptions=False)
+    runner.invoke(main_group, ['label', paths['changed'], paths['labels']], catch_exceptions=False)
+    bounds = str(tmpdir.join('bounds.gpkg'))
+    runner.invoke(
+        main_group, ['labelbounds', paths['labels'], bounds, '--intensity', paths['diff']],
+        catch_exceptions=False)
+
+    with rasterio.open(testdem) as t0, rasterio.open(shifted) as t1:
+        diff = pipeline.difference(t0, t1)
+        ones = pipeline.run(np.abs, diff, dst='/vsimem/ones.tif')
+        changed = pipeline.threshold(diff, diff, 0.5)
+        labels = pipeline.label(changed)
+        features = pipeline.labelbounds(labels, intensity=diff)
+
+        for name, dataset in (('diff', diff), ('changed', changed), ('labels', labels)):
+            with rasterio.open(paths[name]) as ref:
+                assert dataset.transform == ref.transform
+                assert np.array_equal(dataset.read(1), ref.read(1), equal_nan=True)
+        assert np.array_equal(ones.read(1), np.abs(diff.read(1)), equal_nan=True)
+        assert len(features) == labels.read(1).max()
+        assert all(f['properties']['max'] >= f['properties']['min'] for f in features)
+        with fiona.open(bounds) as ref:
+            assert [
+                (f['properties']['id'], f['properties']['min'], f['properties']['max'])
+                for f in ref
+            ] == [
+                (f['properties']['id'], f['properties']['min'], f['properties']['max'])
+                for f in features
+            ]
+
+        for dataset in (diff, ones, changed, labels):
+            pipeline.discard(dataset)
+        assert not rasterio.shutil.exists('/vsimem/ones.tif')
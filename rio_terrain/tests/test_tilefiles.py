@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.rio.main import main_group
+
+import rio_terrain as rt
+from rio_terrain.core import engine
+
+
+testdem = 'rio_terrain/tests/data/dem_5m.tif'
+
+
+def test_slope_tile_outputs(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.vrt'))
+    tiles = str(tmpdir.join('tiles'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '-j', '2', '--tile-outputs', tiles],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not tmpdir.join('out.vrt.journal').check()
+
+    # a file per 256 cell tile of the 920 x 1400 raster
+    names = sorted(os.listdir(tiles))
+    assert len(names) == 4 * 6
+    assert names[0] == 'tile-r0000000-c0000000.tif'
+
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert src.driver == 'VRT'
+        assert src.transform == ref.transform
+        assert src.crs == ref.crs
+        assert src.nodata == ref.nodata
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_tile_outputs_ignore_stale_tiles(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.vrt'))
+    tiles = tmpdir.mkdir('tiles')
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+
+    # a tile left by an earlier run with other tiles
+    with rasterio.open(expected) as ref:
+        profile = dict(ref.profile, width=100, height=100)
+        with rasterio.open(str(tiles.join('tile-r0000000-c0000100.tif')), 'w', **profile) as dst:
+            dst.write(np.zeros((100, 100), dtype=profile['dtype']), 1)
+
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '--tile-outputs', str(tiles)],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert len(src.files) == 1 + 4 * 6
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_resume_tile_outputs(tmpdir, runner):
+    expected = str(tmpdir.join('expected.tif'))
+    outfile = str(tmpdir.join('out.vrt'))
+    tiles = str(tmpdir.join('tiles'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    calls = []
+    with rasterio.open(testdem) as src:
+        res = (src.transform.a, src.transform.e)
+
+    def failing(arr):
+        calls.append(1)
+        if len(calls) > 10:
+            raise RuntimeError('interrupted')
+        return rt.slope(arr, res=res, neighbors=8)
+
+    def counting(arr):
+        calls.append(1)
+        return rt.slope(arr, res=res, neighbors=8)
+
+    with rasterio.open(testdem) as src:
+        for kernel, resume in ((failing, False), (counting, True)):
+            calls.clear()
+            profile = dict(src.profile, dtype='float32', count=1)
+            options = engine.RunOptions(tile_outputs=tiles, resume=resume, prefetch=0)
+            if kernel is failing:
+                with pytest.raises(RuntimeError):
+                    engine.run([src], kernel, profile, outfile, options, overlap=2)
+                assert not os.path.exists(outfile)
+            else:
+                engine.run([src], kernel, profile, outfile, options, overlap=2)
+
+    # ten of the 24 tiles were written and journaled
+    assert len(calls) == 24 - 10
+    assert not tmpdir.join('out.vrt.journal').check()
+    with rasterio.open(outfile) as src, rasterio.open(expected) as ref:
+        assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_tile_outputs_rejects_cog_and_zarr(tmpdir, runner):
+    for args in (['--cog'], ['--format', 'zarr']):
+        result = runner.invoke(
+            main_group, ['slope', testdem, str(tmpdir.join('out.vrt')),
+                         '--tile-outputs', str(tmpdir.join('tiles'))] + args)
+        assert result.exit_code == 2
+        assert '--tile-outputs writes GTiff tiles' in result.output
+        assert not tmpdir.join('tiles').check()
+
+
+def test_tile_outputs_mask_band(tmpdir, runner):
+    outfile = str(tmpdir.join('out.vrt'))
+    tiles = str(tmpdir.join('tiles'))
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '-b', '1', '--tile-outputs', tiles, '--mask-band'],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    with rasterio.open(outfile) as src:
+        assert rasterio.enums.MaskFlags.per_dataset in src.mask_flag_enums[0]
+        assert np.array_equal(src.read_masks(1) == 0, np.isnan(src.read(1)))
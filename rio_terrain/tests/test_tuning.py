@@ -0,0 +1,41 @@
+import json
+
+import rasterio
+from rasterio.rio.main import main_group
+
+import rio_terrain as rt
+from rio_terrain.core import engine, tuning
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+def test_probe_picks_a_candidate():
+    with rasterio.open(testdem) as src, engine.BandReader(src) as reader:
+        choice = tuning.probe(src, reader, rt.slope, overlap=2, max_njobs=2)
+    assert choice['blocks'] in tuning.BLOCKS
+    assert choice['njobs'] in (1, 2)
+    assert choice['rate'] > 0
+
+
+def test_autotune_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('RIO_TERRAIN_CACHE_DIR', str(tmpdir))
+    with rasterio.open(testdem) as src, engine.BandReader(src) as reader:
+        key = tuning.cache_key('slope', src)
+        tuning.write_cache(key, {'blocks': 4, 'njobs': 3, 'rate': 1.0})
+        assert tuning.autotune('slope', src, reader, rt.slope) == (4, 3)
+        # a memory budget caps the cached tile size
+        assert tuning.autotune('slope', src, reader, rt.slope, max_memory=1) == (1, 3)
+
+    with open(tuning.cache_path()) as f:
+        assert list(json.load(f)) == [key]
+
+
+def test_slope_autotune(tmpdir, monkeypatch, runner):
+    monkeypatch.setenv('RIO_TERRAIN_CACHE_DIR', str(tmpdir))
+    outfile = str(tmpdir.join('out.tif'))
+    result = runner.invoke(
+        main_group, ['slope', testdem, outfile, '--autotune'], catch_exceptions=False)
+    assert result.exit_code == 0
+    assert 'Autotuned' in result.output
+    assert tmpdir.join('autotune.json').check()
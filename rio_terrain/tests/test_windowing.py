@@ -31,6 +31,16 @@ ul_in_window = Window(col_off=10, row_off=10, width=128, height=128)
 lr_in_window = Window(col_off=62, row_off=62, width=128, height=128)
 
 
+def test_fit_blocks():
+    # 1 tile of (k*10 + 4)**2 cells at 1 byte per cell
+    assert rt.fit_blocks((10, 10), 34**2, 1, halo=2) == 3
+    assert rt.fit_blocks((10, 10), 34**2 - 1, 1, halo=2) == 2
+    assert rt.fit_blocks((10, 10), 34**2, 1, halo=2, ntiles=2) == 2
+    assert rt.fit_blocks((10, 10), 10**6, 1, limit=5) == 5
+    # never fewer than one block
+    assert rt.fit_blocks((10, 10), 1, 8) == 1
+
+
 def test_expand_window():
     ## test with upper-left window
     # expand window by margin within bounds
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.rio.main import main_group
+
+from rio_terrain.core import zarrstore
+
+
+testdem = 'rio_terrain/tests/data/dem_20m.tif'
+
+
+def test_slope_zarr(tmpdir, runner):
+    zarr = pytest.importorskip('zarr')
+    expected = str(tmpdir.join('expected.tif'))
+    store = str(tmpdir.join('out.zarr'))
+    converted = str(tmpdir.join('out.tif'))
+    runner.invoke(main_group, ['slope', testdem, expected, '-j', '0'], catch_exceptions=False)
+    result = runner.invoke(
+        main_group, ['slope', testdem, store, '-b', '1', '-j', '2', '--format', 'zarr',
+                     '--to-gtiff', converted],
+        catch_exceptions=False)
+    assert result.exit_code == 0
+    assert not tmpdir.join('out.zarr.journal').check()
+
+    arr = zarr.open_array(store, mode='r')
+    # a chunk per 256 cell tile, clipped to the 230 rows of the raster
+    assert arr.chunks == (230, 256)
+    with rasterio.open(expected) as ref:
+        assert arr.attrs['transform'] == list(ref.transform)[:6]
+        assert rasterio.crs.CRS.from_wkt(arr.attrs['crs']) == ref.crs
+        assert np.array_equal(arr[:], ref.read(1), equal_nan=True)
+        with rasterio.open(converted) as src:
+            assert src.transform == ref.transform
+            assert np.array_equal(src.read(1), ref.read(1), equal_nan=True)
+
+
+def test_zarr_gtiff_options_are_usage_errors(tmpdir, runner):
+    for args, message in (
+            (['--cog'], '--cog applies to GTiff output only'),
+            (['--mask-band'], '--mask-band applies to GTiff output only')):
+        result = runner.invoke(
+            main_group, ['slope', testdem, str(tmpdir.join('out.zarr')), '--format', 'zarr'] + args)
+        assert result.exit_code == 2
+        assert message in result.output
+        assert not tmpdir.join('out.zarr').check()
+
+
+def test_create_store_numpy_attrs(tmpdir):
+    pytest.importorskip('zarr')
+    nodata = np.finfo(np.float32).min
+    with rasterio.open(testdem) as src:
+        profile = dict(src.profile, dtype='float32', nodata=nodata)
+    store = str(tmpdir.join('out.zarr'))
+    arr = zarrstore.create_store(
+        store, profile, (256, 256), scaling=(np.float32(0.5), np.float64(10.0)))
+
+    assert arr.attrs['nodata'] == float(nodata)
+    assert (arr.attrs['scale'], arr.attrs['offset']) == (0.5, 10.0)
@@ -7,10 +7,14 @@ STARTING = "Running {} on {}"
 INMEMORY = "in-memory raster"
 SEQUENTIAL = "sequential raster blocks"
 CONCURRENT = "concurrent raster blocks"
+FRAGMENTS = "raster fragments"
+TASKS = "{} tasks of {}"
+AUTOTUNED = "Autotuned to {} blocks per tile with {} jobs"
 
 # Completion status
 COMPLETION = "Finished in {}"
 WRITEOUT = "Wrote output to {}"
+READSTATS = "Read {:.2f}x the input cells with {:.2f} decodes per block"
 
 # Warnings
 STRIPED = "Blocks are lines with shape {}. Rewrite the data blocks for sequential and parallel processing."
@@ -19,6 +23,19 @@ NOTILING = "Raster with shape {} is not tiled. Rewrite the data with tiling for
 # Errors
 NONINTERSECTING = "Input rasters are non-intersecting"
 NONALIGNED = "Raster cells are not aligned between inputs"
+MOSAICEMPTY = "Mosaic input has no sources"
+MOSAICLIST = "Mosaic input {} is not a VRT, a directory, a GeoTIFF or a text file listing sources"
+MOSAICSOURCE = "Mosaic source {} must be read without resampling, scaling or band selection"
+JOURNALMISMATCH = "Journal {} was written for a different plan, run without --resume"
+EMPTYSHARD = "Cannot split {} shards from {} rows of tiles, use fewer shards or smaller blocks"
+NODASK = "The dask backend needs dask, install rio-terrain[dask]"
+NOZARR = "Zarr output needs zarr, install rio-terrain[zarr]"
+ZARRCOG = "--cog applies to GTiff output only"
+TILEOUTPUTS = "--tile-outputs writes GTiff tiles and a VRT, without --cog or --format zarr"
+CODECLEVEL = "--codec-level applies to deflate, zstd, lerc_deflate and lerc_zstd, not {}"
+ZARRMASK = "--mask-band applies to GTiff output only"
+MAXZERROR = "--max-z-error applies to the lerc codecs, not {}"
+ZEROSCALE = "Quantization scale must not be zero"
 
 
 def printtime(t0: float, t1: float) -> str:
@@ -38,6 +55,23 @@ def printtime(t0: float, t1: float) -> str:
     return fmt
 
 
+def runmode(njobs: int) -> str:
+    """Return the description of the processing mode for a number of jobs
+
+    Parameters:
+        njobs: number of concurrent jobs, 0 for in-memory
+
+    Returns:
+        processing mode description
+    """
+    if njobs == 0:
+        return INMEMORY
+    elif njobs == 1:
+        return SEQUENTIAL
+    else:
+        return CONCURRENT
+
+
 def progress(
     value: int,
     endvalue: int,
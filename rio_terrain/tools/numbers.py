@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Union
+from typing import Optional, Union
 import numpy as np
 
 
@@ -51,3 +51,23 @@ def nan_shape(shape: tuple[int, ...]) -> np.ndarray:
     result = np.empty(shape)
     result[:] = np.nan
     return result
+
+
+def valid_mask(arr: np.ndarray, nodata: Optional[float] = None) -> np.ndarray:
+    """Return the mask band of a result, 0 for nan and nodata cells and 255 elsewhere
+
+    Parameters:
+        arr: result
+        nodata: nodata value of the output
+
+    Returns:
+        uint8 mask
+
+    """
+    valid = np.ones(arr.shape, dtype=bool)
+    if arr.dtype.kind == 'f':
+        np.logical_not(np.isnan(arr), out=valid)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= arr != nodata
+
+    return valid.view(np.uint8) * np.uint8(255)